@@ -1,7 +1,11 @@
 from django.contrib import admin
-from .models import UserProfile, Device, SensorReading
+from .models import UserProfile, Device, SensorReading, HourlyReadingRollup, DailyReadingRollup, OutgoingEmail, GatewayReception
 
 # Register your models here.
 admin.site.register(UserProfile)
 admin.site.register(Device)
 admin.site.register(SensorReading)
+admin.site.register(HourlyReadingRollup)
+admin.site.register(DailyReadingRollup)
+admin.site.register(OutgoingEmail)
+admin.site.register(GatewayReception)
@@ -0,0 +1,97 @@
+"""
+Per-device alert state machine.
+
+A device is in one of three levels (ok, warning, alert) depending on its
+latest reading and the thresholds in effect. Thresholds are set globally
+(SENSOR_WARNING_THRESHOLD, SENSOR_ALERT_THRESHOLD) and can be overridden
+per device and, above that, per user, each pair taken as a whole from one
+of these. The registry resolves them into one AlertRule per distinct pair
+of thresholds among a device's subscribers, and each rule keeps its own
+state. Users are mailed when a device escalates, when it recovers back to
+ok, and as a reminder every SENSOR_ALERT_COOLDOWN seconds while it stays
+above a threshold. Stepping down from alert to warning is not mailed.
+A reading older than the one that last changed the state does not move it,
+so late or re-ingested readings cannot undo a newer transition.
+
+The state lives in the 'alerts' cache, so evaluating a reading never
+touches the database, and the cache is only written when the state changes.
+"""
+import time
+from typing import NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+
+OK = 'ok'
+WARNING = 'warning'
+ALERT = 'alert'
+RECOVERED = 'recovered'
+
+SEVERITY = {OK: 0, WARNING: 1, ALERT: 2}
+
+cache = ConnectionProxy(caches, 'alerts')
+
+
+class AlertState(NamedTuple):
+    level: str
+    notified_at: Optional[float]
+    reading_at: Optional[float] = None
+
+
+INITIAL_STATE = AlertState(OK, None)
+
+
+class AlertRule(NamedTuple):
+    """Subscribers of a device sharing the same overrides (None: the global setting)."""
+    warning_threshold: Optional[int]
+    alert_threshold: Optional[int]
+    recipients: Tuple[str, ...]
+
+    def thresholds(self):
+        warning = settings.SENSOR_WARNING_THRESHOLD if self.warning_threshold is None else self.warning_threshold
+        alert = settings.SENSOR_ALERT_THRESHOLD if self.alert_threshold is None else self.alert_threshold
+        # The global settings may have changed since the override was
+        # validated against them; never warn above the alert level.
+        return min(warning, alert), alert
+
+
+def cache_key(device_id, thresholds=None):
+    if thresholds is None:
+        return f'alert-state:{device_id}'
+    return f'alert-state:{device_id}:{thresholds[0]}:{thresholds[1]}'
+
+
+def level_for(value, warning_threshold, alert_threshold):
+    if value > alert_threshold:
+        return ALERT
+    if value > warning_threshold:
+        return WARNING
+    return OK
+
+
+def transition(device_id, level, now=None, thresholds=None, reading_at=None):
+    """
+    Move the device's state under ``thresholds`` to ``level``. Returns the
+    notification to send (WARNING, ALERT or RECOVERED), or None when users
+    should not be mailed. ``reading_at`` is the reading's own timestamp;
+    readings older than the one that last changed the state are ignored.
+    """
+    now = time.time() if now is None else now
+    key = cache_key(device_id, thresholds)
+    state = AlertState(*cache.get(key, INITIAL_STATE))
+    if reading_at is not None and state.reading_at is not None and reading_at < state.reading_at:
+        return None
+    event = None
+    if SEVERITY[level] > SEVERITY[state.level]:
+        event = level
+    elif level == OK and state.level != OK:
+        event = RECOVERED
+    elif level != OK and (state.notified_at is None or now - state.notified_at >= settings.SENSOR_ALERT_COOLDOWN):
+        event = level
+    if level != state.level or event:
+        new_state = AlertState(level, now if event else state.notified_at,
+                               state.reading_at if reading_at is None else reading_at)
+        cache.set(key, tuple(new_state), timeout=None)
+    return event
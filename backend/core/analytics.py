@@ -0,0 +1,148 @@
+"""
+Streaming sensor-health checks, run on every reading before it is stored.
+
+Each device keeps a fixed-size summary of its stream in Django's cache
+(like the alert state): exponentially weighted mean and variance of the
+value, the last value and how often it repeated, the typical interval
+between readings, and a fast and a slow average of the RSSI. Checking a
+reading is a constant amount of arithmetic with no database access, and
+the result is stored on the reading as a bitmask in ``SensorReading.flags``:
+
+STUCK
+    The same value ANALYTICS_STUCK_COUNT or more times in a row.
+SPIKE
+    More than ANALYTICS_SPIKE_SIGMA standard deviations from the average and
+    at least ANALYTICS_SPIKE_MIN_DELTA away from the previous value.
+GAP
+    The first reading after a silence longer than ANALYTICS_GAP_FACTOR
+    times the usual interval.
+RSSI_DEGRADED
+    The recent RSSI is ANALYTICS_RSSI_DROP dB or more below its long-run
+    average, e.g. a gateway went away or the device was moved.
+
+Spikes, gaps and degradation are only flagged after ANALYTICS_WARMUP
+readings. Readings older than the newest one seen are not flagged and do
+not update the summary.
+"""
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+
+STUCK = 1
+SPIKE = 2
+GAP = 4
+RSSI_DEGRADED = 8
+
+FLAG_NAMES = {STUCK: 'stuck', SPIKE: 'spike', GAP: 'gap', RSSI_DEGRADED: 'rssi_degraded'}
+
+# The slow RSSI average reacts this many times slower than the fast one.
+SLOW_RSSI_FACTOR = 10
+
+
+def flag_names(flags):
+    return [name for flag, name in FLAG_NAMES.items() if flags & flag]
+
+
+class StreamStats:
+    __slots__ = ('count', 'mean', 'variance', 'last_value', 'last_timestamp', 'repeats', 'interval',
+                 'rssi_fast', 'rssi_slow')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.last_value = None
+        self.last_timestamp = None
+        self.repeats = 0
+        self.interval = None
+        self.rssi_fast = None
+        self.rssi_slow = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def update(self, value, rssi, timestamp):
+        """Fold one reading (``timestamp`` in epoch seconds) into the summary. Returns its flags."""
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            return 0
+        alpha = settings.ANALYTICS_EWMA_ALPHA
+        warm = self.count >= settings.ANALYTICS_WARMUP
+        flags = 0
+
+        if value == self.last_value:
+            self.repeats += 1
+        else:
+            self.repeats = 1
+        if self.repeats >= settings.ANALYTICS_STUCK_COUNT:
+            flags |= STUCK
+
+        deviation = value - self.mean
+        if (warm and abs(deviation) > settings.ANALYTICS_SPIKE_SIGMA * math.sqrt(self.variance)
+                and abs(value - self.last_value) >= settings.ANALYTICS_SPIKE_MIN_DELTA):
+            flags |= SPIKE
+        if self.count:
+            increment = alpha * deviation
+            self.mean += increment
+            self.variance = (1 - alpha) * (self.variance + deviation * increment)
+        else:
+            self.mean = value
+
+        if self.last_timestamp is not None:
+            elapsed = timestamp - self.last_timestamp
+            if warm and self.interval and elapsed > settings.ANALYTICS_GAP_FACTOR * self.interval:
+                # Not folded into the interval, which would learn the outage.
+                flags |= GAP
+            else:
+                self.interval = elapsed if self.interval is None else self.interval + alpha * (elapsed - self.interval)
+
+        if rssi is not None:
+            if self.rssi_fast is None:
+                self.rssi_fast = self.rssi_slow = rssi
+            else:
+                self.rssi_fast += alpha * (rssi - self.rssi_fast)
+                self.rssi_slow += alpha / SLOW_RSSI_FACTOR * (rssi - self.rssi_slow)
+            if warm and self.rssi_slow - self.rssi_fast >= settings.ANALYTICS_RSSI_DROP:
+                flags |= RSSI_DEGRADED
+
+        self.count += 1
+        self.last_value = value
+        self.last_timestamp = timestamp
+        return flags
+
+
+def cache_key(device_id):
+    return f'stream-stats:{device_id}'
+
+
+def flag_readings(readings):
+    """
+    Set ``flags`` on unsaved readings (with datetime timestamps), in time
+    order. Returns the updated summaries, to pass to ``save`` once the
+    readings are stored.
+    """
+    keys = {reading.device_id: cache_key(reading.device_id) for reading in readings}
+    cached = cache.get_many(keys.values())
+    stats = {device_id: cached.get(key) or StreamStats() for device_id, key in keys.items()}
+    for reading in sorted(readings, key=lambda reading: reading.timestamp):
+        reading.flags = stats[reading.device_id].update(
+            float(reading.value), reading.rssi, reading.timestamp.timestamp(),
+        )
+    return stats
+
+
+def save(stats, readings):
+    """Keep the summaries returned by ``flag_readings`` after ``readings`` were stored."""
+    cache.set_many({cache_key(device_id): summary for device_id, summary in stats.items()},
+                   timeout=settings.ANALYTICS_STATE_TTL)
+    for reading in readings:
+        if reading.flags:
+            for name in flag_names(reading.flags):
+                metrics.READINGS_FLAGGED.labels(name).inc()
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from . import checks  # noqa: F401 -- register the system checks
+        from . import dashboard, live, metrics, registry, rollups  # noqa: F401 -- connect their signal receivers
@@ -0,0 +1,201 @@
+"""
+Append-only archive of every raw uplink payload received over MQTT, so
+messages that failed to ingest can be replayed later (``manage.py
+replayuplinks``).
+
+An archive directory holds segments named
+``uplinks-<UTC start>-<pid>-<seq>.<compression>``. A segment is a sequence
+of independently compressed blocks (gzip members or zstd frames), each
+holding up to UPLINK_ARCHIVE_BLOCK_RECORDS records of::
+
+    received_at (float64, big endian) | length (uint32) | payload
+
+Next to every segment, ``<segment>.idx`` has one line per block with its
+byte offset, record count and first ``received_at``, so readers can seek to
+a block without decompressing the ones before it. Segments are rotated
+after UPLINK_ARCHIVE_SEGMENT_BYTES or UPLINK_ARCHIVE_SEGMENT_SECONDS.
+Records still buffered when a process dies are lost: blocks are flushed
+when full, after UPLINK_ARCHIVE_FLUSH_INTERVAL and on shutdown.
+"""
+import gzip
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+RECORD_HEADER = struct.Struct('>dI')
+
+
+def _zstd():
+    import zstandard
+    return zstandard
+
+
+# (compress a block, decompress the block at the start of some bytes)
+CODECS = {
+    'gzip': (
+        lambda data: gzip.compress(data, compresslevel=6),
+        lambda data: zlib.decompressobj(wbits=31).decompress(data),
+    ),
+    'zstd': (
+        lambda data: _zstd().ZstdCompressor(level=3).compress(data),
+        lambda data: _zstd().ZstdDecompressor().decompressobj().decompress(data),
+    ),
+}
+
+
+class IndexEntry(NamedTuple):
+    offset: int
+    records: int
+    first_received_at: float
+
+
+class UplinkArchive:
+    def __init__(self, directory, compression=None, segment_bytes=None, segment_seconds=None,
+                 block_records=None, flush_interval=None):
+        self.directory = Path(directory)
+        self.compression = compression or settings.UPLINK_ARCHIVE_COMPRESSION
+        self.compress = CODECS[self.compression][0]
+        self.segment_bytes = segment_bytes or settings.UPLINK_ARCHIVE_SEGMENT_BYTES
+        self.segment_seconds = segment_seconds or settings.UPLINK_ARCHIVE_SEGMENT_SECONDS
+        self.block_records = block_records or settings.UPLINK_ARCHIVE_BLOCK_RECORDS
+        self.flush_interval = flush_interval or settings.UPLINK_ARCHIVE_FLUSH_INTERVAL
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._first_received_at = None
+        self._last_flush = time.monotonic()
+        self._segment = None
+        self._index = None
+        self._segment_started = 0.0
+        self._sequence = 0
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Flush in the background too, so a quiet period does not hold records back."""
+        threading.Thread(target=self._run, name='uplink-archive', daemon=True).start()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def append(self, payload, received_at=None):
+        received_at = time.time() if received_at is None else received_at
+        with self._lock:
+            if not self._buffer:
+                self._first_received_at = received_at
+            self._buffer.append(RECORD_HEADER.pack(received_at, len(payload)))
+            self._buffer.append(payload)
+            if (len(self._buffer) // 2 >= self.block_records
+                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self._stopping.set()
+        with self._lock:
+            self._flush()
+            self._close_segment()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        if self._segment is None or self._should_rotate():
+            self._close_segment()
+            self._open_segment()
+        block = self.compress(b''.join(self._buffer))
+        offset = self._segment.tell()
+        self._segment.write(block)
+        self._segment.flush()
+        # Written after the block, so the index never points past the data.
+        self._index.write(f'{offset}\t{len(self._buffer) // 2}\t{self._first_received_at!r}\n')
+        self._index.flush()
+        self._buffer = []
+
+    def _should_rotate(self):
+        return (self._segment.tell() >= self.segment_bytes
+                or time.time() - self._segment_started >= self.segment_seconds)
+
+    def _open_segment(self):
+        self._segment_started = time.time()
+        self._sequence += 1
+        stamp = datetime.fromtimestamp(self._segment_started, timezone.utc).strftime('%Y%m%dT%H%M%S')
+        path = self.directory / f'uplinks-{stamp}-{os.getpid()}-{self._sequence:04d}.{self.compression}'
+        self._segment = open(path, 'ab')
+        self._index = open(f'{path}.idx', 'a')
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+
+def read_index(segment):
+    with open(f'{segment}.idx') as f:
+        return [
+            IndexEntry(int(offset), int(records), float(first))
+            for offset, records, first in (line.split('\t') for line in f if line.endswith('\n'))
+        ]
+
+
+def read_segment(segment, since=None, until=None):
+    """Yield (received_at, payload) from one segment, optionally limited to a time range."""
+    segment = Path(segment)
+    decompress = CODECS[segment.suffix.lstrip('.')][1]
+    entries = read_index(segment)
+    with open(segment, 'rb') as f:
+        for position, entry in enumerate(entries):
+            following = entries[position + 1] if position + 1 < len(entries) else None
+            if since is not None and following is not None and following.first_received_at < since:
+                continue
+            if until is not None and entry.first_received_at >= until:
+                break
+            f.seek(entry.offset)
+            data = decompress(f.read(following.offset - entry.offset) if following else f.read())
+            view = memoryview(data)
+            cursor = 0
+            while cursor < len(data):
+                received_at, length = RECORD_HEADER.unpack_from(view, cursor)
+                cursor += RECORD_HEADER.size
+                payload = bytes(view[cursor:cursor + length])
+                cursor += length
+                if (since is None or received_at >= since) and (until is None or received_at < until):
+                    yield received_at, payload
+
+
+def list_segments(path):
+    """Segments in ``path`` (a directory or a single segment), oldest first."""
+    path = Path(path)
+    if path.is_file():
+        return [path]
+    return sorted(
+        (segment for codec in CODECS for segment in path.glob(f'uplinks-*.{codec}')),
+        key=lambda segment: segment.name,
+    )
+
+
+@lru_cache
+def get_archive():
+    """The process-wide archive, or None when UPLINK_ARCHIVE_DIR is not set."""
+    if not settings.UPLINK_ARCHIVE_DIR:
+        return None
+    archive = UplinkArchive(settings.UPLINK_ARCHIVE_DIR)
+    archive.start()
+    return archive
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of uplink decoding: the original on_message path against
+each available decoder in ``core.decoders``.
+
+    python -m core.benchmarks.decoding [number]
+"""
+import json
+import sys
+import timeit
+
+from .generator import SAMPLE
+
+
+def sample_payload():
+    return json.dumps(json.loads(SAMPLE.read_text())).encode()
+
+
+def decode_baseline(payload):
+    from core.sensor import parse_uplink
+
+    # What on_message did before decoders: decode to str, parse the whole
+    # document, format the debug message and walk it with parse_uplink.
+    text = payload.decode()
+    data = json.loads(text)
+    f"Received message topic: {text}"
+    return parse_uplink(data)
+
+
+def benchmark(payload=None, number=20000, repeat=5):
+    """Best-of-``repeat`` microseconds per decode, keyed by decoder name."""
+    from core import decoders
+
+    payload = payload or sample_payload()
+    candidates = {'baseline': decode_baseline}
+    candidates.update((name, decoders.DECODERS[name]) for name in decoders.available_decoders())
+    expected = decode_baseline(payload)
+    results = {}
+    for name, decode in candidates.items():
+        if decode(payload) != expected:
+            raise AssertionError(f'{name} decoded {decode(payload)}, expected {expected}')
+        best = min(timeit.repeat(lambda: decode(payload), number=number, repeat=repeat))
+        results[name] = best / number * 1e6
+    return results
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 20000
+    results = benchmark(number=number)
+    baseline = results['baseline']
+    for name, micros in results.items():
+        print(f'{name:10} {micros:8.2f} us/msg  {baseline / micros:5.2f}x')
+
+
+if __name__ == '__main__':
+    import os
+
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'radon_backend.settings')
+    django.setup()
+    main(sys.argv)
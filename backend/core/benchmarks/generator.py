@@ -0,0 +1,59 @@
+"""
+Synthetic ChirpStack uplink events for load and benchmark runs.
+
+Events are built from the sample event in ``files/`` and vary the device,
+value, RSSI and time. Output is reproducible for a given seed.
+"""
+import copy
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+
+SAMPLE = Path(__file__).parent / 'files' / 'chirpstack_uplink.json'
+
+
+def serial_numbers(devices, prefix='bench'):
+    return [f'{prefix}{index:012x}' for index in range(devices)]
+
+
+def generate_events(count, devices=10, duplicate_rate=0.0, crossing_rate=0.05, seed=0,
+                    start=None, interval=timedelta(minutes=10), prefix='bench'):
+    """
+    Yield ``count`` uplink events spread round-robin over ``devices`` devices.
+
+    ``duplicate_rate`` of the events repeat an earlier event's
+    deduplicationId (as a broker redelivery would) and ``crossing_rate`` of
+    the values are above the warning threshold, half of those above the
+    alert threshold.
+    """
+    from django.conf import settings
+
+    rng = random.Random(seed)
+    template = json.loads(SAMPLE.read_text())
+    serials = serial_numbers(devices, prefix)
+    start = start or datetime.now(timezone.utc) - interval * (count // max(devices, 1) + 1)
+    warning = settings.SENSOR_WARNING_THRESHOLD
+    alert = settings.SENSOR_ALERT_THRESHOLD
+    sent = []
+    for index in range(count):
+        if sent and rng.random() < duplicate_rate:
+            yield rng.choice(sent)
+            continue
+        event = copy.deepcopy(template)
+        if rng.random() < crossing_rate:
+            value = rng.randint(warning + 1, alert) if rng.random() < 0.5 else rng.randint(alert + 1, alert * 2)
+        else:
+            value = rng.randint(0, warning)
+        event['deduplicationId'] = f'{prefix}-{seed}-{index}'
+        event['time'] = (start + interval * (index // max(devices, 1))).isoformat()
+        event['deviceInfo']['devEui'] = serials[index % devices]
+        event['object']['hexdata'] = str(value)
+        event['rxInfo'][0]['rssi'] = rng.randint(-120, -40)
+        # Keep a bounded pool of candidates for redelivery.
+        if len(sent) < 1000:
+            sent.append(event)
+        else:
+            sent[rng.randrange(len(sent))] = event
+        yield event
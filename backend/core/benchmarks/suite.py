@@ -0,0 +1,246 @@
+"""
+Ingest and dashboard benchmarks. Run them with ``manage.py runbenchmarks``,
+which sets up a throwaway test database first: every benchmark here writes
+readings. Each run starts by deleting what earlier ones left there (with
+``--keepdb``), so it stores the same new readings every time instead of
+measuring the duplicate path.
+"""
+import json
+import math
+import platform
+import time
+from datetime import datetime, timedelta, timezone
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+
+from ..models import Device, SensorReading
+from ..registry import registry
+from ..rollups import rebuild_rollups
+from ..sensor import process_message
+from .generator import generate_events, serial_numbers
+
+
+def summarize(samples):
+    """Latency summary in milliseconds of a list of durations in seconds."""
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'min_ms': round(ordered[0] * 1000, 3),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+# Serial number prefixes of the devices the benchmarks create.
+DEVICE_PREFIXES = ('pm', 'http', 'bulk', 'dash')
+
+
+def reset():
+    """Delete the devices, readings and users left by earlier runs."""
+    devices = Device.objects.none()
+    for prefix in DEVICE_PREFIXES:
+        devices |= Device.objects.filter(serial_number__startswith=prefix)
+    # Readings first, in one statement, rather than collected per device.
+    SensorReading.objects.filter(device__in=devices).delete()
+    devices.delete()
+    get_user_model().objects.filter(username__startswith='bench').delete()
+    registry.clear()
+
+
+def register_devices(devices, prefix='bench'):
+    Device.objects.bulk_create(
+        [Device(serial_number=serial_number, name=serial_number) for serial_number in serial_numbers(devices, prefix)],
+        ignore_conflicts=True,
+    )
+    # bulk_create sends no signals to drop negative registry entries.
+    registry.clear()
+
+
+def _throughput(name, params, count, elapsed, samples=None, **extra):
+    result = {
+        'benchmark': name,
+        'params': params,
+        'messages': count,
+        'seconds': round(elapsed, 4),
+        'messages_per_second': round(count / elapsed, 1) if elapsed else None,
+        **extra,
+    }
+    if samples:
+        result['latency'] = summarize(samples)
+    return result
+
+
+def bench_process_message(events, devices, duplicate_rate, crossing_rate, seed=0):
+    params = dict(events=events, devices=devices, duplicate_rate=duplicate_rate, crossing_rate=crossing_rate)
+    register_devices(devices, prefix='pm')
+    messages = list(generate_events(events, devices, duplicate_rate, crossing_rate, seed, prefix='pm'))
+    samples = []
+    started = time.perf_counter()
+    for message in messages:
+        tick = time.perf_counter()
+        process_message(message)
+        samples.append(time.perf_counter() - tick)
+    return _throughput('process_message', params, len(messages), time.perf_counter() - started, samples)
+
+
+def bench_http_ingest(events, devices, duplicate_rate, crossing_rate, seed=0):
+    params = dict(events=events, devices=devices, duplicate_rate=duplicate_rate, crossing_rate=crossing_rate)
+    register_devices(devices, prefix='http')
+    messages = [
+        json.dumps(message)
+        for message in generate_events(events, devices, duplicate_rate, crossing_rate, seed, prefix='http')
+    ]
+    client = Client(HTTP_AUTHORIZATION=f'Api-Key {settings.CENTRAL_COLLECTOR_API_KEY}')
+    url = reverse('sensor-ingest')
+    samples = []
+    statuses = {}
+    started = time.perf_counter()
+    for body in messages:
+        tick = time.perf_counter()
+        response = client.post(url, body, content_type='application/json')
+        samples.append(time.perf_counter() - tick)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    return _throughput('http_ingest', params, len(messages), time.perf_counter() - started, samples, statuses=statuses)
+
+
+def bench_http_bulk_ingest(events, devices, duplicate_rate, crossing_rate, seed=0, request_size=1000):
+    params = dict(events=events, devices=devices, duplicate_rate=duplicate_rate, crossing_rate=crossing_rate,
+                  request_size=request_size)
+    register_devices(devices, prefix='bulk')
+    messages = list(generate_events(events, devices, duplicate_rate, crossing_rate, seed, prefix='bulk'))
+    bodies = [
+        ''.join(json.dumps(message) + '\n' for message in messages[offset:offset + request_size])
+        for offset in range(0, len(messages), request_size)
+    ]
+    client = Client(HTTP_AUTHORIZATION=f'Api-Key {settings.CENTRAL_COLLECTOR_API_KEY}')
+    url = reverse('sensor-ingest-bulk')
+    samples = []
+    accepted = 0
+    started = time.perf_counter()
+    for body in bodies:
+        tick = time.perf_counter()
+        response = client.post(url, body, content_type='application/x-ndjson')
+        samples.append(time.perf_counter() - tick)
+        accepted += response.json()['accepted']
+    return _throughput('http_bulk_ingest', params, len(messages), time.perf_counter() - started, samples,
+                       accepted=accepted)
+
+
+def populate_readings(device, rows, span=timedelta(days=30), batch_size=10000):
+    """Insert ``rows`` readings for ``device`` spread evenly over the last ``span``."""
+    end = datetime.now(timezone.utc)
+    step = span / rows
+    if connection.vendor == 'postgresql':
+        # Generating the rows server side is what makes 100M-row runs feasible.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {connection.ops.quote_name(SensorReading._meta.db_table)} '
+                '(date_created, date_updated, device_id, value, rssi, "timestamp", "deduplicationId", flags) '
+                'SELECT now(), now(), %s, 100 + 60 * sin(i / 500.0), -70, '
+                '%s - make_interval(secs => i * %s), %s || i, 0 '
+                'FROM generate_series(1, %s) AS i',
+                [device.pk, end, step.total_seconds(), f'fill-{device.pk}-', rows],
+            )
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(SensorReading._meta.db_table)}')
+        return
+    for offset in range(0, rows, batch_size):
+        SensorReading.objects.bulk_create(
+            SensorReading(
+                device=device,
+                value=100 + 60 * math.sin(i / 500.0),
+                rssi=-70,
+                timestamp=end - step * i,
+                deduplicationId=f'fill-{device.pk}-{i}',
+            )
+            for i in range(offset + 1, min(offset + batch_size, rows) + 1)
+        )
+
+
+def bench_dashboard(rows, repeat=20):
+    user = get_user_model().objects.create_user(username=f'bench{rows}', password='bench')
+    device = Device.objects.create(serial_number=f'dash{rows}', name=f'Dashboard {rows}')
+    device.users.add(user)
+    started = time.perf_counter()
+    populate_readings(device, rows)
+    rebuild_rollups(devices=[device])
+    populate_seconds = time.perf_counter() - started
+    client = Client(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+    url = reverse('device-dashboard', args=[device.serial_number])
+    client.get(url)  # warm up caches and connections
+    samples = []
+    with override_settings(DASHBOARD_CACHE_TTL=0), CaptureQueriesContext(connection) as queries:
+        for _ in range(repeat):
+            tick = time.perf_counter()
+            response = client.get(url)
+            samples.append(time.perf_counter() - tick)
+    cached_samples = []
+    # A single process, so the cache works here even when it is LocMemCache.
+    with override_settings(DASHBOARD_CACHE_TTL=settings.DASHBOARD_CACHE_TTL or 60):
+        for _ in range(repeat):
+            tick = time.perf_counter()
+            client.get(url)
+            cached_samples.append(time.perf_counter() - tick)
+    return {
+        'benchmark': 'dashboard',
+        'params': dict(rows=rows, repeat=repeat, use_rollups=settings.DASHBOARD_USE_ROLLUPS),
+        'populate_seconds': round(populate_seconds, 3),
+        'status': response.status_code,
+        'queries_per_request': len(queries) / repeat,
+        'latency': summarize(samples),
+        'cached_latency': summarize(cached_samples),
+    }
+
+
+INGEST_BENCHMARKS = {
+    'process_message': bench_process_message,
+    'http_ingest': bench_http_ingest,
+    'http_bulk_ingest': bench_http_bulk_ingest,
+}
+
+BENCHMARKS = (*INGEST_BENCHMARKS, 'dashboard')
+
+
+def run(benchmarks=BENCHMARKS, events=2000, devices=50, duplicate_rate=0.05, crossing_rate=0.05,
+        dashboard_rows=(10000, 100000), dashboard_repeat=20, seed=0, log=None):
+    """Run the selected benchmarks and return a JSON-serializable report."""
+    started_at = datetime.now(timezone.utc)
+    reset()
+    results = []
+    for name in benchmarks:
+        if name == 'dashboard':
+            for rows in dashboard_rows:
+                if log:
+                    log(f'dashboard: {rows} rows')
+                results.append(bench_dashboard(rows, repeat=dashboard_repeat))
+            continue
+        if log:
+            log(f'{name}: {events} events')
+        results.append(INGEST_BENCHMARKS[name](events, devices, duplicate_rate, crossing_rate, seed))
+    return {
+        'meta': {
+            'started_at': started_at.isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'settings': {
+                name: getattr(settings, name)
+                for name in ('UPLINK_DECODER', 'INGEST_BATCH_SIZE', 'DASHBOARD_USE_ROLLUPS', 'DASHBOARD_CACHE_TTL')
+            },
+        },
+        'results': results,
+    }
+
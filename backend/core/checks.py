@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, Tags, register
+
+
+def cache_is_shared(alias='default'):
+    """Whether the cache is seen by every process, unlike the per-process LocMemCache."""
+    return not isinstance(caches[alias], LocMemCache)
+
+
+@register(Tags.caches)
+def check_dashboard_cache(app_configs, **kwargs):
+    # Readings usually arrive in the MQTT process, whose invalidations
+    # would never reach a web process's own LocMemCache.
+    if settings.DASHBOARD_CACHE_TTL and not cache_is_shared():
+        return [Error(
+            'DASHBOARD_CACHE_TTL is set but the default cache is a per-process LocMemCache, '
+            'so dashboards would not be invalidated by readings stored in other processes.',
+            hint='Point CACHE_BACKEND and CACHE_LOCATION at a shared cache, or set DASHBOARD_CACHE_TTL=0.',
+            id='core.E001',
+        )]
+    return []
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal as D
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Avg, Count, FloatField, Max, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import NullIf, TruncDay, TruncHour, TruncMinute
+from django.dispatch import receiver
+
+from .models import HourlyReadingRollup, SensorReading
+from .rollups import hour_bucket
+from .signals import readings_stored
+
+
+AVERAGE_WINDOWS = {
+    '24_hours': timedelta(days=1),
+    '7_days': timedelta(days=7),
+    '30_days': timedelta(days=30),
+}
+STATISTICS_WINDOW = timedelta(days=30)
+TREND_WINDOW = timedelta(days=30)
+# Bucket sizes the trend can be averaged into, finest first.
+TREND_RESOLUTIONS = {
+    'minute': (TruncMinute, timedelta(minutes=1)),
+    'hour': (TruncHour, timedelta(hours=1)),
+    'day': (TruncDay, timedelta(days=1)),
+}
+
+
+def _quantize(value):
+    return D(value).quantize(D('0.01')) if value is not None else None
+
+
+def window_statistics(device, now):
+    """
+    Averages over AVERAGE_WINDOWS plus min, max and count over the last 30
+    days, computed by the database in a single query.
+
+    With DASHBOARD_USE_ROLLUPS the query reads at most one hourly rollup per
+    hour of the window (windows then start on the hour); otherwise it
+    aggregates the raw readings.
+    """
+    if settings.DASHBOARD_USE_ROLLUPS:
+        since = {name: hour_bucket(now - window) for name, window in AVERAGE_WINDOWS.items()}
+        aggregates = {}
+        for name, start in since.items():
+            aggregates[f'{name}_total'] = Sum('total', filter=Q(bucket__gte=start))
+            aggregates[f'{name}_count'] = Sum('count', filter=Q(bucket__gte=start))
+        row = HourlyReadingRollup.objects.filter(
+            device=device, bucket__gte=hour_bucket(now - STATISTICS_WINDOW),
+        ).aggregate(minimum=Min('minimum'), maximum=Max('maximum'), **aggregates)
+        averages = {
+            name: row[f'{name}_total'] / row[f'{name}_count'] if row[f'{name}_count'] else None
+            for name in AVERAGE_WINDOWS
+        }
+        count = row['30_days_count'] or 0
+    else:
+        aggregates = {
+            name: Avg('value', filter=Q(timestamp__gte=now - window))
+            for name, window in AVERAGE_WINDOWS.items()
+        }
+        row = SensorReading.objects.filter(
+            device=device, timestamp__gte=now - STATISTICS_WINDOW,
+        ).aggregate(minimum=Min('value'), maximum=Max('value'), count=Count('id'), **aggregates)
+        averages = {name: row[name] for name in AVERAGE_WINDOWS}
+        count = row['count']
+    return (
+        {name: _quantize(value) for name, value in averages.items()},
+        {'minimum': row['minimum'], 'maximum': row['maximum'], 'count': count},
+    )
+
+
+def average_subquery(now, window):
+    """
+    Subquery for annotating devices with their average value over ``window``,
+    from the hourly rollups with DASHBOARD_USE_ROLLUPS as in
+    ``window_statistics``.
+    """
+    if settings.DASHBOARD_USE_ROLLUPS:
+        rows = HourlyReadingRollup.objects.filter(device=OuterRef('pk'), bucket__gte=hour_bucket(now - window))
+        average = Sum('total') / NullIf(Sum('count'), 0)
+    else:
+        rows = SensorReading.objects.filter(device=OuterRef('pk'), timestamp__gte=now - window)
+        average = Avg('value')
+    return Subquery(rows.values('device').annotate(average=average).values('average'), output_field=FloatField())
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling of ``points``, a list of
+    (x, y, *extra) tuples sorted by x, to at most ``threshold`` points.
+    Keeps the first and last point and the visually significant ones between.
+    """
+    if threshold >= len(points) or threshold < 3:
+        return points
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_bucket = points[end:next_end] or points[-1:]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+        ax, ay = points[a][0], points[a][1]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def trend(device, now, count, resolution='auto', max_points=1000):
+    """
+    The device's readings over the last 30 days, at most ``max_points`` of them.
+
+    ``count`` is the number of raw readings in the window. With resolution
+    'auto' the raw readings are returned when they fit, otherwise they are
+    averaged by the database into the finest bucket size that fits. Whatever
+    is still above ``max_points`` is reduced with LTTB.
+    Returns (resolution used, points).
+    """
+    readings = SensorReading.objects.filter(device=device, timestamp__gte=now - TREND_WINDOW)
+    if resolution == 'auto':
+        resolution = 'raw'
+        if count > max_points:
+            for resolution, (_, size) in TREND_RESOLUTIONS.items():
+                if TREND_WINDOW / size <= max_points:
+                    break
+    if resolution == 'raw':
+        rows = readings.order_by('timestamp').values_list('timestamp', 'value', 'rssi')
+    else:
+        trunc = TREND_RESOLUTIONS[resolution][0]
+        rows = (
+            readings.annotate(bucket=trunc('timestamp'))
+            .values('bucket')
+            .annotate(avg_value=Avg('value'), avg_rssi=Avg('rssi'))
+            .order_by('bucket')
+            .values_list('bucket', 'avg_value', 'avg_rssi')
+        )
+    points = [(timestamp.timestamp(), value, rssi, timestamp) for timestamp, value, rssi in rows]
+    return resolution, [
+        {'timestamp': timestamp.isoformat(), 'value': value, 'rssi': rssi}
+        for _, value, rssi, timestamp in lttb(points, max_points)
+    ]
+
+
+def _version_key(device_id):
+    return f'dashboard-version:{device_id}'
+
+
+def cache_version(device_id):
+    """
+    Token that changes whenever a reading is stored for the device. Cached
+    payloads are keyed by it, so storing a reading invalidates them all in
+    every process sharing the cache.
+    """
+    version = cache.get(_version_key(device_id))
+    if version is None:
+        cache.add(_version_key(device_id), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(device_id))
+    return version
+
+
+def invalidate(device_ids):
+    # A fresh token rather than an increment: after the old one is evicted
+    # a counter could restart at a value that still has payloads cached.
+    cache.set_many({_version_key(device_id): time.time_ns() for device_id in device_ids}, timeout=None)
+
+
+@receiver(readings_stored)
+def invalidate_dashboards(sender, readings, **kwargs):
+    device_ids = {reading.device_id for reading in readings}
+    # After the commit, or a request in between could cache the old readings
+    # under the new version.
+    transaction.on_commit(lambda: invalidate(device_ids))
+
+
+def etag(payload):
+    return '"%s"' % hashlib.md5(json.dumps(payload, cls=DjangoJSONEncoder, sort_keys=True).encode()).hexdigest()
+
+
+def cached_payload(device_id, params, build):
+    """
+    (ETag, payload) of a dashboard, where ``build()`` computes the payload.
+
+    Payloads are cached per device and query parameters until a reading is
+    stored for the device, or for DASHBOARD_CACHE_TTL seconds as the time
+    windows move on. A TTL of 0 disables the cache.
+    """
+    if not settings.DASHBOARD_CACHE_TTL:
+        payload = build()
+        return etag(payload), payload
+    query = ':'.join(f'{name}={params[name]}' for name in sorted(params))
+    key = f'dashboard:{device_id}:{cache_version(device_id)}:{settings.DASHBOARD_USE_ROLLUPS:d}:{query}'
+    entry = cache.get(key)
+    if entry is None:
+        payload = build()
+        entry = (etag(payload), payload)
+        cache.set(key, entry, settings.DASHBOARD_CACHE_TTL)
+    return entry
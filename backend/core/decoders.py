@@ -0,0 +1,115 @@
+"""
+Decoders turning a raw ChirpStack uplink payload (bytes) into an Uplink.
+
+ChirpStack events carry a lot we do not store (every gateway's rxInfo,
+locations, metadata). The msgspec decoder validates straight into structs
+holding only the five fields we need and skips the rest while parsing; the
+orjson and json decoders build the full document and pick the fields out
+with ``parse_uplink``. UPLINK_DECODER selects one, by default the fastest
+installed.
+"""
+import json
+from functools import lru_cache
+from typing import List, Optional
+
+from django.conf import settings
+
+from .exceptions import SensorException
+from .sensor import Reception, Uplink, best_rssi, parse_uplink
+
+
+def decode_json(payload):
+    try:
+        return parse_uplink(json.loads(payload))
+    except (ValueError, TypeError, AttributeError, KeyError, IndexError) as exc:
+        raise SensorException(f'Invalid uplink payload: {exc}')
+
+
+def decode_orjson(payload):
+    import orjson
+
+    try:
+        return parse_uplink(orjson.loads(payload))
+    except (ValueError, TypeError, AttributeError, KeyError, IndexError) as exc:
+        raise SensorException(f'Invalid uplink payload: {exc}')
+
+
+_msgspec_decoder = None
+
+
+def _make_msgspec_decoder():
+    import msgspec
+
+    class DeviceInfo(msgspec.Struct):
+        devEui: Optional[str] = None
+
+    class Object(msgspec.Struct):
+        hexdata: Optional[str] = None
+
+    class RxInfo(msgspec.Struct):
+        gatewayId: Optional[str] = None
+        rssi: Optional[float] = None
+        snr: Optional[float] = None
+
+    class Event(msgspec.Struct):
+        deduplicationId: Optional[str] = None
+        time: Optional[str] = None
+        deviceInfo: DeviceInfo = msgspec.field(default_factory=DeviceInfo)
+        object: Object = msgspec.field(default_factory=Object)
+        rxInfo: List[RxInfo] = msgspec.field(default_factory=list)
+
+    return msgspec.json.Decoder(Event), msgspec.ValidationError, msgspec.DecodeError
+
+
+def decode_msgspec(payload):
+    global _msgspec_decoder
+    if _msgspec_decoder is None:
+        _msgspec_decoder = _make_msgspec_decoder()
+    decoder, validation_error, decode_error = _msgspec_decoder
+    try:
+        event = decoder.decode(payload)
+    except validation_error:
+        # Valid JSON of an unexpected shape (e.g. a numeric hexdata): let
+        # the generic path extract what it can, exactly as before.
+        return decode_json(payload)
+    except decode_error as exc:
+        raise SensorException(f'Invalid uplink payload: {exc}')
+    receptions = tuple(Reception(rx.gatewayId, rx.rssi, rx.snr) for rx in event.rxInfo)
+    return Uplink(
+        deduplicationId=event.deduplicationId,
+        time=event.time,
+        devEui=event.deviceInfo.devEui,
+        hexdata=event.object.hexdata,
+        rssi=best_rssi(receptions),
+        receptions=receptions,
+    )
+
+
+DECODERS = {
+    'msgspec': decode_msgspec,
+    'orjson': decode_orjson,
+    'json': decode_json,
+}
+
+
+@lru_cache
+def available_decoders():
+    names = []
+    for name, module in (('msgspec', 'msgspec'), ('orjson', 'orjson')):
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        names.append(name)
+    return names + ['json']
+
+
+def get_decoder(name=None):
+    """The decoder called ``name`` (default UPLINK_DECODER); 'auto' picks the fastest installed."""
+    name = name or settings.UPLINK_DECODER
+    if name == 'auto':
+        name = available_decoders()[0]
+    try:
+        return DECODERS[name]
+    except KeyError:
+        raise ValueError(f'Unknown uplink decoder: {name!r}')
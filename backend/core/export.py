@@ -0,0 +1,146 @@
+"""
+Streaming export of sensor readings as CSV, NDJSON or Parquet.
+
+Rows are read with a server-side cursor in chunks and encoded chunk by
+chunk, so memory use does not depend on how many readings are exported.
+Under ASGI the chunks must be wrapped with ``aiter_chunks``: Django reads a
+synchronous iterator into memory before sending any of it.
+Parquet support needs the optional ``pyarrow`` package.
+"""
+import csv
+import io
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+COLUMNS = ('serial_number', 'timestamp', 'value', 'rssi', 'deduplicationId')
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def export_rows(readings):
+    """Reading rows ordered by device and time, fetched ``EXPORT_CHUNK_SIZE`` at a time."""
+    return (
+        readings.order_by('device_id', 'timestamp', 'id')
+        .values_list('device__serial_number', 'timestamp', 'value', 'rssi', 'deduplicationId')
+        .iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    )
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_stream(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for chunk in _chunks(rows, settings.EXPORT_CHUNK_SIZE):
+        writer.writerows(
+            (serial_number, timestamp.isoformat(), value, rssi, deduplicationId)
+            for serial_number, timestamp, value, rssi, deduplicationId in chunk
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def ndjson_stream(rows):
+    for chunk in _chunks(rows, settings.EXPORT_CHUNK_SIZE):
+        yield ''.join(
+            json.dumps(dict(zip(COLUMNS, (serial_number, timestamp.isoformat(), value, rssi, deduplicationId)))) + '\n'
+            for serial_number, timestamp, value, rssi, deduplicationId in chunk
+        ).encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last drain."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data, self.parts = b''.join(self.parts), []
+        return data
+
+
+def parquet_stream(rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('serial_number', pa.string()),
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('value', pa.float64()),
+        ('rssi', pa.float64()),
+        ('deduplicationId', pa.string()),
+    ])
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        # Each chunk becomes one row group and is flushed out straight away.
+        for chunk in _chunks(rows, settings.EXPORT_CHUNK_SIZE):
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(zip(*chunk), schema)],
+                schema=schema,
+            ))
+            yield sink.drain()
+    yield sink.drain()
+
+
+STREAMS = {
+    'csv': csv_stream,
+    'ndjson': ndjson_stream,
+    'parquet': parquet_stream,
+}
+
+
+def export_readings(readings, export_format):
+    """Iterator of encoded byte chunks for the given SensorReading queryset."""
+    return STREAMS[export_format](export_rows(readings))
+
+
+
+async def aiter_chunks(chunks):
+    """Async iterator over ``chunks``, producing each one in the sync thread that holds the cursor."""
+    chunks = iter(chunks)
+    done = object()
+    try:
+        while (chunk := await sync_to_async(next)(chunks, done)) is not done:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
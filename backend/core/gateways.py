@@ -0,0 +1,35 @@
+"""
+Gateway coverage statistics from the per-gateway receptions stored at ingest.
+"""
+from django.db.models import Avg, Count, Max, Min
+
+from .models import GatewayReception
+
+
+def coverage(since=None, until=None, devices=None, gateway_id=None):
+    """
+    Per-gateway reception counts and signal quality, busiest gateway first.
+    Filters use the (gateway_id, timestamp) and (device, timestamp) indexes.
+    """
+    receptions = GatewayReception.objects.all()
+    if since is not None:
+        receptions = receptions.filter(timestamp__gte=since)
+    if until is not None:
+        receptions = receptions.filter(timestamp__lt=until)
+    if devices is not None:
+        receptions = receptions.filter(device__in=devices)
+    if gateway_id is not None:
+        receptions = receptions.filter(gateway_id=gateway_id)
+    return list(
+        receptions.values('gateway_id')
+        .annotate(
+            receptions=Count('id'),
+            devices=Count('device', distinct=True),
+            avg_rssi=Avg('rssi'),
+            min_rssi=Min('rssi'),
+            max_rssi=Max('rssi'),
+            avg_snr=Avg('snr'),
+            last_seen=Max('timestamp'),
+        )
+        .order_by('-receptions', 'gateway_id')
+    )
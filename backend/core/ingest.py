@@ -0,0 +1,303 @@
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models.constants import OnConflict
+
+from . import analytics, metrics
+from .exceptions import SensorException
+from .models import GatewayReception, SensorReading
+from .registry import registry
+from .sensor import check_uplink, gateway_receptions, notify_users, parse_time
+from .signals import readings_stored
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class IngestResult:
+    def __init__(self):
+        self.stored = 0
+        self.duplicates = 0
+        self.unregistered = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, index, error):
+        self.rejected += 1
+        self.errors.append({'index': index, 'error': error})
+
+
+def store_uplinks(uplinks, notify=True):
+    """
+    Store a batch of uplinks with a single insert.
+
+    Unlike ``process_message`` a bad record never aborts the batch: it is
+    counted as rejected (with its position in ``uplinks``) and skipped.
+    With ``notify=False`` (replays of historic uplinks) the readings are not
+    checked against the alert thresholds.
+    """
+    with metrics.INGEST_BATCH_SECONDS.time(), metrics.db_time('store_uplinks'):
+        result = _store_uplinks(uplinks, notify)
+    metrics.UPLINKS_STORED.inc(result.stored)
+    metrics.UPLINKS_DUPLICATE.inc(result.duplicates)
+    metrics.UPLINKS_UNREGISTERED.inc(result.unregistered)
+    metrics.UPLINKS_REJECTED.inc(result.rejected)
+    return result
+
+
+def _store_uplinks(uplinks, notify=True):
+    result = IngestResult()
+    pending = {}
+    for index, uplink in enumerate(uplinks):
+        try:
+            check_uplink(uplink)
+            if uplink.hexdata == "":
+                raise SensorException('Empty hexdata.')
+            try:
+                value = int(uplink.hexdata)
+            except (TypeError, ValueError):
+                raise SensorException(f'Invalid hexdata: {uplink.hexdata!r}')
+            timestamp = parse_time(uplink.time)
+        except SensorException as exc:
+            result.reject(index, str(exc))
+            continue
+        if uplink.deduplicationId in pending:
+            result.duplicates += 1
+            continue
+        pending[uplink.deduplicationId] = (index, uplink, value, timestamp)
+    if not pending:
+        return result
+
+    devices = registry.get_devices(uplink.devEui for _, uplink, _, _ in pending.values())
+    existing = set(
+        SensorReading.objects.filter(deduplicationId__in=list(pending))
+        .values_list('deduplicationId', flat=True)
+    )
+    readings = []
+    receptions = []
+    for deduplicationId, (index, uplink, value, timestamp) in pending.items():
+        device = devices.get(uplink.devEui)
+        if device is None:
+            logger.info('Device not registered: %s', uplink.devEui)
+            result.unregistered += 1
+            result.reject(index, f'Device not registered: {uplink.devEui}')
+            continue
+        if deduplicationId in existing:
+            result.duplicates += 1
+            continue
+        readings.append(SensorReading(
+            device=device,
+            value=value,
+            rssi=uplink.rssi,
+            timestamp=timestamp,
+            deduplicationId=deduplicationId,
+        ))
+        receptions.append(gateway_receptions(device, timestamp, uplink))
+    result.errors.sort(key=lambda error: error['index'])
+    stats = analytics.flag_readings(readings)
+    with transaction.atomic():
+        inserted = insert_new_readings(readings)
+        if len(inserted) < len(readings):
+            # Another worker stored these since the lookup above.
+            inserted_ids = {reading.deduplicationId for reading in inserted}
+            result.duplicates += len(readings) - len(inserted)
+            receptions = [
+                reception for reading, reading_receptions in zip(readings, receptions)
+                if reading.deduplicationId in inserted_ids
+                for reception in reading_receptions
+            ]
+            readings = inserted
+        else:
+            receptions = [reception for reading_receptions in receptions for reception in reading_receptions]
+        GatewayReception.objects.bulk_create(receptions, batch_size=1000)
+        if readings:
+            readings_stored.send(sender=SensorReading, readings=readings)
+    analytics.save(stats, readings)
+    result.stored = len(readings)
+    if notify:
+        for reading in sorted(readings, key=lambda reading: reading.timestamp):
+            notify_users(reading.device, reading.value, reading.timestamp)
+    return result
+
+
+def insert_new_readings(readings):
+    """
+    Insert ``readings``, skipping deduplicationIds that are already stored
+    (e.g. by another worker since they were looked up), and return the ones
+    inserted, with their pks set.
+    """
+    if not readings:
+        return []
+    if not connection.features.can_return_rows_from_bulk_insert:
+        SensorReading.objects.bulk_create(readings, ignore_conflicts=True)
+        return readings
+    opts = SensorReading._meta
+    fields = [field for field in opts.concrete_fields if not field.primary_key]
+    returning_fields = [opts.pk, opts.get_field('deduplicationId')]
+    by_id = {reading.deduplicationId: reading for reading in readings}
+    batch_size = connection.ops.bulk_batch_size(fields, readings)
+    inserted = []
+    for start in range(0, len(readings), batch_size):
+        # INSERT ... ON CONFLICT DO NOTHING RETURNING only returns the rows
+        # it inserted, which bulk_create(ignore_conflicts=True) cannot tell.
+        rows = SensorReading.objects._insert(
+            readings[start:start + batch_size], fields=fields,
+            returning_fields=returning_fields, on_conflict=OnConflict.IGNORE,
+        )
+        for row in rows:
+            if row is None:  # a single-row insert that conflicted
+                continue
+            reading = by_id[row[1]]
+            reading.pk = row[0]
+            reading._state.adding = False
+            reading._state.db = connection.alias
+            inserted.append(reading)
+    return inserted
+
+
+def retry_delays():
+    """Seconds to wait before each retry of a batch that failed to store."""
+    delay = settings.INGEST_RETRY_DELAY
+    for _ in range(settings.INGEST_MAX_RETRIES):
+        yield min(delay, settings.INGEST_MAX_RETRY_DELAY)
+        delay *= 2
+
+
+class IngestBuffer:
+    """
+    Collects uplinks from the MQTT network thread and stores them from a
+    worker thread in batches bounded by size and time.
+
+    When the queue is full (the database is slow or down) ``put`` blocks
+    paho's network thread, which holds the broker back but also stops the
+    MQTT keepalive. So it only waits INGEST_PUT_TIMEOUT seconds and then
+    drops the uplink, counted in the 'dropped' stat and metric, rather than
+    have the broker disconnect the client and lose messages unseen.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, max_queue_size=None, put_timeout=None):
+        self.batch_size = batch_size or settings.INGEST_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.INGEST_FLUSH_INTERVAL
+        self.queue = queue.Queue(maxsize=max_queue_size or settings.INGEST_QUEUE_SIZE)
+        self.put_timeout = settings.INGEST_PUT_TIMEOUT if put_timeout is None else put_timeout
+        self.stats = {
+            'received': 0,
+            'dropped': 0,
+            'stored': 0,
+            'duplicates': 0,
+            'unregistered': 0,
+            'rejected': 0,
+            'batches': 0,
+            'retries': 0,
+            'failed_batches': 0,
+        }
+        self.started_at = time.monotonic()
+        self._stopping = threading.Event()
+        self._dropping = False
+        self._thread = None
+
+    def put(self, uplink):
+        # Waits while the queue is full so a stalled or failing database
+        # (whose batches are retried, see _store) slows the consumer down
+        # instead of growing memory without bound.
+        try:
+            self.queue.put(uplink, timeout=self.put_timeout or None)
+        except queue.Full:
+            self.stats['dropped'] += 1
+            metrics.UPLINKS_DROPPED.inc()
+            if not self._dropping:
+                logger.error('Ingest queue full for %.1fs, dropping uplinks', self.put_timeout)
+                self._dropping = True
+            return
+        self._dropping = False
+        self.stats['received'] += 1
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started_at
+        return dict(
+            self.stats,
+            queue_depth=self.queue_depth,
+            stored_per_second=round(self.stats['stored'] / elapsed, 2) if elapsed else 0.0,
+        )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ingest-buffer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def flush(self):
+        """Store everything currently queued. Returns the number of uplinks taken."""
+        batch = self._take(self.batch_size, block=False)
+        taken = 0
+        while batch:
+            self._store(batch)
+            taken += len(batch)
+            batch = self._take(self.batch_size, block=False)
+        return taken
+
+    def _take(self, limit, block=True):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < limit:
+            try:
+                if block:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _store(self, batch, retry=False):
+        # Only the worker thread retries, recycling its connection before
+        # each attempt; flush() can run inside a caller's transaction.
+        delays = retry_delays() if retry else iter(())
+        while True:
+            if retry:
+                close_old_connections()
+            try:
+                result = store_uplinks(batch)
+                break
+            except Exception:
+                delay = next(delays, None)
+                if delay is None or self._stopping.is_set():
+                    logger.exception('Failed to store batch of %d uplinks', len(batch))
+                    self.stats['failed_batches'] += 1
+                    return
+                logger.exception('Failed to store batch of %d uplinks, retrying in %.1fs', len(batch), delay)
+                self.stats['retries'] += 1
+                self._stopping.wait(delay)
+        self.stats['batches'] += 1
+        self.stats['stored'] += result.stored
+        self.stats['duplicates'] += result.duplicates
+        self.stats['unregistered'] += result.unregistered
+        self.stats['rejected'] += result.rejected
+        for error in result.errors:
+            logger.warning('Rejected uplink: %s', error['error'])
+        logger.debug('Stored batch: %s', self.snapshot())
+
+    def _run(self):
+        last_report = time.monotonic()
+        while not self._stopping.is_set():
+            batch = self._take(self.batch_size)
+            if batch:
+                self._store(batch, retry=True)
+            if time.monotonic() - last_report >= settings.INGEST_STATS_INTERVAL:
+                logger.info('Ingest stats: %s', self.snapshot())
+                last_report = time.monotonic()
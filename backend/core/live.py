@@ -0,0 +1,215 @@
+"""
+Pushes newly stored readings to the dashboards that have a device open,
+over Server-Sent Events (see ``views.reading_stream``).
+
+Streams subscribe to the ``hub`` of the web process serving them. Readings
+reach the hub in one of two ways:
+
+* On PostgreSQL (unless LIVE_READINGS_NOTIFY is off), every process storing
+  readings, including the MQTT client, sends them with ``pg_notify`` as part
+  of its transaction, and each web process with open streams LISTENs on the
+  channel and publishes what it receives to its hub.
+* Otherwise readings are published to the hub of the process that stored
+  them once the transaction commits, so only streams served by that same
+  process see them.
+
+Delivery is best effort: a stream that falls LIVE_READINGS_QUEUE_SIZE
+readings behind loses the oldest ones, and clients are expected to refetch
+history after reconnecting.
+"""
+import asyncio
+import json
+import select
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections, transaction
+from django.dispatch import receiver
+
+from .rollups import as_datetime
+from .signals import readings_stored
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+CHANNEL = 'radon_readings'
+# NOTIFY payloads must stay below 8000 bytes.
+NOTIFY_BATCH = 50
+
+
+def reading_event(reading):
+    return {
+        'device': reading.device_id,
+        'value': float(reading.value),
+        'rssi': float(reading.rssi),
+        'timestamp': as_datetime(reading.timestamp).isoformat(),
+    }
+
+
+class Subscription:
+    def __init__(self, device_id, loop, maxsize):
+        self.device_id = device_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, event):
+        # Runs on the subscriber's event loop.
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class Hub:
+    """Fans events out to the streams subscribed in this process, from any thread."""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, device_id):
+        """Subscribe to a device's events. Call from the event loop that will read them."""
+        subscription = Subscription(device_id, asyncio.get_running_loop(), settings.LIVE_READINGS_QUEUE_SIZE)
+        with self._lock:
+            self._subscriptions.setdefault(device_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.device_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.device_id, None)
+
+    def publish(self, events):
+        with self._lock:
+            targets = [
+                (subscription, event)
+                for event in events
+                for subscription in self._subscriptions.get(event['device'], ())
+            ]
+        for subscription, event in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The loop closed under a stream that did not unsubscribe.
+                self.unsubscribe(subscription)
+
+
+hub = Hub()
+
+
+class EventStream:
+    """
+    Body of a Server-Sent Events response with a subscription's events,
+    passed through ``render``. Django calls close() when the response ends,
+    including when the client disconnects.
+    """
+
+    def __init__(self, hub, subscription, render):
+        self.hub = hub
+        self.subscription = subscription
+        self.render = render
+
+    async def __aiter__(self):
+        yield f'retry: {settings.LIVE_READINGS_RETRY * 1000}\n\n'
+        while True:
+            try:
+                event = await self.subscription.get(settings.LIVE_READINGS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle connection.
+                yield ': keep-alive\n\n'
+                continue
+            yield f'event: reading\ndata: {json.dumps(self.render(event))}\n\n'
+
+    def close(self):
+        self.hub.unsubscribe(self.subscription)
+
+
+def notify_enabled():
+    return settings.LIVE_READINGS_NOTIFY and connection.vendor == 'postgresql'
+
+
+@receiver(readings_stored)
+def publish_readings(sender, readings, **kwargs):
+    events = [reading_event(reading) for reading in readings]
+    if not notify_enabled():
+        transaction.on_commit(lambda: hub.publish(events))
+        return
+    payloads = [
+        json.dumps(events[offset:offset + NOTIFY_BATCH], cls=DjangoJSONEncoder)
+        for offset in range(0, len(events), NOTIFY_BATCH)
+    ]
+    # Delivered to listeners when the surrounding transaction commits.
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload', [CHANNEL, payloads])
+
+
+class Listener:
+    """LISTENs for readings stored by other processes and publishes them to the hub."""
+
+    def __init__(self, hub, reconnect_delay=5.0, poll_interval=5.0):
+        self.hub = hub
+        self.reconnect_delay = reconnect_delay
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='live-readings', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception('Listening for readings failed, reconnecting in %ss', self.reconnect_delay)
+                self._stopping.wait(self.reconnect_delay)
+
+    def _listen(self):
+        # A connection of its own: the thread outlives any request.
+        wrapper = connections.create_connection('default')
+        try:
+            wrapper.ensure_connection()
+            wrapper.set_autocommit(True)
+            raw = wrapper.connection
+            with raw.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            logger.info('Listening for readings on %s', CHANNEL)
+            while not self._stopping.is_set():
+                if select.select([raw], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                raw.poll()
+                events = []
+                while raw.notifies:
+                    events.extend(json.loads(raw.notifies.pop(0).payload))
+                if events:
+                    self.hub.publish(events)
+        finally:
+            wrapper.close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def ensure_listener():
+    """Start this process's listener the first time a stream opens, when NOTIFY is in use."""
+    global _listener
+    if _listener is not None or not notify_enabled():
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = Listener(hub)
+            _listener.start()
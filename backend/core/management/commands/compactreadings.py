@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from core import retention
+
+
+class Command(BaseCommand):
+    help = "Deletes readings and rollups past their retention tier, rolling raw readings up first"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help='Rows deleted per transaction (default: RETENTION_BATCH_SIZE).')
+        parser.add_argument('--pause', type=float,
+                            help='Seconds to wait between batches (default: RETENTION_BATCH_PAUSE).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be rebuilt and deleted.')
+
+    def handle(self, *args, **options):
+        verb = 'would delete' if options['dry_run'] else 'deleted'
+
+        def log(device, result):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{device.serial_number}: {result}')
+
+        totals = retention.compact(
+            batch_size=options['batch_size'], pause=options['pause'], dry_run=options['dry_run'], log=log,
+        )
+        self.stdout.write(
+            f"rollup days rebuilt: {totals['rebuilt_days']}, {verb}: {totals['readings']} readings, "
+            f"{totals['receptions']} receptions, {totals['hourly']} hourly and {totals['daily']} daily rollups"
+        )
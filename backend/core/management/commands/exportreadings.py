@@ -0,0 +1,42 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from core import export
+from core.models import Device, SensorReading
+
+
+class Command(BaseCommand):
+    help = "Exports the readings of every device (or the given ones) to one file per device"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir', help='Directory the export files are written to.')
+        parser.add_argument('--format', dest='export_format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument('--device', action='append', dest='devices', metavar='SERIAL_NUMBER',
+                            help='Only export this device; can be repeated.')
+        parser.add_argument('--since', help='Only export readings at or after this ISO 8601 timestamp.')
+        parser.add_argument('--until', help='Only export readings before this ISO 8601 timestamp.')
+
+    def handle(self, *args, **options):
+        export_format = options['export_format']
+        if export_format == 'parquet' and not export.parquet_available():
+            raise CommandError('Parquet export requires the pyarrow package.')
+        output_dir = Path(options['output_dir'])
+        output_dir.mkdir(parents=True, exist_ok=True)
+        readings = SensorReading.objects.all()
+        for option, lookup in (('since', 'timestamp__gte'), ('until', 'timestamp__lt')):
+            if options[option]:
+                timestamp = parse_datetime(options[option])
+                if timestamp is None:
+                    raise CommandError(f'Invalid --{option} timestamp: {options[option]}')
+                readings = readings.filter(**{lookup: timestamp})
+        devices = Device.objects.order_by('serial_number')
+        if options['devices']:
+            devices = devices.filter(serial_number__in=options['devices'])
+        for device in devices.iterator():
+            path = output_dir / f'{device.serial_number}.{export_format}'
+            with open(path, 'wb') as f:
+                for chunk in export.export_readings(readings.filter(device=device), export_format):
+                    f.write(chunk)
+            self.stdout.write(f'Wrote {path}')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from core import silence
+
+
+class Command(BaseCommand):
+    help = "Mails the users of devices that stopped sending readings, and of those that came back"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=int,
+                            help='Seconds without a reading before a device is silent '
+                                 '(default: SENSOR_SILENCE_TIMEOUT).')
+        parser.add_argument('--batch-size', type=int,
+                            help='Devices handled per transaction (default: SILENCE_BATCH_SIZE).')
+
+    def handle(self, *args, **options):
+        silent, returned = silence.notify(timeout=options['timeout'], batch_size=options['batch_size'])
+        self.stdout.write(f'{silent} devices went silent, {returned} came back')
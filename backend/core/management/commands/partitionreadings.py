@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core import partitions
+
+
+class Command(BaseCommand):
+    help = "Maintains monthly partitions of the sensor readings table (PostgreSQL only)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true',
+                            help='Rebuild the readings table as a partitioned table (locks it while copying).')
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help='Number of future monthly partitions to keep created.')
+        parser.add_argument('--detach-older-than', type=int, metavar='MONTHS',
+                            help='Detach partitions whose readings are all older than this many months.')
+        parser.add_argument('--drop', action='store_true',
+                            help='Drop detached partitions instead of keeping them as standalone tables.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning is only supported on PostgreSQL.')
+        today = timezone.now().date()
+        with transaction.atomic():
+            if options['convert']:
+                if partitions.is_partitioned(connection):
+                    raise CommandError('The readings table is already partitioned.')
+                partitions.convert_to_partitioned(connection, options['months_ahead'])
+                self.stdout.write('Converted readings table to monthly partitions.')
+            elif not partitions.is_partitioned(connection):
+                raise CommandError('The readings table is not partitioned; run with --convert first.')
+            for name in partitions.create_partitions(connection, today, options['months_ahead'] + 1):
+                self.stdout.write(f'Created partition {name}')
+            if options['detach_older_than'] is not None:
+                before = partitions.add_months(partitions.month_start(today), -options['detach_older_than'])
+                for name in partitions.detach_partitions(connection, before, drop=options['drop']):
+                    self.stdout.write(f"{'Dropped' if options['drop'] else 'Detached'} partition {name}")
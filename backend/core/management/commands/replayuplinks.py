@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from core.archive import list_segments, read_segment
+from core.decoders import get_decoder
+from core.exceptions import SensorException
+from core.ingest import store_uplinks
+
+
+class Command(BaseCommand):
+    help = "Re-ingests archived raw uplinks through the batched ingest path"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='Archive directories or segment files (default: UPLINK_ARCHIVE_DIR).')
+        parser.add_argument('--since', help='Only uplinks received at or after this ISO 8601 time.')
+        parser.add_argument('--until', help='Only uplinks received before this ISO 8601 time.')
+        parser.add_argument('--batch-size', type=int, default=settings.INGEST_BATCH_SIZE)
+
+    def parse_time(self, value):
+        if value is None:
+            return None
+        moment = parse_datetime(value)
+        if moment is None or moment.tzinfo is None:
+            raise CommandError(f'Expected an ISO 8601 time with a UTC offset, got {value!r}.')
+        return moment.timestamp()
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ([settings.UPLINK_ARCHIVE_DIR] if settings.UPLINK_ARCHIVE_DIR else [])
+        if not paths:
+            raise CommandError('No archive given and UPLINK_ARCHIVE_DIR is not set.')
+        since = self.parse_time(options['since'])
+        until = self.parse_time(options['until'])
+        decode = get_decoder()
+        totals = {'read': 0, 'undecodable': 0, 'stored': 0, 'duplicates': 0, 'unregistered': 0, 'rejected': 0}
+        batch = []
+
+        def store():
+            # Historic readings: alerting on them would mail stale news.
+            result = store_uplinks(batch, notify=False)
+            for key in ('stored', 'duplicates', 'unregistered', 'rejected'):
+                totals[key] += getattr(result, key)
+            batch.clear()
+
+        for path in paths:
+            for segment in list_segments(path):
+                for received_at, payload in read_segment(segment, since=since, until=until):
+                    totals['read'] += 1
+                    try:
+                        batch.append(decode(payload))
+                    except SensorException:
+                        totals['undecodable'] += 1
+                        continue
+                    if len(batch) >= options['batch_size']:
+                        store()
+        if batch:
+            store()
+        self.stdout.write(', '.join(f'{key}: {value}' for key, value in totals.items()))
@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.retention import cutoff
+from core.rollups import rebuild_last_readings, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuilds hourly and daily reading rollups and last readings from the raw readings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2,
+                            help='Rebuild buckets covering this many past days.')
+        parser.add_argument('--all', action='store_true',
+                            help='Rebuild every bucket that still has raw readings, e.g. to backfill existing readings.')
+
+    def handle(self, *args, **options):
+        since = None if options['all'] else timezone.now() - timedelta(days=options['days'])
+        # Older rollups are all that is left of readings compactreadings has
+        # deleted; rebuilding them from the raw readings would empty them.
+        oldest = cutoff(settings.READING_RETENTION_DAYS)
+        if oldest is not None and (since is None or since < oldest):
+            self.stdout.write(f'Rebuilding from {oldest:%Y-%m-%d}, the oldest day of raw readings kept')
+            since = oldest
+        for model, count in rebuild_rollups(since=since).items():
+            self.stdout.write(f'{model}: {count} buckets')
+        self.stdout.write(f'Device: {rebuild_last_readings()} last readings')
@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from core.benchmarks import suite
+
+
+class Command(BaseCommand):
+    help = "Runs the ingest and dashboard benchmarks against a throwaway test database and writes JSON results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--benchmark', action='append', choices=suite.BENCHMARKS, dest='benchmarks',
+                            help='Benchmark to run; repeat for several (default: all).')
+        parser.add_argument('--events', type=int, default=2000, help='Uplinks per ingest benchmark.')
+        parser.add_argument('--devices', type=int, default=50, help='Devices the uplinks are spread over.')
+        parser.add_argument('--duplicate-rate', type=float, default=0.05,
+                            help='Fraction of uplinks that are redeliveries of earlier ones.')
+        parser.add_argument('--crossing-rate', type=float, default=0.05,
+                            help='Fraction of readings above the warning threshold.')
+        parser.add_argument('--dashboard-rows', type=int, nargs='+', default=[10000, 100000],
+                            help='Readings per device for the dashboard benchmark, e.g. 10000 1000000 100000000.')
+        parser.add_argument('--dashboard-repeat', type=int, default=20, help='Dashboard requests per data volume.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON results here instead of to stdout.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database between runs.')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            report = suite.run(
+                benchmarks=options['benchmarks'] or suite.BENCHMARKS,
+                events=options['events'],
+                devices=options['devices'],
+                duplicate_rate=options['duplicate_rate'],
+                crossing_rate=options['crossing_rate'],
+                dashboard_rows=options['dashboard_rows'],
+                dashboard_repeat=options['dashboard_repeat'],
+                seed=options['seed'],
+                log=self.stderr.write,
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.outbox import deliver_queued_emails
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Delivers queued notification e-mails, polling the outbox until stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the outbox once and exit.')
+        parser.add_argument('--interval', type=float, default=settings.EMAIL_OUTBOX_POLL_INTERVAL,
+                            help='Seconds to wait when the outbox is empty.')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            try:
+                sent, failed = deliver_queued_emails()
+            except Exception:
+                logger.exception('E-mail delivery failed')
+                sent = failed = 0
+            if sent or failed:
+                logger.info('Delivered %d e-mails, %d failed', sent, failed)
+            if options['once'] and not (sent or failed):
+                return
+            if not (sent or failed):
+                time.sleep(options['interval'])
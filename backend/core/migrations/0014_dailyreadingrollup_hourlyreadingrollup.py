@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_sensorreading_core_reading_device_ts_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyReadingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('total', models.FloatField()),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('last_value', models.FloatField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.device')),
+            ],
+            options={
+                'abstract': False,
+                'constraints': [models.UniqueConstraint(fields=('device', 'bucket'), name='dailyreadingrollup_device_bucket_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlyReadingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('count', models.PositiveIntegerField()),
+                ('total', models.FloatField()),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('last_value', models.FloatField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.device')),
+            ],
+            options={
+                'abstract': False,
+                'constraints': [models.UniqueConstraint(fields=('device', 'bucket'), name='hourlyreadingrollup_device_bucket_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GatewayReception',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField()),
+                ('gateway_id', models.CharField(max_length=32)),
+                ('rssi', models.FloatField()),
+                ('snr', models.FloatField(null=True)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.device')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['gateway_id', 'timestamp'], name='core_reception_gateway_ts_idx'), models.Index(fields=['device', 'timestamp'], name='core_reception_device_ts_idx')],
+            },
+        ),
+    ]
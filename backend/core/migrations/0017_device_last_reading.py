@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:51
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_last_readings(apps, schema_editor):
+    Device = apps.get_model('core', 'Device')
+    SensorReading = apps.get_model('core', 'SensorReading')
+    latest = SensorReading.objects.filter(device=OuterRef('pk')).order_by('-timestamp')
+    Device.objects.update(
+        last_value=Subquery(latest.values('value')[:1]),
+        last_rssi=Subquery(latest.values('rssi')[:1]),
+        last_seen=Subquery(latest.values('timestamp')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_gatewayreception'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='last_rssi',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_value',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_last_readings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_device_last_reading'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensorreading',
+            name='flags',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_sensorreading_flags'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='silence_notified_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(condition=models.Q(('silence_notified_at__isnull', True)), fields=['last_seen'], name='core_device_silent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(condition=models.Q(('silence_notified_at__isnull', False)), fields=['last_seen'], name='core_device_silenced_idx'),
+        ),
+    ]
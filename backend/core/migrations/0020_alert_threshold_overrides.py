@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_device_silence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='alert_threshold',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='warning_threshold',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='alert_threshold',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='warning_threshold',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
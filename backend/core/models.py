@@ -1,8 +1,11 @@
 from django.contrib.auth import get_user_model
 from django.db import models
+from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from .signals import readings_stored
+
 User = get_user_model()
 
 class TimeStampedModel(models.Model):
@@ -17,6 +20,9 @@ class UserProfile(TimeStampedModel):
     address = models.CharField(max_length=255, blank=True)
     phone = models.CharField(max_length=32, blank=True)
     alert_email_enabled = models.BooleanField(default=True)
+    # The user's own limits, overriding the device's and the global ones.
+    warning_threshold = models.PositiveIntegerField(null=True, blank=True)
+    alert_threshold = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return f"Profile of {self.user.username}"
@@ -31,6 +37,27 @@ class Device(TimeStampedModel):
     # alphanumeric EUI-64
     serial_number = models.CharField(max_length=64, unique=True)
     users = models.ManyToManyField(User, related_name='devices', blank=True)
+    # Limits for this device (e.g. its building type), overriding
+    # SENSOR_WARNING_THRESHOLD and SENSOR_ALERT_THRESHOLD.
+    warning_threshold = models.PositiveIntegerField(null=True, blank=True)
+    alert_threshold = models.PositiveIntegerField(null=True, blank=True)
+    # The newest reading, kept up to date at ingest so device lists need not
+    # look at the readings table (see rollups.update_last_readings).
+    last_value = models.FloatField(null=True, blank=True, editable=False)
+    last_rssi = models.FloatField(null=True, blank=True, editable=False)
+    last_seen = models.DateTimeField(null=True, blank=True, editable=False)
+    # When the users were told the device went silent (see silence.py).
+    silence_notified_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # The devices that went silent are a range scan of the first;
+            # the silent ones that are back are found among the second.
+            models.Index(fields=['last_seen'], name='core_device_silent_idx',
+                         condition=models.Q(silence_notified_at__isnull=True)),
+            models.Index(fields=['last_seen'], name='core_device_silenced_idx',
+                         condition=models.Q(silence_notified_at__isnull=False)),
+        ]
 
     def __str__(self):
         return f"{self.serial_number}"
@@ -41,6 +68,95 @@ class SensorReading(TimeStampedModel):
     rssi = models.FloatField()
     timestamp = models.DateTimeField()
     deduplicationId = models.CharField(max_length=64, unique=True)
+    # Bitmask of the health checks in analytics.py the reading failed.
+    flags = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Dashboard queries filter on device and a timestamp range and
+            # usually want the newest reading first.
+            models.Index(fields=['device', '-timestamp'], name='core_reading_device_ts_idx'),
+        ]
 
     def __str__(self):
         return f"{self.device.serial_number} @ {self.timestamp}: {self.value} ({self.rssi})"
+
+@receiver(post_save, sender=SensorReading)
+def sensor_reading_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        readings_stored.send(sender=SensorReading, readings=[instance])
+
+
+class ReadingRollup(models.Model):
+    """Running aggregate of one device's readings over a time bucket."""
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='+')
+    bucket = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    total = models.FloatField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+    last_value = models.FloatField()
+    last_timestamp = models.DateTimeField()
+
+    class Meta:
+        abstract = True
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'bucket'], name='%(class)s_device_bucket_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.device_id} @ {self.bucket}: {self.count} readings"
+
+
+class GatewayReception(models.Model):
+    """One gateway's reception of a device uplink, for coverage statistics."""
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='+')
+    timestamp = models.DateTimeField()
+    gateway_id = models.CharField(max_length=32)
+    rssi = models.FloatField()
+    snr = models.FloatField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['gateway_id', 'timestamp'], name='core_reception_gateway_ts_idx'),
+            models.Index(fields=['device', 'timestamp'], name='core_reception_device_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.gateway_id} <- {self.device_id} @ {self.timestamp}: {self.rssi} ({self.snr})"
+
+
+class HourlyReadingRollup(ReadingRollup):
+    class Meta(ReadingRollup.Meta):
+        pass
+
+
+class DailyReadingRollup(ReadingRollup):
+    class Meta(ReadingRollup.Meta):
+        pass
+
+
+class OutgoingEmail(TimeStampedModel):
+    """An e-mail waiting in the outbox for the delivery worker."""
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    from_email = models.CharField(max_length=255)
+    recipient = models.EmailField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='core_outgoingemail_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.recipient} ({self.status})"
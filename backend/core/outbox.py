@@ -0,0 +1,119 @@
+"""
+Durable outbox for notification e-mails.
+
+The ingest path only inserts OutgoingEmail rows; ``manage.py
+sendqueuedemails`` delivers them in batches over a single SMTP connection
+and retries failures with exponential backoff.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import OutgoingEmail
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def queue_email(subject, message, recipients, from_email=None):
+    queue_emails([(subject, message, recipients)], from_email)
+
+
+def queue_emails(emails, from_email=None):
+    """Queue several ``(subject, message, recipients)`` e-mails in one insert."""
+    emails = OutgoingEmail.objects.bulk_create(
+        OutgoingEmail(
+            subject=subject,
+            message=message,
+            from_email=from_email or settings.NOTIFICATIONS_FROM_EMAIL,
+            recipient=recipient,
+        )
+        for subject, message, recipients in emails
+        for recipient in recipients
+    )
+    metrics.EMAILS_QUEUED.inc(len(emails))
+
+
+def retry_delay(attempts):
+    delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.EMAIL_OUTBOX_MAX_RETRY_DELAY))
+
+
+def _claim(batch_size, now):
+    # Push the claimed rows' next attempt out so a concurrent worker (or
+    # this one, should it crash mid-batch) leaves them alone for a while.
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutgoingEmail.PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            next_attempt_at=now + timedelta(seconds=settings.EMAIL_OUTBOX_CLAIM_TIMEOUT),
+        )
+    return emails
+
+
+def _record_failure(email, exc):
+    email.last_error = str(exc)
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        logger.error('Giving up on e-mail %s to %s: %s', email.pk, email.recipient, exc)
+        email.status = OutgoingEmail.FAILED
+    else:
+        logger.warning('Failed to send e-mail %s to %s: %s', email.pk, email.recipient, exc)
+        email.next_attempt_at = timezone.now() + retry_delay(email.attempts)
+
+
+def _save(email):
+    email.save(update_fields=['attempts', 'status', 'next_attempt_at', 'sent_at', 'last_error', 'date_updated'])
+
+
+def deliver_queued_emails(batch_size=None):
+    """Send due e-mails from the outbox. Returns the number sent and failed."""
+    now = timezone.now()
+    emails = _claim(batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE, now)
+    if not emails:
+        return 0, 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as exc:
+        # Counts as an attempt for every claimed e-mail, so an unreachable
+        # SMTP server backs off and eventually gives up like a refusal.
+        for email in emails:
+            email.attempts += 1
+            _record_failure(email, exc)
+            _save(email)
+        metrics.EMAILS_FAILED.inc(len(emails))
+        return 0, len(emails)
+    sent = failed = 0
+    try:
+        for email in emails:
+            message = EmailMessage(
+                subject=email.subject,
+                body=email.message,
+                from_email=email.from_email,
+                to=[email.recipient],
+                connection=connection,
+            )
+            email.attempts += 1
+            try:
+                connection.send_messages([message])
+            except Exception as exc:
+                failed += 1
+                _record_failure(email, exc)
+            else:
+                sent += 1
+                email.status = OutgoingEmail.SENT
+                email.sent_at = timezone.now()
+            _save(email)
+    finally:
+        connection.close()
+    metrics.EMAILS_SENT.inc(sent)
+    metrics.EMAILS_FAILED.inc(failed)
+    return sent, failed
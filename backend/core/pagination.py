@@ -0,0 +1,18 @@
+import base64
+from datetime import datetime
+
+
+def encode_cursor(timestamp, pk):
+    """Opaque keyset cursor for the row sorting right before the next page."""
+    raw = f'{timestamp.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Raises ValueError for a malformed cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (TypeError, ValueError) as exc:
+        raise ValueError('Invalid cursor.') from exc
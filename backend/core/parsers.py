@@ -0,0 +1,15 @@
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Newline-delimited JSON. The body is not read up front: the parsed data
+    is a generator over the non-blank lines so large uploads can be
+    processed while they stream in. Each line is decoded by the view.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return iter(())
+        return (line for line in (raw.strip() for raw in stream) if line)
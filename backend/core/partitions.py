@@ -0,0 +1,186 @@
+"""
+Monthly range partitioning of the SensorReading table (PostgreSQL only).
+
+Partitioning is opt-in: ``manage.py partitionreadings --convert`` rebuilds
+the table as ``PARTITION BY RANGE ("timestamp")`` and the same command is
+then run periodically to create upcoming partitions and detach old ones.
+Readings outside every monthly partition (e.g. the job lapsed, or a device
+sent a bogus time) land in the ``_default`` partition; creating their month
+later moves them into the new partition.
+
+PostgreSQL requires unique constraints on a partitioned table to include the
+partition key, so the primary key becomes (id, timestamp) and uniqueness of
+``deduplicationId`` is enforced together with ``timestamp``. ChirpStack
+assigns the deduplication id to a single uplink with a single time, so this
+does not let duplicates through.
+"""
+import re
+from datetime import date, datetime, timezone
+
+from django.db import transaction
+
+from .models import SensorReading
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+PARTITION_NAME_RE = re.compile(r'_p(\d{4})_(\d{2})$')
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(start):
+    return f'{SensorReading._meta.db_table}_p{start.year:04d}_{start.month:02d}'
+
+
+def partition_start(name):
+    match = PARTITION_NAME_RE.search(name)
+    if not match:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def _bound(day):
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).isoformat()
+
+
+def is_partitioned(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass',
+            [SensorReading._meta.db_table],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions(connection):
+    """Names of the monthly partitions currently attached, oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = %s::regclass',
+            [SensorReading._meta.db_table],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    return sorted(name for name in names if partition_start(name))
+
+
+def default_partition_name():
+    return f'{SensorReading._meta.db_table}_default'
+
+
+def has_default_partition(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [connection.ops.quote_name(default_partition_name())])
+        return cursor.fetchone()[0]
+
+
+def create_partitions(connection, first_month, months):
+    """Create monthly partitions from ``first_month`` on. Returns the names created."""
+    quote = connection.ops.quote_name
+    table = quote(SensorReading._meta.db_table)
+    default = quote(default_partition_name())
+    moved_table = quote(f'{SensorReading._meta.db_table}_moved')
+    existing = set(list_partitions(connection))
+    use_default = has_default_partition(connection)
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for offset in range(months):
+            start = add_months(month_start(first_month), offset)
+            name = partition_name(start)
+            if name in existing:
+                continue
+            bounds = [_bound(start), _bound(add_months(start, 1))]
+            if use_default:
+                # PostgreSQL refuses to create a partition while the default
+                # partition holds rows for its range: set them aside first.
+                cursor.execute(f'CREATE TEMPORARY TABLE {moved_table} (LIKE {table}) ON COMMIT DROP')
+                cursor.execute(
+                    f'WITH moved AS (DELETE FROM {default} WHERE "timestamp" >= %s AND "timestamp" < %s '
+                    f'RETURNING *) INSERT INTO {moved_table} SELECT * FROM moved',
+                    bounds,
+                )
+                moved = cursor.rowcount
+            cursor.execute(
+                f'CREATE TABLE {quote(name)} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)',
+                bounds,
+            )
+            if use_default:
+                cursor.execute(f'INSERT INTO {table} SELECT * FROM {moved_table}')
+                cursor.execute(f'DROP TABLE {moved_table}')
+                if moved:
+                    logger.info('Moved %d readings from the default partition into %s', moved, name)
+            created.append(name)
+    return created
+
+
+def detach_partitions(connection, before, drop=False):
+    """Detach (and optionally drop) partitions holding only readings older than ``before``."""
+    table = connection.ops.quote_name(SensorReading._meta.db_table)
+    detached = []
+    with connection.cursor() as cursor:
+        for name in list_partitions(connection):
+            if add_months(partition_start(name), 1) > month_start(before):
+                continue
+            cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {connection.ops.quote_name(name)}')
+            if drop:
+                cursor.execute(f'DROP TABLE {connection.ops.quote_name(name)}')
+            detached.append(name)
+    return detached
+
+
+def convert_to_partitioned(connection, months_ahead):
+    """
+    Rebuild the readings table as a partitioned table, copying every row.
+
+    This rewrites the whole table inside one transaction and holds an
+    exclusive lock while doing so: run it in a maintenance window.
+    """
+    quote = connection.ops.quote_name
+    db_table = SensorReading._meta.db_table
+    old_table = f'{db_table}_unpartitioned'
+    sequence = f'{db_table}_id_seq'
+    device_table = SensorReading._meta.get_field('device').related_model._meta.db_table
+    with connection.cursor() as cursor:
+        # Deferred foreign key checks queued earlier in this transaction
+        # would otherwise block dropping the old table.
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f'ALTER TABLE {quote(db_table)} RENAME TO {quote(old_table)}')
+        cursor.execute(
+            f'CREATE TABLE {quote(db_table)} (LIKE {quote(old_table)} INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+        cursor.execute(f'SELECT min("timestamp"), max(id) FROM {quote(old_table)}')
+        oldest, max_id = cursor.fetchone()
+        today = datetime.now(timezone.utc).date()
+        first_month = month_start(oldest.date() if oldest else today)
+        months = (today.year - first_month.year) * 12 + today.month - first_month.month + 1 + months_ahead
+        create_partitions(connection, first_month, months)
+        cursor.execute(f'CREATE TABLE {quote(default_partition_name())} PARTITION OF {quote(db_table)} DEFAULT')
+        cursor.execute(f'INSERT INTO {quote(db_table)} SELECT * FROM {quote(old_table)}')
+        cursor.execute(f'DROP TABLE {quote(old_table)}')
+        cursor.execute(f'CREATE SEQUENCE {quote(sequence)} OWNED BY {quote(db_table)}.id')
+        if max_id:
+            cursor.execute('SELECT setval(%s, %s)', [sequence, max_id])
+        cursor.execute(f"ALTER TABLE {quote(db_table)} ALTER COLUMN id SET DEFAULT nextval('{sequence}')")
+        cursor.execute(f'ALTER TABLE {quote(db_table)} ADD PRIMARY KEY (id, "timestamp")')
+        cursor.execute(
+            f'ALTER TABLE {quote(db_table)} ADD CONSTRAINT {quote(db_table + "_dedup_ts_uniq")} '
+            f'UNIQUE ("deduplicationId", "timestamp")'
+        )
+        cursor.execute(
+            f'ALTER TABLE {quote(db_table)} ADD CONSTRAINT {quote(db_table + "_device_id_fk")} '
+            f'FOREIGN KEY (device_id) REFERENCES {quote(device_table)} (id) DEFERRABLE INITIALLY DEFERRED'
+        )
+        for index in SensorReading._meta.indexes:
+            cursor.execute(str(index.create_sql(SensorReading, connection.schema_editor())))
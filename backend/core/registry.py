@@ -0,0 +1,166 @@
+"""
+In-process cache of devices and their alert rules (subscribers grouped by
+their thresholds) for the ingest path.
+
+Devices are cached by serial number (the ChirpStack devEui) with a TTL and
+LRU eviction; unknown serials are cached as well, so a gateway flooding us
+with unregistered devices does not hit the database for every uplink.
+
+Changes made in this process invalidate the cache through model signals.
+Changes made by other processes (e.g. the web app while the MQTT client
+runs) are picked up once the entry expires after DEVICE_REGISTRY_TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .alerts import AlertRule
+from .models import Device, UserProfile
+
+
+class LRUCache:
+    """Thread-safe mapping with a per-entry TTL and least-recently-used eviction."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_where(self, predicate):
+        with self._lock:
+            for key in [key for key, (_, value) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Cached in place of a Device for serials that are not registered.
+UNREGISTERED = object()
+
+
+class DeviceRegistry:
+    def __init__(self, maxsize=None, ttl=None):
+        maxsize = maxsize or settings.DEVICE_REGISTRY_SIZE
+        ttl = ttl or settings.DEVICE_REGISTRY_TTL
+        self.devices = LRUCache(maxsize, ttl)
+        self.rules = LRUCache(maxsize, ttl)
+
+    def get_device(self, serial_number):
+        return self.get_devices([serial_number]).get(serial_number)
+
+    def get_devices(self, serial_numbers):
+        """Map of serial number to Device for the registered ones among ``serial_numbers``."""
+        found = {}
+        missing = []
+        for serial_number in set(serial_numbers):
+            device = self.devices.get(serial_number)
+            if device is None:
+                missing.append(serial_number)
+            elif device is not UNREGISTERED:
+                found[serial_number] = device
+        if missing:
+            loaded = Device.objects.in_bulk(missing, field_name='serial_number')
+            for serial_number in missing:
+                device = loaded.get(serial_number)
+                self.devices.set(serial_number, UNREGISTERED if device is None else device)
+                if device is not None:
+                    found[serial_number] = device
+        return found
+
+    def get_alert_rules(self, device):
+        """The AlertRules of the users who want alerts for ``device``."""
+        rules = self.rules.get(device.pk)
+        if rules is None:
+            subscribers = (
+                EmailAddress.objects.filter(
+                    primary=True,
+                    verified=True,
+                    user__devices=device,
+                    user__profile__alert_email_enabled=True,
+                ).order_by('user_id')
+                .values_list('email', 'user__profile__warning_threshold', 'user__profile__alert_threshold')
+            )
+            recipients = {}
+            for email, warning_threshold, alert_threshold in subscribers:
+                # Both thresholds come from the same place, the user's
+                # overrides or else the device's, as that is where they were
+                # validated against each other.
+                if warning_threshold is None and alert_threshold is None:
+                    warning_threshold, alert_threshold = device.warning_threshold, device.alert_threshold
+                recipients.setdefault((warning_threshold, alert_threshold), []).append(email)
+            rules = tuple(AlertRule(*thresholds, tuple(emails)) for thresholds, emails in recipients.items())
+            self.rules.set(device.pk, rules)
+        return rules
+
+    def get_subscribers(self, device):
+        """E-mail addresses of the users who want alerts for ``device``."""
+        return [email for rule in self.get_alert_rules(device) for email in rule.recipients]
+
+    def forget_device(self, device):
+        self.devices.pop(device.serial_number)
+        # The serial number may have changed since the device was cached.
+        self.devices.pop_where(lambda cached: cached is not UNREGISTERED and cached.pk == device.pk)
+        self.rules.pop(device.pk)
+
+    def forget_subscribers(self):
+        self.rules.clear()
+
+    def clear(self):
+        self.devices.clear()
+        self.rules.clear()
+
+
+registry = DeviceRegistry()
+
+
+@receiver([post_save, post_delete], sender=Device)
+def device_changed(sender, instance, **kwargs):
+    registry.forget_device(instance)
+
+
+@receiver(m2m_changed, sender=Device.users.through)
+def device_users_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        registry.forget_subscribers()
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+@receiver([post_save, post_delete], sender=EmailAddress)
+def subscriber_changed(sender, **kwargs):
+    # These are rare next to readings, so dropping every device's rules is
+    # simpler than working out which devices the user is subscribed to.
+    registry.forget_subscribers()
@@ -0,0 +1,121 @@
+"""
+Retention tiers for readings and their rollups, applied by ``manage.py
+compactreadings``:
+
+* raw readings (and gateway receptions) are kept READING_RETENTION_DAYS,
+* hourly rollups HOURLY_ROLLUP_RETENTION_DAYS,
+* daily rollups DAILY_ROLLUP_RETENTION_DAYS,
+
+where 0 keeps a tier forever. Cutoffs fall on UTC day boundaries.
+
+Before raw readings are deleted, the rollups of every day being deleted are
+checked against them and rebuilt where readings were stored without updating
+the rollups (e.g. a backfill). Days whose rollups count more readings than
+are left are never rebuilt, so a run interrupted half way through deleting a
+day does not lose what the rollups already hold.
+
+Rows are deleted per device, walking the (device, timestamp) indexes, in
+batches of RETENTION_BATCH_SIZE, each in its own transaction and followed by
+a pause of RETENTION_BATCH_PAUSE seconds. That keeps row locks short and
+gives replicas time to catch up. On a partitioned readings table, dropping
+whole old partitions (``partitionreadings --detach-older-than``) is cheaper
+once the rollups have been compacted.
+"""
+import time
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Count
+from django.db.models.functions import TruncDay
+from django.utils import timezone
+
+from .models import DailyReadingRollup, Device, GatewayReception, HourlyReadingRollup, SensorReading
+from .rollups import day_bucket, rebuild_rollups
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def cutoff(days, now=None):
+    """Start of the oldest day kept by a tier, or None for a tier kept forever."""
+    if not days:
+        return None
+    return day_bucket((now or timezone.now()) - timedelta(days=days))
+
+
+def delete_in_batches(queryset, batch_size=None, pause=None):
+    """Delete the rows of ``queryset`` a batch at a time. Returns how many were deleted."""
+    batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+    pause = settings.RETENTION_BATCH_PAUSE if pause is None else pause
+    model = queryset.model
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += model.objects.filter(pk__in=pks).delete()[0]
+        if len(pks) < batch_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def stale_rollup_days(device, before):
+    """Days before ``before`` whose daily rollup counts fewer readings than are stored."""
+    stored = (
+        SensorReading.objects.filter(device=device, timestamp__lt=before)
+        .annotate(day=TruncDay('timestamp', tzinfo=dt_timezone.utc))
+        .values_list('day')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    rolled_up = dict(
+        DailyReadingRollup.objects.filter(device=device, bucket__lt=before).values_list('bucket', 'count')
+    )
+    return sorted(day for day, count in stored if count > rolled_up.get(day, 0))
+
+
+def compact_device(device, now=None, batch_size=None, pause=None, dry_run=False):
+    """Apply the retention tiers to one device. Returns the rows deleted (or due) per tier."""
+    result = dict(rebuilt_days=0, readings=0, receptions=0, hourly=0, daily=0)
+    readings_before = cutoff(settings.READING_RETENTION_DAYS, now)
+    tiers = [
+        ('hourly', HourlyReadingRollup.objects.filter(device=device), cutoff(settings.HOURLY_ROLLUP_RETENTION_DAYS, now)),
+        ('daily', DailyReadingRollup.objects.filter(device=device), cutoff(settings.DAILY_ROLLUP_RETENTION_DAYS, now)),
+    ]
+    if readings_before is not None:
+        days = stale_rollup_days(device, readings_before)
+        result['rebuilt_days'] = len(days)
+        if not dry_run:
+            for day in days:
+                rebuild_rollups(since=day, until=day + timedelta(days=1), devices=[device])
+        readings = SensorReading.objects.filter(device=device, timestamp__lt=readings_before)
+        receptions = GatewayReception.objects.filter(device=device, timestamp__lt=readings_before)
+        if dry_run:
+            result['readings'] = readings.count()
+            result['receptions'] = receptions.count()
+        else:
+            result['readings'] = delete_in_batches(readings, batch_size, pause)
+            result['receptions'] = delete_in_batches(receptions, batch_size, pause)
+    for tier, rollups, before in tiers:
+        if before is None:
+            continue
+        rollups = rollups.filter(bucket__lt=before)
+        result[tier] = rollups.count() if dry_run else delete_in_batches(rollups, batch_size, pause)
+    return result
+
+
+def compact(now=None, batch_size=None, pause=None, dry_run=False, log=None):
+    """Apply the retention tiers to every device. Returns the totals of ``compact_device``."""
+    now = now or timezone.now()
+    totals = dict(rebuilt_days=0, readings=0, receptions=0, hourly=0, daily=0)
+    for device in Device.objects.order_by('pk').iterator():
+        result = compact_device(device, now, batch_size, pause, dry_run)
+        if any(result.values()):
+            logger.info('Compacted %s: %s', device.serial_number, result)
+            if log:
+                log(device, result)
+        for key, value in result.items():
+            totals[key] += value
+    return totals
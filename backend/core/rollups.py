@@ -0,0 +1,215 @@
+"""
+Hourly and daily per-device rollups of sensor readings.
+
+Rollups are updated incrementally whenever readings are stored (see the
+``readings_stored`` signal) and can be rebuilt from the raw readings with
+``manage.py rollupreadings``, e.g. after a backfill or a failed write.
+
+The newest reading of each device is kept on the Device itself
+(``last_value``, ``last_rssi``, ``last_seen``) the same way.
+"""
+from datetime import timezone as dt_timezone
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Exists, F, Max, Min, OuterRef, Q, Subquery, Sum, Window
+from django.db.models.functions import Greatest, Least, RowNumber, TruncDay, TruncHour
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import DailyReadingRollup, Device, HourlyReadingRollup, SensorReading
+from .signals import readings_stored
+
+
+def hour_bucket(timestamp):
+    return timestamp.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(timestamp):
+    return hour_bucket(timestamp).replace(hour=0)
+
+
+ROLLUPS = (
+    (HourlyReadingRollup, hour_bucket, TruncHour),
+    (DailyReadingRollup, day_bucket, TruncDay),
+)
+
+
+def as_datetime(value):
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+
+def _merge(model, device_id, bucket, agg):
+    count, total, minimum, maximum, last_timestamp, last_value = agg
+    bucket_rollup = model.objects.filter(device_id=device_id, bucket=bucket)
+    increments = dict(
+        count=F('count') + count,
+        total=F('total') + total,
+        minimum=Least('minimum', minimum),
+        maximum=Greatest('maximum', maximum),
+    )
+    # Readings normally arrive in order, so try moving `last` forward first.
+    updated = bucket_rollup.filter(last_timestamp__lte=last_timestamp).update(
+        last_value=last_value, last_timestamp=last_timestamp, **increments,
+    ) or bucket_rollup.filter(last_timestamp__gt=last_timestamp).update(**increments)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(
+                device_id=device_id, bucket=bucket, count=count, total=total, minimum=minimum,
+                maximum=maximum, last_value=last_value, last_timestamp=last_timestamp,
+            )
+    except IntegrityError:
+        # Another writer created the bucket first; fold into it instead.
+        _merge(model, device_id, bucket, agg)
+
+
+ROLLUP_FIELDS = ('device_id', 'bucket', 'count', 'total', 'minimum', 'maximum', 'last_value', 'last_timestamp')
+
+
+def _upsert(model, rows):
+    """Fold ``(device_id, bucket, *agg)`` rows into ``model`` with INSERT ... ON CONFLICT DO UPDATE."""
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    fields = [model._meta.get_field(name) for name in ROLLUP_FIELDS]
+    columns = ', '.join(quote(field.column) for field in fields)
+    least, greatest = ('LEAST', 'GREATEST') if connection.vendor == 'postgresql' else ('MIN', 'MAX')
+    newer = f'EXCLUDED."last_timestamp" >= {table}."last_timestamp"'
+    update = (
+        f'"count" = {table}."count" + EXCLUDED."count", '
+        f'"total" = {table}."total" + EXCLUDED."total", '
+        f'"minimum" = {least}({table}."minimum", EXCLUDED."minimum"), '
+        f'"maximum" = {greatest}({table}."maximum", EXCLUDED."maximum"), '
+        f'"last_value" = CASE WHEN {newer} THEN EXCLUDED."last_value" ELSE {table}."last_value" END, '
+        f'"last_timestamp" = CASE WHEN {newer} THEN EXCLUDED."last_timestamp" ELSE {table}."last_timestamp" END'
+    )
+    batch_size = connection.ops.bulk_batch_size(fields, rows)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            placeholders = ', '.join(['(' + ', '.join(['%s'] * len(fields)) + ')'] * len(batch))
+            params = [field.get_db_prep_save(value, connection) for row in batch for field, value in zip(fields, row)]
+            cursor.execute(
+                f'INSERT INTO {table} ({columns}) VALUES {placeholders} '
+                f'ON CONFLICT ("device_id", "bucket") DO UPDATE SET {update}',
+                params,
+            )
+
+
+def add_readings(readings):
+    """
+    Fold newly stored readings into the rollup tables.
+
+    Buckets are written in (device, bucket) order, so concurrent ingest
+    workers lock rollup rows in the same order and cannot deadlock.
+    """
+    for model, bucket_for, _ in ROLLUPS:
+        groups = {}
+        for reading in readings:
+            timestamp = as_datetime(reading.timestamp)
+            key = (reading.device_id, bucket_for(timestamp))
+            value = float(reading.value)
+            agg = groups.get(key)
+            if agg is None:
+                groups[key] = [1, value, value, value, timestamp, value]
+                continue
+            agg[0] += 1
+            agg[1] += value
+            agg[2] = min(agg[2], value)
+            agg[3] = max(agg[3], value)
+            if timestamp > agg[4]:
+                agg[4], agg[5] = timestamp, value
+        keys = sorted(groups)
+        if connection.features.supports_update_conflicts_with_target:
+            _upsert(model, [(*key, *groups[key][:4], groups[key][5], groups[key][4]) for key in keys])
+        else:
+            for device_id, bucket in keys:
+                _merge(model, device_id, bucket, groups[device_id, bucket])
+
+
+def update_last_readings(readings):
+    """Store the newest of ``readings`` on each device, unless it already has a newer one."""
+    latest = {}
+    for reading in readings:
+        timestamp = as_datetime(reading.timestamp)
+        if reading.device_id not in latest or timestamp > latest[reading.device_id][0]:
+            latest[reading.device_id] = (timestamp, reading)
+    # In device order, like the rollups, so concurrent workers cannot deadlock.
+    for device_id, (timestamp, reading) in sorted(latest.items(), key=lambda item: item[0]):
+        Device.objects.filter(
+            Q(last_seen__isnull=True) | Q(last_seen__lt=timestamp), pk=device_id,
+        ).update(last_value=reading.value, last_rssi=reading.rssi, last_seen=timestamp)
+
+
+@receiver(readings_stored)
+def update_rollups(sender, readings, **kwargs):
+    add_readings(readings)
+    update_last_readings(readings)
+
+
+def rebuild_last_readings(devices=None):
+    """
+    Recompute every device's last reading from the raw readings. Devices with
+    no raw readings left (e.g. compacted away) keep theirs. Returns the
+    number of devices updated.
+    """
+    latest = SensorReading.objects.filter(device=OuterRef('pk')).order_by('-timestamp')
+    queryset = Device.objects.all() if devices is None else Device.objects.filter(pk__in=[device.pk for device in devices])
+    return queryset.filter(Exists(latest)).update(
+        last_value=Subquery(latest.values('value')[:1]),
+        last_rssi=Subquery(latest.values('rssi')[:1]),
+        last_seen=Subquery(latest.values('timestamp')[:1]),
+    )
+
+
+def rebuild_rollups(since=None, devices=None, until=None):
+    """
+    Recompute rollups from raw readings, for buckets starting at ``since``
+    (or all of them) and, given ``until`` (a day boundary), ending before
+    it. Returns the number of rollup rows written per model.
+    """
+    written = {}
+    for model, bucket_for, trunc in ROLLUPS:
+        readings = SensorReading.objects.all()
+        rollups = model.objects.all()
+        if since is not None:
+            start = bucket_for(since)
+            readings = readings.filter(timestamp__gte=start)
+            rollups = rollups.filter(bucket__gte=start)
+        if until is not None:
+            readings = readings.filter(timestamp__lt=until)
+            rollups = rollups.filter(bucket__lt=until)
+        if devices is not None:
+            readings = readings.filter(device__in=devices)
+            rollups = rollups.filter(device__in=devices)
+        bucket = trunc('timestamp', tzinfo=dt_timezone.utc)
+        partition = dict(partition_by=[F('device'), bucket])
+        # One row per bucket: its newest reading, carrying the bucket's aggregates.
+        grouped = (
+            readings.annotate(
+                bucket=bucket,
+                position=Window(RowNumber(), order_by=[F('timestamp').desc(), F('id').desc()], **partition),
+                count=Window(Count('id'), **partition),
+                total=Window(Sum('value'), **partition),
+                minimum=Window(Min('value'), **partition),
+                maximum=Window(Max('value'), **partition),
+            )
+            .filter(position=1)
+            .values_list('device', 'bucket', 'count', 'total', 'minimum', 'maximum', 'value', 'timestamp')
+            .order_by()
+        )
+        fields = ('device_id', 'bucket', 'count', 'total', 'minimum', 'maximum', 'last_value', 'last_timestamp')
+        with transaction.atomic():
+            rollups.delete()
+            objs = model.objects.bulk_create(
+                (model(**dict(zip(fields, row))) for row in grouped.iterator()),
+                batch_size=1000,
+            )
+        written[model.__name__] = len(objs)
+    return written
+
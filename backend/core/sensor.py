@@ -1,81 +1,182 @@
-from django.core.mail import send_mail
+from datetime import timezone as dt_timezone
+from typing import NamedTuple, Optional, Tuple
+
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 
+from . import alerts, analytics, metrics
 from .exceptions import SensorException
-from .models import Device, SensorReading
+from .models import GatewayReception, SensorReading
+from .outbox import queue_emails
+from .registry import registry
 
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def process_message(obj):
-    deduplicationId = obj.get('deduplicationId')
-    timestamp = obj.get('time')
+class Reception(NamedTuple):
+    """One gateway's rxInfo entry."""
+    gatewayId: str
+    rssi: float
+    snr: Optional[float]
+
+
+class Uplink(NamedTuple):
+    """The fields of a ChirpStack uplink event that we actually store."""
+    deduplicationId: str
+    time: str
+    devEui: str
+    hexdata: str
+    rssi: float
+    receptions: Tuple[Reception, ...] = ()
+
+
+def parse_receptions(rx_info):
+    return tuple(Reception(entry.get('gatewayId'), entry.get('rssi'), entry.get('snr')) for entry in rx_info)
+
+
+def best_rssi(receptions):
+    """
+    RSSI of the gateway chosen by SENSOR_GATEWAY_SELECTION: 'first' as
+    listed by ChirpStack, or the one with the best 'rssi' or 'snr'.
+    """
+    if not receptions:
+        return None
+    if settings.SENSOR_GATEWAY_SELECTION == 'first':
+        return receptions[0].rssi
+    heard = [reception for reception in receptions if reception.rssi is not None]
+    if not heard:
+        return None
+    if settings.SENSOR_GATEWAY_SELECTION == 'snr':
+        best = max(heard, key=lambda r: (r.snr is not None, r.snr or 0, r.rssi))
+    else:
+        best = max(heard, key=lambda r: (r.rssi, r.snr if r.snr is not None else float('-inf')))
+    return best.rssi
+
+
+def parse_uplink(obj):
     device_info = obj.get('deviceInfo', {})
-    serial_number = device_info.get('devEui')
     object_data = obj.get('object', {})
-    hexdata = object_data.get('hexdata')
-    rxInfo = obj.get('rxInfo', [])
-    rssi = rxInfo[0]['rssi'] if rxInfo and 'rssi' in rxInfo[0] else None
+    receptions = parse_receptions(obj.get('rxInfo', []))
+    return Uplink(
+        deduplicationId=obj.get('deduplicationId'),
+        time=obj.get('time'),
+        devEui=device_info.get('devEui'),
+        hexdata=object_data.get('hexdata'),
+        rssi=best_rssi(receptions),
+        receptions=receptions,
+    )
+
+
+def check_uplink(uplink):
     missing = []
-    if not deduplicationId:
+    if not uplink.deduplicationId:
         missing.append('deduplicationId')
-    if not timestamp:
+    if not uplink.time:
         missing.append('time')
-    if not serial_number:
+    if not uplink.devEui:
         missing.append('deviceInfo.devEui')
-    if hexdata is None:
+    if uplink.hexdata is None:
         missing.append('object.hexdata')
-    if rssi is None:
+    if uplink.rssi is None:
         missing.append('rxInfo[0].rssi')
     if missing:
         # FIXME do we need to raise? or ignore and warn?
         raise SensorException(f'Missing required field(s): {", ".join(missing)}')
-    if hexdata == "":
+
+
+def parse_time(value):
+    try:
+        timestamp = parse_datetime(value)
+    except (TypeError, ValueError):
+        timestamp = None
+    if timestamp is None:
+        raise SensorException(f'Invalid time: {value!r}')
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    return timestamp
+
+
+def process_message(obj):
+    process_uplink(parse_uplink(obj))
+
+
+def process_uplink(uplink):
+    with metrics.PROCESS_MESSAGE_SECONDS.time(), metrics.db_time('process_message'):
+        try:
+            _process_uplink(uplink)
+        except SensorException:
+            metrics.UPLINKS_REJECTED.inc()
+            raise
+
+
+def _process_uplink(uplink):
+    check_uplink(uplink)
+    if uplink.hexdata == "":
         logger.error("Empty hexdata. Ignoring.")
+        metrics.UPLINKS_REJECTED.inc()
         return
-    value = int(hexdata)
-    try:
-        device = Device.objects.get(serial_number=serial_number)
-    except Device.DoesNotExist:
-        logger.info('Device not registered: %s', serial_number)
+    value = int(uplink.hexdata)
+    device = registry.get_device(uplink.devEui)
+    if device is None:
+        logger.info('Device not registered: %s', uplink.devEui)
+        metrics.UPLINKS_UNREGISTERED.inc()
+        metrics.UPLINKS_REJECTED.inc()
         return
+    reading = SensorReading(device=device, value=value, rssi=uplink.rssi, timestamp=parse_time(uplink.time))
+    stats = analytics.flag_readings([reading])
     reading, created = SensorReading.objects.get_or_create(
-        deduplicationId=deduplicationId,
+        deduplicationId=uplink.deduplicationId,
         defaults=dict(
             device=device,
             value=value,
-            rssi=rssi,
-            timestamp=timestamp,
+            rssi=uplink.rssi,
+            timestamp=reading.timestamp,
+            flags=reading.flags,
         )
     )
     if not created:
-        logger.info('Duplicate deduplicationId: %s', deduplicationId)
+        logger.info('Duplicate deduplicationId: %s', uplink.deduplicationId)
+        metrics.UPLINKS_DUPLICATE.inc()
         return
-    # Alert logic
-    alert_threshold = settings.SENSOR_ALERT_THRESHOLD
-    warning_threshold = settings.SENSOR_WARNING_THRESHOLD
-    logger.debug("Email using TLS: %s", settings.EMAIL_USE_TLS)
-    if reading.value > alert_threshold:
-        for user in device.users.filter(profile__alert_email_enabled=True):
-            user_email = user.emailaddress_set.get(primary=True, verified=True).email
-            send_mail(
-                subject='Sensor Alert - Action Needed',
-                message=f'Sensor {device.name} ({device.serial_number}) value {reading.value} exceeded threshold {alert_threshold}.',
-                from_email=settings.NOTIFICATIONS_FROM_EMAIL,
-                recipient_list=[user_email],
-                fail_silently=True,
-            )
-    elif reading.value > warning_threshold:
-        for user in device.users.filter(profile__alert_email_enabled=True):
-            user_email = user.emailaddress_set.get(primary=True, verified=True).email
-            send_mail(
-                subject='Sensor Warning',
-                message=f'Sensor {device.name} ({device.serial_number}) value {reading.value} exceeded threshold {warning_threshold}.',
-                from_email=settings.NOTIFICATIONS_FROM_EMAIL,
-                recipient_list=[user_email],
-                fail_silently=True,
-            )
-    
\ No newline at end of file
+    analytics.save(stats, [reading])
+    metrics.UPLINKS_STORED.inc()
+    GatewayReception.objects.bulk_create(gateway_receptions(device, reading.timestamp, uplink))
+    notify_users(device, reading.value, reading.timestamp)
+
+
+def gateway_receptions(device, timestamp, uplink):
+    if not settings.STORE_GATEWAY_RECEPTIONS:
+        return []
+    return [
+        GatewayReception(device=device, timestamp=timestamp, gateway_id=reception.gatewayId,
+                         rssi=reception.rssi, snr=reception.snr)
+        for reception in uplink.receptions
+        if reception.gatewayId and reception.rssi is not None
+    ]
+
+
+def notify_users(device, value, timestamp=None):
+    reading_at = None if timestamp is None else timestamp.timestamp()
+    emails = []
+    for rule in registry.get_alert_rules(device):
+        thresholds = warning_threshold, alert_threshold = rule.thresholds()
+        event = alerts.transition(device.pk, alerts.level_for(value, warning_threshold, alert_threshold),
+                                  thresholds=thresholds, reading_at=reading_at)
+        if event == alerts.ALERT:
+            subject = 'Sensor Alert - Action Needed'
+            message = f'Sensor {device.name} ({device.serial_number}) value {value} exceeded threshold {alert_threshold}.'
+        elif event == alerts.WARNING:
+            subject = 'Sensor Warning'
+            message = f'Sensor {device.name} ({device.serial_number}) value {value} exceeded threshold {warning_threshold}.'
+        elif event == alerts.RECOVERED:
+            subject = 'Sensor Recovered'
+            message = f'Sensor {device.name} ({device.serial_number}) value {value} is back below threshold {warning_threshold}.'
+        else:
+            continue
+        emails.append((subject, message, rule.recipients))
+    if emails:
+        queue_emails(emails)
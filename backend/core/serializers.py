@@ -1,29 +1,85 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import UserProfile, Device
+from .pagination import decode_cursor
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import get_user_model
 
 
 User = get_user_model()
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class AlertThresholdsMixin:
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        warning = attrs.get('warning_threshold', getattr(self.instance, 'warning_threshold', None))
+        alert = attrs.get('alert_threshold', getattr(self.instance, 'alert_threshold', None))
+        # The pair is used together (see registry.get_alert_rules), with the
+        # global setting standing in for the one left unset.
+        if warning is None and alert is None:
+            return attrs
+        if warning is None:
+            if alert <= settings.SENSOR_WARNING_THRESHOLD:
+                raise serializers.ValidationError({'alert_threshold': 'Must be above the warning threshold.'})
+        elif warning >= (settings.SENSOR_ALERT_THRESHOLD if alert is None else alert):
+            raise serializers.ValidationError({'warning_threshold': 'Must be below the alert threshold.'})
+        return attrs
+
+class UserProfileSerializer(AlertThresholdsMixin, serializers.ModelSerializer):
     email = serializers.EmailField(source='user.email', read_only=True)
     class Meta:
         model = UserProfile
-        fields = ['email', 'address', 'phone', 'alert_email_enabled']
+        fields = ['email', 'address', 'phone', 'alert_email_enabled', 'warning_threshold', 'alert_threshold']
 
 class PasswordChangeSerializer(serializers.Serializer):
     old_password = serializers.CharField(required=True)
     new_password = serializers.CharField(required=True, validators=[validate_password])
 
-class DeviceSerializer(serializers.ModelSerializer):
+class DeviceSerializer(AlertThresholdsMixin, serializers.ModelSerializer):
     class Meta:
         model = Device
-        fields = ['id', 'serial_number', 'date_created', 'date_updated', "users", "name"]
+        fields = ['id', 'serial_number', 'date_created', 'date_updated', "users", "name",
+                  'warning_threshold', 'alert_threshold']
         read_only_fields = ['id', 'date_created', 'date_updated']
         extra_kwargs = {'users': {'required': False}}
 
+class DeviceUpdateSerializer(DeviceSerializer):
+    # A device is shared: one of its users may rename it or change its
+    # thresholds, but not re-point it or change who else has it.
+    class Meta(DeviceSerializer.Meta):
+        read_only_fields = DeviceSerializer.Meta.read_only_fields + ['serial_number', 'users']
+
+class DeviceSummarySerializer(DeviceSerializer):
+    # Annotated by DeviceListCreateView in summary mode.
+    average_24_hours = serializers.DecimalField(max_digits=12, decimal_places=2, coerce_to_string=False, read_only=True)
+
+    class Meta(DeviceSerializer.Meta):
+        fields = DeviceSerializer.Meta.fields + ['last_value', 'last_rssi', 'last_seen', 'average_24_hours']
+        read_only_fields = DeviceSerializer.Meta.read_only_fields + ['last_value', 'last_rssi', 'last_seen']
+
+class DeviceDashboardQuerySerializer(serializers.Serializer):
+    resolution = serializers.ChoiceField(choices=['auto', 'raw', 'minute', 'hour', 'day'], default='auto')
+    max_points = serializers.IntegerField(min_value=3, max_value=10000, default=1000)
+
+class DeviceReadingsQuerySerializer(serializers.Serializer):
+    cursor = serializers.CharField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=10000, default=1000)
+
+    def get_fields(self):
+        # 'from' is a keyword, so these cannot be declared as attributes.
+        fields = super().get_fields()
+        fields['from'] = serializers.DateTimeField(required=False)
+        fields['to'] = serializers.DateTimeField(required=False)
+        return fields
+
+    def validate_cursor(self, value):
+        try:
+            return decode_cursor(value)
+        except ValueError as exc:
+            raise serializers.ValidationError(str(exc))
+
 class DeviceDashboardSerializer(serializers.Serializer):
     recent_reading = serializers.DictField()
     averages = serializers.DictField()
+    statistics = serializers.DictField()
+    trend_resolution = serializers.CharField()
     trend = serializers.ListField() 
\ No newline at end of file
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent after new SensorReadings are written, whether one at a time through
+# the ORM or in bulk by the ingest pipeline (where post_save does not fire).
+# Arguments: readings, a list of SensorReading instances.
+readings_stored = Signal()
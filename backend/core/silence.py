@@ -0,0 +1,103 @@
+"""
+Notices for devices that stopped sending readings, sent by ``manage.py
+notifysilentdevices`` (run it every few minutes, e.g. from cron).
+
+A device is silent once its newest reading (``Device.last_seen``, kept up to
+date at ingest) is older than SENSOR_SILENCE_TIMEOUT. Its users are mailed
+once per silence: ``silence_notified_at`` is set when they are, and once the
+device sends a reading newer than that they are told it is back and the
+field is cleared. Devices that never sent a reading are left alone.
+
+Both lookups use a partial index on ``last_seen``: a range scan over the
+devices not notified, and a scan of the ones notified (the devices silent
+right now), so a run never reads the whole fleet. Devices are claimed
+SILENCE_BATCH_SIZE at a time with SKIP LOCKED, so overlapping runs do not
+mail anyone twice.
+"""
+import logging
+from datetime import timedelta
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Device
+from .outbox import queue_emails
+
+
+logger = logging.getLogger(__name__)
+
+
+def silent_devices(cutoff):
+    """Devices not heard from since ``cutoff`` whose users were not told yet."""
+    return Device.objects.filter(silence_notified_at__isnull=True, last_seen__lt=cutoff)
+
+
+def returned_devices():
+    """Devices whose users were told they went silent that reported since."""
+    return Device.objects.filter(silence_notified_at__isnull=False, last_seen__gt=F('silence_notified_at'))
+
+
+def subscribers(devices):
+    """E-mail addresses of the users who want alerts, per device id."""
+    emails = {device.pk: [] for device in devices}
+    rows = (
+        EmailAddress.objects.filter(
+            primary=True,
+            verified=True,
+            user__devices__in=list(emails),
+            user__profile__alert_email_enabled=True,
+        )
+        .order_by('user_id')
+        .values_list('user__devices', 'email')
+    )
+    for device_id, email in rows:
+        emails[device_id].append(email)
+    return emails
+
+
+def silence_email(device):
+    return (
+        'Sensor Offline',
+        f'Sensor {device.name} ({device.serial_number}) has not sent a reading since '
+        f'{device.last_seen:%Y-%m-%d %H:%M} UTC.',
+    )
+
+
+def return_email(device):
+    return (
+        'Sensor Back Online',
+        f'Sensor {device.name} ({device.serial_number}) is sending readings again.',
+    )
+
+
+def _notify(queryset, email, notified_at, batch_size):
+    handled = 0
+    while True:
+        with transaction.atomic():
+            devices = list(queryset.select_for_update(skip_locked=True).order_by('last_seen')[:batch_size])
+            if not devices:
+                return handled
+            recipients = subscribers(devices)
+            queue_emails((*email(device), recipients[device.pk]) for device in devices)
+            Device.objects.filter(pk__in=[device.pk for device in devices]).update(silence_notified_at=notified_at)
+        handled += len(devices)
+        if len(devices) < batch_size:
+            return handled
+
+
+def notify(now=None, timeout=None, batch_size=None):
+    """Mail the users of devices that went silent or came back. Returns how many of each."""
+    now = now or timezone.now()
+    timeout = settings.SENSOR_SILENCE_TIMEOUT if timeout is None else timeout
+    batch_size = batch_size or settings.SILENCE_BATCH_SIZE
+    cutoff = now - timedelta(seconds=timeout)
+    # Returns first: a device that came back and went silent again between
+    # two runs gets both notices.
+    returned = _notify(returned_devices(), return_email, None, batch_size)
+    silent = _notify(silent_devices(cutoff), silence_email, now, batch_size)
+    if silent or returned:
+        logger.info('%d devices went silent, %d came back', silent, returned)
+    return silent, returned
@@ -1,17 +1,40 @@
 from webbrowser import get
+import asyncio
+import csv
+import importlib.util
+import json
+import os
+import time
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock, skipUnless
 from django.core import mail
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.mail import get_connection
+from asgiref.sync import sync_to_async
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework.authtoken.models import Token
-from .models import UserProfile, Device, SensorReading
-from .sensor import process_message
+from .models import UserProfile, Device, SensorReading, HourlyReadingRollup, DailyReadingRollup, OutgoingEmail, GatewayReception
+from .sensor import process_message, Reception, Uplink
+from .ingest import store_uplinks, IngestBuffer
+from . import alerts, analytics, archive, dashboard, decoders, export, gateways, live, metrics, partitions, silence
+from .benchmarks import decoding, generator, suite
+from .rollups import rebuild_rollups
+from .registry import LRUCache, registry
+from .outbox import deliver_queued_emails, queue_email
 from .exceptions import SensorException
+from .signals import readings_stored
 from django.core import mail
 from django.utils import timezone
 from datetime import timedelta
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, connections
 
 
 User = get_user_model()
@@ -48,6 +71,15 @@ class ProfileViewTests(APITestCase):
         self.assertEqual(self.profile.phone, '555-1234')
         self.assertFalse(self.profile.alert_email_enabled)
 
+    def test_update_thresholds(self):
+        response = self.client.patch(self.url, {'warning_threshold': 100, 'alert_threshold': 180})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.patch(self.url, {'warning_threshold': 180})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('warning_threshold', response.data)
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.warning_threshold, self.profile.alert_threshold), (100, 180))
+
 class PasswordChangeViewTests(APITestCase):
     def setUp(self):
         self.user = create_test_user(username='changepass', email='change@example.com', password='oldpass123')
@@ -104,6 +136,38 @@ class DeviceAPITests(APITestCase):
         self.assertIn('SN123', serials)
         self.assertIn('SN456', serials)
 
+    def test_list_devices_summary(self):
+        other_user = create_test_user(username='devsummary', email='devsummary@example.com', password='devpass123')
+        self.device1.users.add(other_user)
+        now = timezone.now()
+        SensorReading.objects.create(device=self.device1, value=10, rssi=-70, timestamp=now - timedelta(hours=30), deduplicationId='sum-1')
+        SensorReading.objects.create(device=self.device1, value=20, rssi=-75, timestamp=now - timedelta(hours=2), deduplicationId='sum-2')
+        SensorReading.objects.create(device=self.device1, value=40, rssi=-80, timestamp=now - timedelta(hours=1), deduplicationId='sum-3')
+        for use_rollups in (True, False):
+            with self.settings(DASHBOARD_USE_ROLLUPS=use_rollups):
+                with self.assertNumQueries(3):  # the user, the devices, their users
+                    response = self.client.get(self.url, {'summary': 1})
+            devices = {device['serial_number']: device for device in response.data}
+            self.assertEqual(devices['SN123']['last_value'], 40)
+            self.assertEqual(devices['SN123']['last_rssi'], -80)
+            self.assertEqual(devices['SN123']['last_seen'], (now - timedelta(hours=1)).isoformat().replace('+00:00', 'Z'))
+            self.assertEqual(devices['SN123']['average_24_hours'], 30)
+            self.assertEqual(sorted(devices['SN123']['users']), [self.user.pk, other_user.pk])
+            self.assertIsNone(devices['SN456']['last_seen'])
+            self.assertIsNone(devices['SN456']['average_24_hours'])
+        self.assertNotIn('last_value', self.client.get(self.url).data[0])
+
+    def test_last_reading_not_overwritten_by_older_one(self):
+        now = timezone.now()
+        SensorReading.objects.create(device=self.device1, value=20, rssi=-75, timestamp=now, deduplicationId='last-1')
+        SensorReading.objects.create(device=self.device1, value=10, rssi=-70, timestamp=now - timedelta(hours=1), deduplicationId='last-2')
+        self.device1.refresh_from_db()
+        self.assertEqual((self.device1.last_value, self.device1.last_seen), (20, now))
+        Device.objects.update(last_value=None, last_rssi=None, last_seen=None)
+        call_command('rollupreadings', stdout=StringIO())
+        self.device1.refresh_from_db()
+        self.assertEqual((self.device1.last_value, self.device1.last_rssi, self.device1.last_seen), (20, -75, now))
+
     def test_create_device(self):
         data = {'serial_number': 'SN789', "name": "Test Device"}
         response = self.client.post(self.url, data)
@@ -140,6 +204,18 @@ class DeviceAPITests(APITestCase):
         response = self.client.get(detail_url)
         self.assertEqual(response.status_code, 404)
 
+    def test_update_device(self):
+        detail_url = reverse('device-detail', args=[self.device1.pk])
+        response = self.client.patch(detail_url, {'name': 'Basement', 'warning_threshold': 120, 'serial_number': 'SN000'})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.device1.refresh_from_db()
+        self.assertEqual((self.device1.name, self.device1.warning_threshold, self.device1.serial_number),
+                         ('Basement', 120, 'SN123'))
+        # Checked against the global alert threshold (200) when it has none.
+        response = self.client.patch(detail_url, {'warning_threshold': 250})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('warning_threshold', response.data)
+
     def test_delete_device(self):
         other_user = create_test_user(username='other', email='other@example.com', password='otherpass')
         self.device1.users.add(other_user)
@@ -151,6 +227,9 @@ class DeviceAPITests(APITestCase):
 
 class SensorReadingIngestTests(TestCase):
     def setUp(self):
+        cache.clear()
+        alerts.cache.clear()
+        registry.clear()
         self.user = create_test_user(username='sensoruser', email='sensor@example.com', password='sensorpass')
         self.device = Device.objects.create(serial_number='0123456789abcd11')
         self.device.users.add(self.user)
@@ -188,6 +267,7 @@ class SensorReadingIngestTests(TestCase):
         payload["deduplicationId"] = "test-dedup-id-3"
         process_message(payload)
         self.assertEqual(SensorReading.objects.all().count(), 1)
+        deliver_queued_emails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('sensor@example.com', mail.outbox[0].to)
         self.assertIn('Sensor Alert', mail.outbox[0].subject)
@@ -198,6 +278,7 @@ class SensorReadingIngestTests(TestCase):
         payload["deduplicationId"] = "test-dedup-id-3"
         process_message(payload)
         self.assertEqual(SensorReading.objects.all().count(), 1)
+        deliver_queued_emails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('sensor@example.com', mail.outbox[0].to)
         self.assertIn('Sensor Alert - Action Needed', mail.outbox[0].subject)
@@ -209,6 +290,7 @@ class SensorReadingIngestTests(TestCase):
         payload["object"] = {"hexdata": "201"}
         process_message(payload)
         self.assertEqual(SensorReading.objects.all().count(), 1)
+        deliver_queued_emails()
         # Both users should receive an email (will fail until process_message is updated)
         self.assertEqual(len(mail.outbox), 2)
         recipients = [email for m in mail.outbox for email in m.to]
@@ -224,6 +306,7 @@ class SensorReadingIngestTests(TestCase):
         payload["deduplicationId"] = "test-dedup-id-toggle"
         process_message(payload)
         self.assertEqual(SensorReading.objects.all().count(), 1)
+        deliver_queued_emails()
         self.assertEqual(len(mail.outbox), 0)
 
     def test_alert_respects_profile_toggle_multiple_users(self):
@@ -238,6 +321,7 @@ class SensorReadingIngestTests(TestCase):
         payload["object"] = {"hexdata": "201"}
         process_message(payload)
         self.assertEqual(SensorReading.objects.all().count(), 1)
+        deliver_queued_emails()
         # Only user2 should receive an email (will fail until process_message is updated)
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('sensor2@example.com', mail.outbox[0].to)
@@ -264,8 +348,465 @@ class SensorReadingIngestTests(TestCase):
         self.assertEqual(SensorReading.objects.filter(device=self.device).count(), 0)
         
 
+class BatchedIngestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        alerts.cache.clear()
+        registry.clear()
+        self.user = create_test_user(username='batchuser', email='batch@example.com', password='batchpass')
+        self.device = Device.objects.create(serial_number='0123456789abcd12')
+        self.device.users.add(self.user)
+
+    def make_uplink(self, deduplicationId, hexdata='23', devEui=None):
+        return Uplink(
+            deduplicationId=deduplicationId,
+            time=timezone.now().isoformat(),
+            devEui=devEui or self.device.serial_number,
+            hexdata=hexdata,
+            rssi=-64,
+        )
+
+    def test_store_uplinks_counts(self):
+        SensorReading.objects.create(device=self.device, value=1, rssi=-60, timestamp=timezone.now(), deduplicationId='batch-0')
+        uplinks = [
+            self.make_uplink('batch-0'),
+            self.make_uplink('batch-1'),
+            self.make_uplink('batch-1'),
+            self.make_uplink('batch-2', devEui='NOTFOUND'),
+            self.make_uplink('batch-3', hexdata=''),
+            self.make_uplink(None),
+            self.make_uplink('batch-4', hexdata='201'),
+        ]
+        # Including the device's alert rules, loaded once into the registry,
+        # plus the NOTIFY for live reading streams on PostgreSQL.
+        with self.assertNumQueries(10 if live.notify_enabled() else 9):
+            result = store_uplinks(uplinks[:-1])
+        # Replaying the batch only looks up the existing deduplicationIds:
+        # devices (and the unknown serial) now come from the registry.
+        with self.assertNumQueries(3):
+            store_uplinks(uplinks[:-1])
+        self.assertEqual(result.stored, 1)
+        self.assertEqual(result.duplicates, 2)
+        self.assertEqual(result.unregistered, 1)
+        self.assertEqual(result.rejected, 3)
+        self.assertEqual([e['index'] for e in result.errors], [3, 4, 5])
+        result = store_uplinks(uplinks[-1:])
+        self.assertEqual(result.stored, 1)
+        self.assertEqual(SensorReading.objects.filter(device=self.device).count(), 3)
+        deliver_queued_emails()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_buffer_flushes_in_batches(self):
+        ingest_buffer = IngestBuffer(batch_size=2, flush_interval=0.01)
+        for i in range(5):
+            ingest_buffer.put(self.make_uplink(f'buffer-{i}'))
+        self.assertEqual(ingest_buffer.queue_depth, 5)
+        self.assertEqual(ingest_buffer.flush(), 5)
+        stats = ingest_buffer.snapshot()
+        self.assertEqual(stats['received'], 5)
+        self.assertEqual(stats['stored'], 5)
+        self.assertEqual(stats['batches'], 3)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(SensorReading.objects.filter(device=self.device).count(), 5)
+
+    def test_buffer_drops_when_full_for_too_long(self):
+        ingest_buffer = IngestBuffer(max_queue_size=1, put_timeout=0.01)
+        dropped = metrics.UPLINKS_DROPPED._children[()].value
+        with self.assertLogs('core.ingest', 'ERROR'):
+            for i in range(3):
+                ingest_buffer.put(self.make_uplink(f'full-{i}'))
+        self.assertEqual((ingest_buffer.stats['received'], ingest_buffer.stats['dropped']), (1, 2))
+        self.assertEqual(metrics.UPLINKS_DROPPED._children[()].value, dropped + 2)
+
+    @override_settings(INGEST_MAX_RETRIES=2, INGEST_RETRY_DELAY=0)
+    def test_buffer_retries_failed_batches(self):
+        from django.db import OperationalError
+        ingest_buffer = IngestBuffer(batch_size=2, flush_interval=0.01)
+        failures = [OperationalError('database is down')] * 2
+        store = store_uplinks
+
+        def flaky_store(batch):
+            if failures:
+                raise failures.pop()
+            return store(batch)
+
+        with mock.patch('core.ingest.store_uplinks', flaky_store), \
+                mock.patch('core.ingest.close_old_connections') as close_old_connections, \
+                self.assertLogs('core.ingest', 'ERROR'):
+            ingest_buffer._store([self.make_uplink('retry-1')], retry=True)
+            failures[:] = [OperationalError('database is down')] * 3
+            ingest_buffer._store([self.make_uplink('retry-2')], retry=True)
+        self.assertEqual(close_old_connections.call_count, 6)
+        self.assertEqual(ingest_buffer.stats['retries'], 4)
+        self.assertEqual(ingest_buffer.stats['failed_batches'], 1)
+        self.assertEqual(list(SensorReading.objects.values_list('deduplicationId', flat=True)), ['retry-1'])
+
+    def test_concurrent_duplicates_are_not_stored_twice(self):
+        flag_readings = analytics.flag_readings
+
+        def store_concurrently(readings):
+            # Another worker stores the same uplink after the lookup.
+            SensorReading.objects.create(device=self.device, value=23, rssi=-64, timestamp=timezone.now(),
+                                         deduplicationId='race-1')
+            return flag_readings(readings)
+
+        stored = []
+        uplinks = [self.make_uplink('race-1'), self.make_uplink('race-2')]
+        uplinks[0] = uplinks[0]._replace(receptions=[Reception('gw-1', -64, 7.0)])
+        uplinks[1] = uplinks[1]._replace(receptions=[Reception('gw-2', -64, 7.0)])
+        with mock.patch('core.ingest.analytics.flag_readings', store_concurrently):
+            receiver = lambda readings, **kwargs: stored.extend(readings)
+            readings_stored.connect(receiver)
+            try:
+                result = store_uplinks(uplinks)
+            finally:
+                readings_stored.disconnect(receiver)
+        self.assertEqual((result.stored, result.duplicates), (1, 1))
+        self.assertEqual([reading.deduplicationId for reading in stored if reading.pk], ['race-1', 'race-2'])
+        self.assertEqual(HourlyReadingRollup.objects.get(device=self.device).count, 2)
+        self.assertEqual(list(GatewayReception.objects.values_list('gateway_id', flat=True)), ['gw-2'])
+
+
+class SensorReadingBulkIngestTests(APITestCase):
+    def setUp(self):
+        self.device = Device.objects.create(serial_number='0123456789abcd14')
+        self.client.credentials(HTTP_AUTHORIZATION='Api-Key ' + settings.CENTRAL_COLLECTOR_API_KEY)
+        self.url = reverse('sensor-ingest-bulk')
+
+    def make_payload(self, deduplicationId, devEui=None):
+        return {
+            "deduplicationId": deduplicationId,
+            "time": timezone.now().isoformat(),
+            "deviceInfo": {"devEui": devEui or self.device.serial_number},
+            "object": {"hexdata": "23"},
+            "rxInfo": [{"rssi": -64}],
+        }
+
+    def test_requires_api_key(self):
+        self.client.credentials()
+        response = self.client.post(self.url, [self.make_payload('bulk-1')], format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_json_array(self):
+        payloads = [self.make_payload('bulk-1'), self.make_payload('bulk-1'), self.make_payload('bulk-2', devEui='NOTFOUND'), {"time": "x"}]
+        response = self.client.post(self.url, payloads, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['accepted'], 1)
+        self.assertEqual(response.data['duplicates'], 1)
+        self.assertEqual(response.data['rejected'], 2)
+        self.assertEqual([e['index'] for e in response.data['errors']], [2, 3])
+        self.assertEqual(SensorReading.objects.filter(device=self.device).count(), 1)
+
+    def test_ndjson_stream(self):
+        lines = [json.dumps(self.make_payload(f'bulk-{i}')) for i in range(3)]
+        lines.insert(1, 'not json')
+        lines.append('')
+        with self.settings(INGEST_BATCH_SIZE=2):
+            response = self.client.post(self.url, '\n'.join(lines), content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['accepted'], 3)
+        self.assertEqual(response.data['rejected'], 1)
+        self.assertEqual(response.data['errors'][0]['index'], 1)
+        self.assertEqual(SensorReading.objects.filter(device=self.device).count(), 3)
+
+    def test_single_ingest_url(self):
+        response = self.client.post(reverse('sensor-ingest'), self.make_payload('single-1'), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(SensorReading.objects.filter(deduplicationId='single-1').exists())
+
+
+class ReadingRollupTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(serial_number='ROLL123')
+        self.hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=3)
+
+    def create_reading(self, minutes, value):
+        return SensorReading.objects.create(
+            device=self.device, value=value, rssi=-60,
+            timestamp=self.hour + timedelta(minutes=minutes), deduplicationId=f'roll-{minutes}',
+        )
+
+    def test_incremental_rollups(self):
+        self.create_reading(10, 30)
+        self.create_reading(50, 10)
+        self.create_reading(20, 50)  # arrives late
+        hourly = HourlyReadingRollup.objects.get(device=self.device)
+        self.assertEqual(hourly.bucket, self.hour)
+        self.assertEqual((hourly.count, hourly.total, hourly.minimum, hourly.maximum), (3, 90, 10, 50))
+        self.assertEqual(hourly.last_value, 10)
+        self.assertEqual(DailyReadingRollup.objects.get(device=self.device).count, 3)
+
+    def test_bulk_ingest_updates_rollups(self):
+        uplinks = [
+            Uplink(f'roll-bulk-{i}', (self.hour + timedelta(minutes=i)).isoformat(), self.device.serial_number, str(i), -60)
+            for i in range(1, 5)
+        ]
+        store_uplinks(uplinks)
+        hourly = HourlyReadingRollup.objects.get(device=self.device)
+        self.assertEqual((hourly.count, hourly.total, hourly.last_value), (4, 10, 4))
+
+    def test_batch_writes_each_rollup_table_once(self):
+        from .rollups import add_readings
+        other = Device.objects.create(serial_number='ROLL456')
+        self.create_reading(10, 30)
+        readings = [
+            SensorReading(device=device, value=value, rssi=-60, timestamp=self.hour + timedelta(minutes=minutes))
+            for device, minutes, value in [
+                (other, 5, 1), (self.device, 70, 2), (self.device, 5, 70), (other, 6, 3),
+            ]
+        ]
+        with self.assertNumQueries(2 if connection.features.supports_update_conflicts_with_target else 10):
+            add_readings(readings)
+        hourly = HourlyReadingRollup.objects.order_by('device_id', 'bucket')
+        self.assertEqual(
+            [(r.device_id, r.count, r.total, r.minimum, r.maximum, r.last_value) for r in hourly],
+            [(self.device.pk, 2, 100, 30, 70, 30), (self.device.pk, 1, 2, 2, 2, 2), (other.pk, 2, 4, 1, 3, 3)],
+        )
+
+    def test_rebuild_matches_incremental(self):
+        self.create_reading(10, 30)
+        self.create_reading(70, 10)
+        HourlyReadingRollup.objects.all().update(count=99)
+        DailyReadingRollup.objects.all().delete()
+        call_command('rollupreadings', '--all', stdout=StringIO())
+        hourly = HourlyReadingRollup.objects.filter(device=self.device).order_by('bucket')
+        self.assertEqual([(r.count, r.total, r.last_value) for r in hourly], [(1, 30, 30), (1, 10, 10)])
+        daily = DailyReadingRollup.objects.filter(device=self.device)
+        self.assertEqual(sum(r.count for r in daily), 2)
+
+
+@override_settings(READING_RETENTION_DAYS=90, HOURLY_ROLLUP_RETENTION_DAYS=110, DAILY_ROLLUP_RETENTION_DAYS=0)
+class StreamAnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.clear()
+        self.device = Device.objects.create(serial_number='HEALTH1')
+        self.start = timezone.now().replace(microsecond=0) - timedelta(days=2)
+
+    def feed(self, stats, values, rssi=-70, start=0, interval=600):
+        return [
+            stats.update(value, rssi, start + i * interval)
+            for i, value in enumerate(values)
+        ]
+
+    def test_spike(self):
+        stats = analytics.StreamStats()
+        flags = self.feed(stats, [100, 104, 98, 102, 99, 101, 103, 97, 100, 102, 400, 101])
+        self.assertEqual([analytics.flag_names(f) for f in flags][-2:], [['spike'], []])
+        self.assertFalse(any(flags[:-2]))
+
+    def test_spike_needs_minimum_delta(self):
+        stats = analytics.StreamStats()
+        flags = self.feed(stats, [100] * 3 + [101] * 8 + [120])
+        self.assertFalse(flags[-1] & analytics.SPIKE)
+
+    def test_stuck(self):
+        with self.settings(ANALYTICS_STUCK_COUNT=4):
+            flags = self.feed(analytics.StreamStats(), [5, 7, 7, 7, 7, 7, 8])
+        self.assertEqual(flags, [0, 0, 0, 0, analytics.STUCK, analytics.STUCK, 0])
+
+    def test_gap(self):
+        stats = analytics.StreamStats()
+        self.feed(stats, [100 + i % 3 for i in range(12)])
+        self.assertEqual(stats.update(100, -70, 11 * 600 + 6 * 600), analytics.GAP)
+        self.assertEqual(stats.update(101, -70, 11 * 600 + 7 * 600), 0)
+        self.assertAlmostEqual(stats.interval, 600)
+
+    def test_rssi_degraded(self):
+        stats = analytics.StreamStats()
+        self.feed(stats, [100 + i % 3 for i in range(12)], rssi=-70)
+        flags = self.feed(stats, [100 + i % 3 for i in range(12)], rssi=-95, start=12 * 600)
+        self.assertTrue(flags[-1] & analytics.RSSI_DEGRADED)
+        self.assertFalse(flags[0] & analytics.RSSI_DEGRADED)
+
+    def test_out_of_order_reading_is_ignored(self):
+        stats = analytics.StreamStats()
+        self.feed(stats, [100, 101])
+        self.assertEqual(stats.update(500, -70, 0), 0)
+        self.assertEqual((stats.count, stats.last_value), (2, 101))
+
+    def uplink(self, i, value):
+        return Uplink(f'health-{i}', (self.start + timedelta(minutes=10 * i)).isoformat(), 'HEALTH1', str(value), -70)
+
+    def test_flags_are_stored(self):
+        values = [100, 104, 98, 102, 99, 101, 103, 97, 100, 102]
+        store_uplinks([self.uplink(i, value) for i, value in enumerate(values)])
+        process_message({
+            'deduplicationId': 'health-spike',
+            'time': (self.start + timedelta(minutes=100)).isoformat(),
+            'deviceInfo': {'devEui': 'HEALTH1'},
+            'object': {'hexdata': '400'},
+            'rxInfo': [{'rssi': -70}],
+        })
+        self.assertEqual(SensorReading.objects.get(deduplicationId='health-spike').flags, analytics.SPIKE)
+        self.assertEqual(SensorReading.objects.exclude(flags=0).count(), 1)
+        # A duplicate uplink does not move the summary on.
+        count = cache.get(analytics.cache_key(self.device.pk)).count
+        store_uplinks([self.uplink(3, 102)])
+        self.assertEqual(cache.get(analytics.cache_key(self.device.pk)).count, count)
+
+    def test_invalid_time(self):
+        with self.assertRaisesMessage(SensorException, 'Invalid time'):
+            process_message({
+                'deduplicationId': 'health-time',
+                'time': 'yesterday',
+                'deviceInfo': {'devEui': 'HEALTH1'},
+                'object': {'hexdata': '1'},
+                'rxInfo': [{'rssi': -70}],
+            })
+
+
+@override_settings(SENSOR_SILENCE_TIMEOUT=3 * 60 * 60)
+class SilentDeviceTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.user = create_test_user(username='silentuser', email='silent@example.com', password='silentpass')
+        self.other = create_test_user(username='otheruser', email='other@example.com', password='otherpass')
+        self.quiet = self.create_device('QUIET1', hours=5)
+        self.quiet.users.add(self.user, self.other)
+        self.busy = self.create_device('BUSY1', hours=1)
+        self.busy.users.add(self.user)
+        self.unused = Device.objects.create(serial_number='NEVER1')
+
+    def create_device(self, serial_number, hours):
+        return Device.objects.create(serial_number=serial_number, name=serial_number,
+                                     last_seen=self.now - timedelta(hours=hours))
+
+    def notify(self, *args):
+        output = StringIO()
+        call_command('notifysilentdevices', *args, stdout=output)
+        return output.getvalue()
+
+    def test_silent_device_notified_once(self):
+        self.assertEqual(self.notify(), '1 devices went silent, 0 came back\n')
+        emails = OutgoingEmail.objects.order_by('recipient')
+        self.assertEqual([email.recipient for email in emails], ['other@example.com', 'silent@example.com'])
+        self.assertEqual(emails[0].subject, 'Sensor Offline')
+        self.assertIn('QUIET1', emails[0].message)
+        self.quiet.refresh_from_db()
+        self.assertIsNotNone(self.quiet.silence_notified_at)
+
+        self.assertEqual(self.notify(), '0 devices went silent, 0 came back\n')
+        self.assertEqual(OutgoingEmail.objects.count(), 2)
+
+    def test_device_back_online(self):
+        self.notify()
+        process_message({
+            'deduplicationId': 'silent-back',
+            'time': timezone.now().isoformat(),
+            'deviceInfo': {'devEui': 'QUIET1'},
+            'object': {'hexdata': '10'},
+            'rxInfo': [{'rssi': -70}],
+        })
+        self.assertEqual(self.notify(), '0 devices went silent, 1 came back\n')
+        self.assertEqual(OutgoingEmail.objects.filter(subject='Sensor Back Online').count(), 2)
+        self.quiet.refresh_from_db()
+        self.assertIsNone(self.quiet.silence_notified_at)
+
+    def test_back_and_silent_again_between_runs(self):
+        self.assertEqual(silence.notify(now=self.now), (1, 0))
+        Device.objects.filter(pk=self.quiet.pk).update(last_seen=self.now + timedelta(minutes=1))
+        # Silent again (as is BUSY1) by the next run.
+        self.assertEqual(silence.notify(now=self.now + timedelta(hours=4)), (2, 1))
+        subjects = OutgoingEmail.objects.filter(recipient='other@example.com').values_list('subject', flat=True)
+        self.assertEqual(list(subjects.order_by('id')), ['Sensor Offline', 'Sensor Back Online', 'Sensor Offline'])
+
+    def test_batches(self):
+        for i in range(3):
+            self.create_device(f'QUIET{i + 2}', hours=4 + i)
+        with self.assertNumQueries(17):
+            # A transaction per batch of two: claim, subscribers, insert
+            # e-mails (skipped for devices without users), mark notified;
+            # plus the empty claims that end each pass.
+            silent, returned = silence.notify(batch_size=2)
+        self.assertEqual((silent, returned), (4, 0))
+        self.assertFalse(Device.objects.filter(last_seen__isnull=False, silence_notified_at__isnull=True)
+                         .exclude(pk=self.busy.pk).exists())
+        self.unused.refresh_from_db()
+        self.assertIsNone(self.unused.silence_notified_at)
+
+
+@override_settings(READING_RETENTION_DAYS=90, HOURLY_ROLLUP_RETENTION_DAYS=110, DAILY_ROLLUP_RETENTION_DAYS=0)
+class ReadingRetentionTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(serial_number='KEEP123')
+        self.noon = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0)
+
+    def create_reading(self, days, value, **kwargs):
+        reading = SensorReading(
+            device=self.device, value=value, rssi=-60,
+            timestamp=self.noon - timedelta(days=days), deduplicationId=f'keep-{days}-{value}',
+        )
+        if kwargs.get('backfill'):
+            SensorReading.objects.bulk_create([reading])  # no signals, so no rollups
+        else:
+            reading.save()
+        GatewayReception.objects.create(device=self.device, timestamp=reading.timestamp, gateway_id='gw', rssi=-60)
+        return reading
+
+    def daily_counts(self):
+        return dict(DailyReadingRollup.objects.filter(device=self.device).values_list('bucket', 'count'))
+
+    def compact(self, *args):
+        output = StringIO()
+        call_command('compactreadings', '--batch-size', '1', '--pause', '0', *args, stdout=output)
+        return output.getvalue()
+
+    def test_compact(self):
+        self.create_reading(100, 10)
+        self.create_reading(100, 20)
+        self.create_reading(120, 30, backfill=True)
+        self.create_reading(10, 40)
+        output = self.compact()
+        self.assertIn('rollup days rebuilt: 1, deleted: 3 readings, 3 receptions, 1 hourly and 0 daily rollups', output)
+        self.assertEqual(list(SensorReading.objects.values_list('value', flat=True)), [40])
+        self.assertEqual(GatewayReception.objects.count(), 1)
+        self.assertEqual(sorted(self.daily_counts().values()), [1, 1, 2])
+        day_120 = (self.noon - timedelta(days=120)).replace(hour=0)
+        self.assertEqual(self.daily_counts()[day_120], 1)
+        # Hourly rollups older than 110 days are gone, the others stay.
+        self.assertEqual(
+            sorted(HourlyReadingRollup.objects.filter(device=self.device).values_list('count', flat=True)), [1, 2],
+        )
+        self.assertIn('deleted: 0 readings', self.compact())
+
+    def test_dry_run(self):
+        self.create_reading(100, 10)
+        output = self.compact('--dry-run')
+        self.assertIn('would delete: 1 readings, 1 receptions', output)
+        self.assertEqual(SensorReading.objects.count(), 1)
+
+    def test_partially_deleted_day_is_not_rebuilt(self):
+        self.create_reading(100, 10)
+        reading = self.create_reading(100, 20)
+        SensorReading.objects.filter(pk=reading.pk).delete()  # as if a run stopped half way
+        self.compact()
+        self.assertEqual(list(self.daily_counts().values()), [2])
+
+    def test_rebuild_keeps_compacted_rollups(self):
+        self.create_reading(100, 10)
+        self.compact()
+        self.device.refresh_from_db()
+        last_seen = self.device.last_seen
+        output = StringIO()
+        call_command('rollupreadings', '--all', stdout=output)
+        self.assertIn('Rebuilding from', output.getvalue())
+        self.assertEqual(list(self.daily_counts().values()), [1])
+        self.device.refresh_from_db()
+        self.assertEqual((self.device.last_value, self.device.last_seen), (10, last_seen))
+
+    def test_keep_forever(self):
+        self.create_reading(100, 10)
+        with self.settings(READING_RETENTION_DAYS=0):
+            self.compact()
+        self.assertEqual(SensorReading.objects.count(), 1)
+
+
+@override_settings(DASHBOARD_CACHE_TTL=60)
 class DeviceDashboardTests(APITestCase):
     def setUp(self):
+        cache.clear()
+        registry.clear()
         self.user = create_test_user(username='dashuser', email='dash@example.com', password='dashpass')
         self.access_token = str(AccessToken.for_user(self.user))
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
@@ -294,6 +835,112 @@ class DeviceDashboardTests(APITestCase):
         self.assertEqual(response.data['averages']['30_days'], 25.0)
         self.assertEqual(len(response.data['trend']), 4)
 
+    def test_dashboard_statistics(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['statistics'], {'minimum': 10, 'maximum': 40, 'count': 4})
+
+    def test_dashboard_statistics_from_readings(self):
+        with self.settings(DASHBOARD_USE_ROLLUPS=False):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['averages']['24_hours'], 10.0)
+        self.assertEqual(response.data['averages']['7_days'], 15.0)
+        self.assertEqual(response.data['averages']['30_days'], 25.0)
+        self.assertEqual(response.data['statistics'], {'minimum': 10, 'maximum': 40, 'count': 4})
+
+    def test_dashboard_query_count(self):
+        now = timezone.now()
+        SensorReading.objects.bulk_create(
+            SensorReading(device=self.device, value=i, rssi=60, timestamp=now - timedelta(minutes=i), deduplicationId=f'dash-q-{i}')
+            for i in range(50)
+        )
+        for use_rollups in (True, False):
+            with self.settings(DASHBOARD_USE_ROLLUPS=use_rollups, DASHBOARD_CACHE_TTL=0), self.assertNumQueries(5):
+                response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_dashboard_cached(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        with self.assertNumQueries(2):  # the user, for authentication, and the device
+            response = self.client.get(self.url)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.data['recent_reading']['value'], 10)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(response.content)
+        response = self.client.get(self.url, {'max_points': 3}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_dashboard_invalidated_by_new_reading(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            process_message({
+                'deduplicationId': 'dash-new',
+                'time': timezone.now().isoformat(),
+                'deviceInfo': {'devEui': self.device.serial_number},
+                'object': {'hexdata': '55'},
+                'rxInfo': [{'rssi': -60}],
+            })
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['recent_reading']['value'], 55)
+
+    def test_dashboard_access_removed(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.device.users.remove(self.user)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_dashboard_access_removed_while_cached(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        # As another process would: the registry and the cache know nothing.
+        Device.users.through.objects.filter(device=self.device, user=self.user).delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_dashboard_cache_needs_shared_cache(self):
+        from .checks import check_dashboard_cache
+        self.assertEqual([error.id for error in check_dashboard_cache(None)], ['core.E001'])
+        with self.settings(DASHBOARD_CACHE_TTL=0):
+            self.assertEqual(check_dashboard_cache(None), [])
+
+    def test_dashboard_trend_downsampling(self):
+        now = timezone.now()
+        SensorReading.objects.bulk_create(
+            SensorReading(device=self.device, value=i % 7, rssi=60, timestamp=now - timedelta(minutes=i), deduplicationId=f'dash-t-{i}')
+            for i in range(1, 301)
+        )
+        rebuild_rollups()
+        response = self.client.get(self.url, {'max_points': 50})
+        self.assertEqual(response.data['trend_resolution'], 'day')
+        self.assertLessEqual(len(response.data['trend']), 50)
+        response = self.client.get(self.url, {'resolution': 'hour', 'max_points': 3})
+        self.assertEqual(response.data['trend_resolution'], 'hour')
+        self.assertEqual(len(response.data['trend']), 3)
+        response = self.client.get(self.url, {'resolution': 'raw', 'max_points': 10})
+        trend = response.data['trend']
+        self.assertEqual(len(trend), 10)
+        self.assertEqual(trend[0]['value'], 40)
+        self.assertEqual(trend[-1]['value'], 1)
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['trend_resolution'], 'raw')
+        self.assertEqual(len(response.data['trend']), 304)
+
+    def test_dashboard_invalid_trend_params(self):
+        response = self.client.get(self.url, {'resolution': 'week'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url, {'max_points': 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_lttb(self):
+        points = [(x, x % 5) for x in range(100)]
+        sampled = dashboard.lttb(points, 10)
+        self.assertEqual(len(sampled), 10)
+        self.assertEqual(sampled[0], points[0])
+        self.assertEqual(sampled[-1], points[-1])
+        self.assertEqual(dashboard.lttb(points[:5], 10), points[:5])
+
     def test_dashboard_device_not_found(self):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.access_token)
         url = reverse('device-dashboard', args=['NOTFOUND'])
@@ -306,3 +953,748 @@ class DeviceDashboardTests(APITestCase):
         self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + other_access_token)
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 404)
+
+
+class ReadingPartitionTests(TestCase):
+    def test_month_helpers(self):
+        from datetime import date
+        self.assertEqual(partitions.add_months(date(2025, 11, 1), 3), date(2026, 2, 1))
+        self.assertEqual(partitions.add_months(date(2025, 1, 1), -1), date(2024, 12, 1))
+        name = partitions.partition_name(date(2025, 7, 1))
+        self.assertEqual(name, 'core_sensorreading_p2025_07')
+        self.assertEqual(partitions.partition_start(name), date(2025, 7, 1))
+        self.assertIsNone(partitions.partition_start('core_sensorreading_default'))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Partitioning requires PostgreSQL')
+    def test_convert_and_maintain_partitions(self):
+        device = Device.objects.create(serial_number='PART123')
+        now = timezone.now()
+        old = SensorReading.objects.create(device=device, value=1, rssi=-60, timestamp=now - timedelta(days=400), deduplicationId='part-1')
+        call_command('partitionreadings', '--convert', '--months-ahead', '2', stdout=StringIO())
+        self.assertTrue(partitions.is_partitioned(connection))
+        self.assertEqual(SensorReading.objects.get(deduplicationId='part-1').pk, old.pk)
+        reading = SensorReading.objects.create(device=device, value=2, rssi=-60, timestamp=now, deduplicationId='part-2')
+        self.assertGreater(reading.pk, old.pk)
+        names = partitions.list_partitions(connection)
+        self.assertIn(partitions.partition_name(partitions.add_months(now.date(), 2)), names)
+        call_command('partitionreadings', '--detach-older-than', '6', '--drop', stdout=StringIO())
+        self.assertFalse(SensorReading.objects.filter(deduplicationId='part-1').exists())
+        self.assertTrue(SensorReading.objects.filter(deduplicationId='part-2').exists())
+        # A reading past the created months lands in the default partition
+        # and moves when its month is created.
+        later = partitions.add_months(now.date(), 8)
+        SensorReading.objects.create(device=device, value=3, rssi=-60, deduplicationId='part-3',
+                                     timestamp=now.replace(year=later.year, month=later.month, day=1))
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {partitions.default_partition_name()}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(partitions.create_partitions(connection, later, 1), [partitions.partition_name(later)])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {partitions.partition_name(later)}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(SensorReading.objects.filter(deduplicationId='part-3').count(), 1)
+
+    @skipUnless(connection.vendor != 'postgresql', 'Checks the non-PostgreSQL guard')
+    def test_requires_postgresql(self):
+        with self.assertRaises(CommandError):
+            call_command('partitionreadings', stdout=StringIO())
+
+
+class DeviceReadingsTests(APITestCase):
+    def setUp(self):
+        self.user = create_test_user(username='readuser', email='read@example.com', password='readpass')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(AccessToken.for_user(self.user)))
+        self.device = Device.objects.create(serial_number='READ123')
+        self.device.users.add(self.user)
+        self.url = reverse('device-readings', args=[self.device.serial_number])
+        self.start = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        # Pairs of readings share a timestamp to exercise the id tie-breaker.
+        SensorReading.objects.bulk_create(
+            SensorReading(device=self.device, value=i, rssi=-i, timestamp=self.start + timedelta(minutes=i // 2), deduplicationId=f'read-{i}')
+            for i in range(10)
+        )
+
+    def test_pages_with_cursor(self):
+        values = []
+        params = {'limit': 3}
+        while True:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['timestamps']), len(response.data['values']))
+            values.extend(response.data['values'])
+            if not response.data['next_cursor']:
+                break
+            params['cursor'] = response.data['next_cursor']
+        self.assertEqual(values, list(range(10)))
+        response = self.client.get(self.url, {'limit': 1})
+        self.assertEqual(response.data['timestamps'], [int(self.start.timestamp() * 1000)])
+        self.assertEqual(response.data['rssi'], [0])
+        self.assertEqual(response.data['flags'], [[]])
+
+    def test_time_range(self):
+        params = {'from': (self.start + timedelta(minutes=1)).isoformat(), 'to': (self.start + timedelta(minutes=3)).isoformat()}
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.data['values'], [2, 3, 4, 5])
+        self.assertIsNone(response.data['next_cursor'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.data)
+
+    def test_other_users_device(self):
+        other_user = create_test_user(username='otherread', email='otherread@example.com', password='otherpass')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + str(AccessToken.for_user(other_user)))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+class ReadingsExportTests(APITestCase):
+    def setUp(self):
+        self.user = create_test_user(username='exportuser', email='export@example.com', password='exportpass')
+        self.authorization = 'Bearer ' + str(AccessToken.for_user(self.user))
+        self.client.credentials(HTTP_AUTHORIZATION=self.authorization)
+        self.devices = [Device.objects.create(serial_number=f'EXP{i}') for i in range(2)]
+        self.user.devices.add(*self.devices)
+        start = timezone.now() - timedelta(hours=1)
+        SensorReading.objects.bulk_create(
+            SensorReading(device=device, value=i, rssi=-60, timestamp=start + timedelta(minutes=i), deduplicationId=f'exp-{device.pk}-{i}')
+            for device in self.devices for i in range(5)
+        )
+
+    def get_export(self, *args):
+        response = self.client.get(reverse(args[0], args=args[1:]))
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_csv_export(self):
+        with self.settings(EXPORT_CHUNK_SIZE=2):
+            response, content = self.get_export('device-readings-export', 'EXP0', 'csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('EXP0.csv', response['Content-Disposition'])
+        rows = list(csv.reader(StringIO(content.decode())))
+        self.assertEqual(rows[0], ['serial_number', 'timestamp', 'value', 'rssi', 'deduplicationId'])
+        self.assertEqual([row[2] for row in rows[1:]], ['0.0', '1.0', '2.0', '3.0', '4.0'])
+
+    def test_ndjson_account_export(self):
+        response, content = self.get_export('readings-export', 'ndjson')
+        records = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(len(records), 10)
+        self.assertEqual({r['serial_number'] for r in records}, {'EXP0', 'EXP1'})
+
+    @skipUnless(export.parquet_available(), 'pyarrow is not installed')
+    def test_parquet_export(self):
+        import pyarrow.parquet as pq
+        with self.settings(EXPORT_CHUNK_SIZE=3):
+            response, content = self.get_export('device-readings-export', 'EXP1', 'parquet')
+        table = pq.read_table(BytesIO(content))
+        self.assertEqual(table.column('value').to_pylist(), [0, 1, 2, 3, 4])
+        self.assertEqual(pq.ParquetFile(BytesIO(content)).num_row_groups, 2)
+
+    async def test_asgi_export_streams(self):
+        response = await AsyncClient().get(reverse('readings-export', args=['ndjson']), headers={'Authorization': self.authorization})
+        self.assertEqual(response.status_code, 200)
+        # An async iterator, so ASGI sends it chunk by chunk instead of buffering it.
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(content.decode().splitlines()), 10)
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse('readings-export', args=['xml']))
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_command(self):
+        with TemporaryDirectory() as output_dir:
+            call_command('exportreadings', output_dir, '--format', 'ndjson', '--device', 'EXP1', stdout=StringIO())
+            self.assertEqual(os.listdir(output_dir), ['EXP1.ndjson'])
+            with open(os.path.join(output_dir, 'EXP1.ndjson')) as f:
+                self.assertEqual(len(f.readlines()), 5)
+
+
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        alerts.cache.clear()
+        registry.clear()
+
+    def test_queued_until_delivered(self):
+        queue_email('Subject', 'Body', ['a@example.com', 'b@example.com'])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(deliver_queued_emails(), (2, 0))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['a@example.com', 'b@example.com'])
+        self.assertEqual(OutgoingEmail.objects.filter(status=OutgoingEmail.SENT).count(), 2)
+        self.assertEqual(deliver_queued_emails(), (0, 0))
+
+    def test_reuses_one_connection(self):
+        queue_email('Subject', 'Body', [f'user{i}@example.com' for i in range(5)])
+        with mock.patch('core.outbox.get_connection', wraps=get_connection) as get_connection_mock:
+            self.assertEqual(deliver_queued_emails(), (5, 0))
+        self.assertEqual(get_connection_mock.call_count, 1)
+
+    def test_retries_with_backoff(self):
+        queue_email('Subject', 'Body', ['a@example.com'])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            self.assertEqual(deliver_queued_emails(), (0, 1))
+        email = OutgoingEmail.objects.get()
+        self.assertEqual((email.status, email.attempts, email.last_error), (OutgoingEmail.PENDING, 1, 'down'))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual(deliver_queued_emails(), (0, 0))
+        OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_queued_emails(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_connection_failure_counts_as_attempt(self):
+        queue_email('Subject', 'Body', ['a@example.com', 'b@example.com'])
+        OutgoingEmail.objects.filter(recipient='b@example.com').update(attempts=settings.EMAIL_OUTBOX_MAX_ATTEMPTS - 1)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.open', side_effect=OSError('refused')):
+            self.assertEqual(deliver_queued_emails(), (0, 2))
+        emails = {email.recipient: email for email in OutgoingEmail.objects.all()}
+        self.assertEqual((emails['a@example.com'].status, emails['a@example.com'].attempts), (OutgoingEmail.PENDING, 1))
+        self.assertGreater(emails['a@example.com'].next_attempt_at, timezone.now())
+        self.assertEqual(emails['b@example.com'].status, OutgoingEmail.FAILED)
+        self.assertEqual(emails['b@example.com'].last_error, 'refused')
+
+    def test_gives_up_after_max_attempts(self):
+        queue_email('Subject', 'Body', ['a@example.com'])
+        OutgoingEmail.objects.update(attempts=settings.EMAIL_OUTBOX_MAX_ATTEMPTS - 1)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            deliver_queued_emails()
+        self.assertEqual(OutgoingEmail.objects.get().status, OutgoingEmail.FAILED)
+
+    def test_alert_is_queued_not_sent(self):
+        user = create_test_user(username='outboxuser', email='outbox@example.com', password='outboxpass')
+        device = Device.objects.create(serial_number='OUTBOX1')
+        device.users.add(user)
+        process_message({
+            "deduplicationId": "outbox-1",
+            "time": timezone.now().isoformat(),
+            "deviceInfo": {"devEui": device.serial_number},
+            "object": {"hexdata": "201"},
+            "rxInfo": [{"rssi": -64}],
+        })
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingEmail.objects.get().recipient, 'outbox@example.com')
+
+
+class AlertStateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        alerts.cache.clear()
+        registry.clear()
+        self.user = create_test_user(username='stateuser', email='state@example.com', password='statepass')
+        self.device = Device.objects.create(serial_number='STATE1', name='Cellar')
+        self.device.users.add(self.user)
+        self.count = 0
+
+    def ingest(self, hexdata):
+        self.count += 1
+        process_message({
+            "deduplicationId": f"state-{self.count}",
+            "time": (timezone.now() + timedelta(seconds=self.count)).isoformat(),
+            "deviceInfo": {"devEui": self.device.serial_number},
+            "object": {"hexdata": hexdata},
+            "rxInfo": [{"rssi": -64}],
+        })
+        deliver_queued_emails()
+        subjects = [m.subject for m in mail.outbox]
+        mail.outbox.clear()
+        return subjects
+
+    def test_mails_only_on_transitions(self):
+        self.assertEqual(self.ingest('100'), [])
+        self.assertEqual(self.ingest('160'), ['Sensor Warning'])
+        self.assertEqual(self.ingest('170'), [])
+        self.assertEqual(self.ingest('210'), ['Sensor Alert - Action Needed'])
+        self.assertEqual(self.ingest('220'), [])
+        self.assertEqual(self.ingest('160'), [])
+        self.assertEqual(self.ingest('100'), ['Sensor Recovered'])
+        self.assertEqual(self.ingest('100'), [])
+        self.assertEqual(self.ingest('210'), ['Sensor Alert - Action Needed'])
+
+    def test_reminder_after_cooldown(self):
+        with self.settings(SENSOR_ALERT_COOLDOWN=60):
+            self.assertEqual(alerts.transition(1, alerts.ALERT, now=1000), alerts.ALERT)
+            self.assertIsNone(alerts.transition(1, alerts.ALERT, now=1030))
+            self.assertEqual(alerts.transition(1, alerts.ALERT, now=1061), alerts.ALERT)
+            self.assertIsNone(alerts.transition(1, alerts.WARNING, now=1062))
+            self.assertEqual(alerts.transition(1, alerts.WARNING, now=1121), alerts.WARNING)
+
+    def test_older_readings_do_not_move_state(self):
+        self.assertEqual(alerts.transition(1, alerts.ALERT, now=1000, reading_at=500), alerts.ALERT)
+        self.assertIsNone(alerts.transition(1, alerts.OK, now=1001, reading_at=400))
+        self.assertEqual(alerts.transition(1, alerts.OK, now=1002, reading_at=600), alerts.RECOVERED)
+        self.assertIsNone(alerts.transition(1, alerts.ALERT, now=1003, reading_at=550))
+        # Nothing is written while the state stays the same.
+        self.assertIsNone(alerts.transition(1, alerts.OK, now=1004, reading_at=700))
+        self.assertEqual(alerts.cache.get(alerts.cache_key(1)), (alerts.OK, 1002, 600))
+
+    def test_threshold_overrides(self):
+        other = create_test_user(username='stateuser2', email='state2@example.com', password='statepass')
+        self.device.users.add(other)
+        self.device.warning_threshold = 50
+        self.device.save()
+        other.profile.alert_threshold = 100
+        other.profile.save()
+        self.assertEqual(sorted(self.ingest('120')), ['Sensor Alert - Action Needed', 'Sensor Warning'])
+        emails = {email.recipient: email for email in OutgoingEmail.objects.all()}
+        self.assertEqual(emails['state@example.com'].subject, 'Sensor Warning')
+        self.assertIn('threshold 50', emails['state@example.com'].message)
+        self.assertEqual(emails['state2@example.com'].subject, 'Sensor Alert - Action Needed')
+        self.assertIn('threshold 100', emails['state2@example.com'].message)
+        # Each group of users keeps its own state.
+        self.assertEqual(self.ingest('120'), [])
+        self.assertEqual(self.ingest('40'), ['Sensor Recovered', 'Sensor Recovered'])
+
+    def test_rules_are_resolved_once(self):
+        self.user.profile.warning_threshold = 90
+        self.user.profile.save()
+        self.assertEqual(registry.get_alert_rules(self.device), (alerts.AlertRule(90, None, ('state@example.com',)),))
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_alert_rules(self.device)[0].thresholds(), (90, 200))
+        self.user.profile.warning_threshold = None
+        self.user.profile.save()
+        self.assertEqual(registry.get_alert_rules(self.device)[0].thresholds(), (150, 200))
+
+    def test_thresholds_come_in_pairs(self):
+        self.device.warning_threshold = 50
+        self.device.alert_threshold = 80
+        self.device.save()
+        self.user.profile.alert_threshold = 300
+        self.user.profile.save()
+        # The user's pair, not their alert threshold with the device's warning.
+        self.assertEqual(registry.get_alert_rules(self.device)[0].thresholds(), (150, 300))
+        self.user.profile.alert_threshold = 100
+        self.user.profile.save()
+        self.assertEqual(registry.get_alert_rules(self.device)[0].thresholds(), (100, 100))
+
+    def test_state_is_not_read_from_database(self):
+        self.ingest('210')
+        reading = SensorReading.objects.create(device=self.device, value=220, rssi=-60, timestamp=timezone.now(), deduplicationId='state-db')
+        with self.assertNumQueries(0):
+            from .sensor import notify_users
+            notify_users(self.device, reading.value)
+
+
+class DeviceRegistryTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.user = create_test_user(username='reguser', email='reg@example.com', password='regpass')
+        self.device = Device.objects.create(serial_number='REG1', name='Attic')
+        self.device.users.add(self.user)
+
+    def test_devices_are_cached(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(registry.get_device('REG1'), self.device)
+            self.assertIsNone(registry.get_device('UNKNOWN'))
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_device('REG1'), self.device)
+            self.assertIsNone(registry.get_device('UNKNOWN'))
+
+    def test_device_changes_invalidate(self):
+        self.assertIsNone(registry.get_device('REG2'))
+        other = Device.objects.create(serial_number='REG2', name='Basement')
+        self.assertEqual(registry.get_device('REG2'), other)
+        registry.get_device('REG1')
+        self.device.serial_number = 'REG3'
+        self.device.save()
+        self.assertIsNone(registry.get_device('REG1'))
+        self.assertEqual(registry.get_device('REG3').serial_number, 'REG3')
+        other.delete()
+        self.assertIsNone(registry.get_device('REG2'))
+
+    def test_subscribers_are_cached_and_invalidated(self):
+        other_user = create_test_user(username='reguser2', email='reg2@example.com', password='regpass')
+        with self.assertNumQueries(1):
+            self.assertEqual(registry.get_subscribers(self.device), ['reg@example.com'])
+        with self.assertNumQueries(0):
+            registry.get_subscribers(self.device)
+        self.device.users.add(other_user)
+        self.assertEqual(registry.get_subscribers(self.device), ['reg@example.com', 'reg2@example.com'])
+        other_user.profile.alert_email_enabled = False
+        other_user.profile.save()
+        self.assertEqual(registry.get_subscribers(self.device), ['reg@example.com'])
+        self.user.emailaddress_set.update(verified=False)  # bypasses signals
+        self.assertEqual(registry.get_subscribers(self.device), ['reg@example.com'])
+        self.user.emailaddress_set.get().save()
+        self.assertEqual(registry.get_subscribers(self.device), [])
+
+    def test_entries_expire_and_are_evicted(self):
+        lru = LRUCache(maxsize=2, ttl=60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')), (1, None, 3))
+        with mock.patch('core.registry.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(lru.get('a'))
+
+
+class UplinkDecoderTests(TestCase):
+    def setUp(self):
+        self.payload = decoding.sample_payload()
+        self.names = decoders.available_decoders()
+
+    def test_decoders_agree(self):
+        expected = Uplink(
+            deduplicationId='04fae026-fc08-4704-bc96-a0291992d58c',
+            time='2025-07-07T11:10:50.263380+00:00',
+            devEui='0123456789abcd11',
+            hexdata='23',
+            rssi=-64,
+            receptions=(Reception('a84041ffff24a7c0', -64, 14.2), Reception('40d63cfffe851125', -81, 13.5)),
+        )
+        variants = [
+            self.payload,
+            json.dumps({'deduplicationId': 'x', 'rxInfo': []}).encode(),
+            json.dumps({'deduplicationId': 'x', 'object': {'hexdata': 23}, 'rxInfo': [{'snr': 1}]}).encode(),
+        ]
+        for name in self.names:
+            decode = decoders.get_decoder(name)
+            with self.subTest(decoder=name):
+                self.assertEqual(decode(self.payload), expected)
+                for payload in variants:
+                    self.assertEqual(decode(payload), decoders.decode_json(payload))
+
+    def test_invalid_payloads(self):
+        for name in self.names:
+            decode = decoders.get_decoder(name)
+            for payload in (b'not json', b'[1, 2]', b'{"object": null}'):
+                with self.subTest(decoder=name, payload=payload), self.assertRaises(SensorException):
+                    decode(payload)
+
+    def test_get_decoder(self):
+        with self.settings(UPLINK_DECODER='auto'):
+            self.assertIs(decoders.get_decoder(), decoders.DECODERS[self.names[0]])
+        with self.settings(UPLINK_DECODER='json'):
+            self.assertIs(decoders.get_decoder(), decoders.decode_json)
+        with self.assertRaises(ValueError):
+            decoders.get_decoder('yaml')
+
+    def test_benchmark_runs(self):
+        results = decoding.benchmark(number=10, repeat=1)
+        self.assertEqual(set(results), {'baseline', *self.names})
+
+
+class BenchmarkSuiteTests(TestCase):
+    def test_generator(self):
+        start = timezone.now()
+        events = list(generator.generate_events(400, devices=4, duplicate_rate=0.1, crossing_rate=0.2, seed=1, start=start))
+        self.assertEqual(len(events), 400)
+        self.assertEqual(len({event['deviceInfo']['devEui'] for event in events}), 4)
+        unique = {event['deduplicationId'] for event in events}
+        self.assertTrue(300 < len(unique) < 400)
+        high = [event for event in events if int(event['object']['hexdata']) > settings.SENSOR_WARNING_THRESHOLD]
+        self.assertTrue(40 < len(high) < 120)
+        self.assertEqual(events, list(generator.generate_events(400, devices=4, duplicate_rate=0.1, crossing_rate=0.2, seed=1, start=start)))
+
+    def test_run(self):
+        report = suite.run(events=30, devices=3, dashboard_rows=[200], dashboard_repeat=2)
+        self.assertEqual(report['meta']['database'], connection.vendor)
+        results = {result['benchmark']: result for result in report['results']}
+        self.assertEqual(set(results), set(suite.BENCHMARKS))
+        self.assertEqual(results['http_ingest']['statuses'], {201: 30})
+        self.assertEqual(results['dashboard']['status'], 200)
+        self.assertEqual(SensorReading.objects.filter(device__serial_number='dash200').count(), 200)
+        json.dumps(report)
+        # Again on the same database, as with runbenchmarks --keepdb.
+        report = suite.run(events=30, devices=3, dashboard_rows=[200], dashboard_repeat=2)
+        results = {result['benchmark']: result for result in report['results']}
+        self.assertEqual(results['http_ingest']['statuses'], {201: 30})
+        self.assertEqual(SensorReading.objects.filter(device__serial_number='dash200').count(), 200)
+
+
+class GatewayReceptionTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.device = Device.objects.create(serial_number='GW1', name='Garage')
+        self.other = Device.objects.create(serial_number='GW2', name='Shed')
+
+    def event(self, deduplicationId, rx_info, devEui='GW1'):
+        return {
+            'deduplicationId': deduplicationId,
+            'time': timezone.now().isoformat(),
+            'deviceInfo': {'devEui': devEui},
+            'object': {'hexdata': '42'},
+            'rxInfo': rx_info,
+        }
+
+    def test_gateway_selection(self):
+        rx_info = [
+            {'gatewayId': 'gw-a', 'rssi': -90, 'snr': 12.0},
+            {'gatewayId': 'gw-b', 'rssi': -60, 'snr': 2.0},
+            {'gatewayId': 'gw-c', 'rssi': -75},
+        ]
+        payload = json.dumps(self.event('sel-1', rx_info)).encode()
+        for selection, rssi in (('first', -90), ('rssi', -60), ('snr', -90)):
+            with self.settings(SENSOR_GATEWAY_SELECTION=selection):
+                for name in decoders.available_decoders():
+                    with self.subTest(selection=selection, decoder=name):
+                        self.assertEqual(decoders.get_decoder(name)(payload).rssi, rssi)
+
+    def test_receptions_are_stored(self):
+        process_message(self.event('rx-1', [
+            {'gatewayId': 'gw-a', 'rssi': -90, 'snr': 12.0},
+            {'gatewayId': 'gw-b', 'rssi': -60, 'snr': 2.0},
+            {'rssi': -70},
+        ]))
+        uplinks = [
+            decoders.decode_json(json.dumps(self.event(f'rx-{i}', [{'gatewayId': 'gw-b', 'rssi': -65}], devEui='GW2')).encode())
+            for i in range(2, 5)
+        ]
+        store_uplinks(uplinks)
+        self.assertEqual(GatewayReception.objects.count(), 5)
+        stats = gateways.coverage()
+        self.assertEqual([row['gateway_id'] for row in stats], ['gw-b', 'gw-a'])
+        self.assertEqual(stats[0]['receptions'], 4)
+        self.assertEqual(stats[0]['devices'], 2)
+        self.assertEqual((stats[0]['min_rssi'], stats[0]['max_rssi']), (-65, -60))
+        self.assertEqual(gateways.coverage(devices=[self.device])[0]['receptions'], 1)
+        self.assertEqual(gateways.coverage(since=timezone.now() + timedelta(hours=1)), [])
+
+    def test_receptions_can_be_disabled(self):
+        with self.settings(STORE_GATEWAY_RECEPTIONS=False):
+            process_message(self.event('rx-off', [{'gatewayId': 'gw-a', 'rssi': -90}]))
+        self.assertTrue(SensorReading.objects.filter(deduplicationId='rx-off').exists())
+        self.assertFalse(GatewayReception.objects.exists())
+
+
+class UplinkArchiveTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def payload(self, i, devEui='ARCH1'):
+        return json.dumps({
+            'deduplicationId': f'arch-{i}',
+            'time': (timezone.now() - timedelta(minutes=i)).isoformat(),
+            'deviceInfo': {'devEui': devEui},
+            'object': {'hexdata': str(i)},
+            'rxInfo': [{'gatewayId': 'gw-a', 'rssi': -70}],
+        }).encode()
+
+    def write(self, compression='gzip', count=25, **kwargs):
+        uplink_archive = archive.UplinkArchive(
+            self.tmp.name, compression=compression, block_records=4, flush_interval=3600, **kwargs,
+        )
+        for i in range(count):
+            uplink_archive.append(self.payload(i), received_at=1000.0 + i)
+        uplink_archive.append(b'not json', received_at=1000.0 + count)
+        uplink_archive.close()
+
+    def read_all(self, **kwargs):
+        return [
+            record
+            for segment in archive.list_segments(self.tmp.name)
+            for record in archive.read_segment(segment, **kwargs)
+        ]
+
+    def test_round_trip_with_rotation(self):
+        self.write(segment_bytes=600)
+        segments = archive.list_segments(self.tmp.name)
+        self.assertGreater(len(segments), 1)
+        self.assertTrue(all(entry.records <= 4 for segment in segments for entry in archive.read_index(segment)))
+        records = self.read_all()
+        self.assertEqual([received_at for received_at, _ in records], [1000.0 + i for i in range(26)])
+        self.assertEqual(json.loads(records[3][1])['deduplicationId'], 'arch-3')
+        self.assertEqual(records[-1][1], b'not json')
+        self.assertEqual([r for r, _ in self.read_all(since=1009.0, until=1013.0)], [1009.0, 1010.0, 1011.0, 1012.0])
+
+    @skipUnless(importlib.util.find_spec('zstandard'), 'zstandard not installed')
+    def test_zstd(self):
+        self.write(compression='zstd', count=10)
+        self.assertEqual(len(self.read_all()), 11)
+
+    def test_replay_after_registering(self):
+        self.write(count=12)
+        out = StringIO()
+        call_command('replayuplinks', self.tmp.name, stdout=out)
+        self.assertIn('read: 13, undecodable: 1, stored: 0, duplicates: 0, unregistered: 12', out.getvalue())
+        device = Device.objects.create(serial_number='ARCH1', name='Archived')
+        device.users.add(create_test_user(username='archuser', email='arch@example.com', password='archpass'))
+        out = StringIO()
+        with self.settings(SENSOR_WARNING_THRESHOLD=5):
+            call_command('replayuplinks', self.tmp.name, '--batch-size', '5', stdout=out)
+        self.assertIn('stored: 12', out.getvalue())
+        # Historic readings do not alert.
+        self.assertFalse(OutgoingEmail.objects.exists())
+        self.assertEqual(SensorReading.objects.filter(device__serial_number='ARCH1').count(), 12)
+        out = StringIO()
+        call_command('replayuplinks', self.tmp.name, '--since', '1970-01-01T00:16:50+00:00', stdout=out)
+        self.assertIn('read: 3, undecodable: 1, stored: 0, duplicates: 2', out.getvalue())
+
+
+class MetricsTests(APITestCase):
+    def setUp(self):
+        registry.clear()
+        self.user = create_test_user(username='metricsuser', email='metrics@example.com', password='metricspass')
+        self.device = Device.objects.create(serial_number='MET1', name='Loft')
+        self.device.users.add(self.user)
+
+    def value(self, metric, *labels):
+        return metric.labels(*labels).value if labels else metric._children[()].value
+
+    def test_render(self):
+        histogram = metrics.Histogram('test_render_seconds', 'Test histogram.', buckets=(0.1, 1))
+        self.addCleanup(metrics.REGISTRY.remove, histogram)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = histogram.render()
+        self.assertIn('# TYPE test_render_seconds histogram', lines)
+        self.assertIn('test_render_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_render_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_render_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_render_seconds_count 3', lines)
+
+    def test_ingest_counters(self):
+        stored = self.value(metrics.UPLINKS_STORED)
+        duplicates = self.value(metrics.UPLINKS_DUPLICATE)
+        unregistered = self.value(metrics.UPLINKS_UNREGISTERED)
+        calls = metrics.PROCESS_MESSAGE_SECONDS._children[()].count
+        queries = self.value(metrics.DB_QUERIES, 'process_message')
+        event = {
+            'deduplicationId': 'met-1',
+            'time': timezone.now().isoformat(),
+            'deviceInfo': {'devEui': 'MET1'},
+            'object': {'hexdata': '10'},
+            'rxInfo': [{'rssi': -60}],
+        }
+        process_message(event)
+        process_message(event)
+        process_message(dict(event, deduplicationId='met-2', deviceInfo={'devEui': 'NOPE'}))
+        self.assertEqual(self.value(metrics.UPLINKS_STORED), stored + 1)
+        self.assertEqual(self.value(metrics.UPLINKS_DUPLICATE), duplicates + 1)
+        self.assertEqual(self.value(metrics.UPLINKS_UNREGISTERED), unregistered + 1)
+        self.assertEqual(metrics.PROCESS_MESSAGE_SECONDS._children[()].count, calls + 3)
+        self.assertGreater(self.value(metrics.DB_QUERIES, 'process_message'), queries)
+
+    def test_query_timer_leaves_callers_wrappers_alone(self):
+        calls = []
+
+        def spy(execute, sql, params, many, context):
+            calls.append(sql)
+            return execute(sql, params, many, context)
+
+        other = connections.create_connection('default')
+        self.addCleanup(other.close)
+        with other.execute_wrapper(spy):
+            other.ensure_connection()  # installs the query timer
+        self.assertEqual(other.execute_wrappers, [metrics._timed_execute])
+        with other.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertEqual(calls, [])
+
+    def test_worker_endpoint(self):
+        from urllib.error import HTTPError
+        from urllib.request import Request as UrlRequest, urlopen
+        server = metrics.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host, port = server.server_address
+        self.assertEqual(host, '127.0.0.1')
+        url = f'http://{host}:{port}/metrics'
+        with self.settings(METRICS_API_KEY='secret'):
+            with self.assertRaises(HTTPError) as raised:
+                urlopen(url, timeout=5)
+            self.assertEqual(raised.exception.code, 401)
+            with urlopen(UrlRequest(url, headers={'Authorization': 'Bearer secret'}), timeout=5) as response:
+                self.assertIn(b'radon_uplinks_stored_total', response.read())
+
+    def test_endpoint(self):
+        self.client.force_authenticate(self.user)
+        self.client.get(reverse('device-dashboard', args=['MET1']))
+        url = reverse('metrics')
+        with self.settings(METRICS_API_KEY=''):
+            self.assertEqual(self.client.get(url).status_code, 404)
+        with self.settings(METRICS_API_KEY='secret'):
+            self.assertEqual(self.client.get(url).status_code, 401)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            response = self.client.get(url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('radon_uplinks_stored_total', body)
+        self.assertRegex(body, r'radon_request_seconds_count\{view="dashboard"\} [1-9]')
+        self.assertRegex(body, r'radon_db_seconds_count\{operation="dashboard"\} [1-9]')
+
+
+@override_settings(LIVE_READINGS_NOTIFY=False)
+class LiveReadingStreamTests(TestCase):
+    def setUp(self):
+        registry.clear()
+        self.user = create_test_user(username='liveuser', email='live@example.com', password='livepass')
+        self.device = Device.objects.create(serial_number='LIVE1')
+        self.device.users.add(self.user)
+        self.url = reverse('device-reading-stream', args=['LIVE1'])
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def event(self, deduplicationId, hexdata):
+        return {
+            'deduplicationId': deduplicationId,
+            'time': '2025-07-07T11:10:50+00:00',
+            'deviceInfo': {'devEui': 'LIVE1'},
+            'object': {'hexdata': hexdata},
+            'rxInfo': [{'rssi': -70}],
+        }
+
+    def store(self, event):
+        with self.captureOnCommitCallbacks(execute=True):
+            process_message(event)
+
+    async def test_hub_publishes_from_other_threads(self):
+        hub = live.Hub()
+        subscription = hub.subscribe(1)
+        other = hub.subscribe(2)
+        await sync_to_async(hub.publish, thread_sensitive=False)([{'device': 1, 'value': 5}])
+        self.assertEqual(await subscription.get(1), {'device': 1, 'value': 5})
+        self.assertTrue(other.queue.empty())
+        # Django closes the response body once the client is gone.
+        live.EventStream(hub, subscription, dict).close()
+        hub.publish([{'device': 1, 'value': 6}])
+        self.assertEqual(hub._subscriptions.keys(), {2})
+
+    async def test_stream_requires_access(self):
+        other = await sync_to_async(create_test_user)(username='liveother', email='liveother@example.com', password='otherpass')
+        client = AsyncClient()
+        self.assertEqual((await client.get(self.url)).status_code, 404)
+        response = await client.get(self.url, headers={'Authorization': f'Bearer {AccessToken.for_user(other)}'})
+        self.assertEqual(response.status_code, 404)
+        response = await client.get(reverse('device-reading-stream', args=['NOPE']),
+                                    headers={'Authorization': self.auth['HTTP_AUTHORIZATION']})
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_needs_asgi(self):
+        self.assertEqual(self.client.get(self.url, **self.auth).status_code, 501)
+
+    async def test_stream_pushes_stored_readings(self):
+        response = await AsyncClient().get(self.url, headers={'Authorization': self.auth['HTTP_AUTHORIZATION']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+        next_event = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        await sync_to_async(self.store)(self.event('live-1', '42'))
+        self.assertEqual(
+            await asyncio.wait_for(next_event, 5),
+            b'event: reading\ndata: {"serial_number": "LIVE1", "value": 42.0, "rssi": -70.0, '
+            b'"timestamp": "2025-07-07T11:10:50+00:00"}\n\n',
+        )
+        await stream.aclose()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'LISTEN/NOTIFY requires PostgreSQL')
+class LiveReadingNotifyTests(TransactionTestCase):
+    async def test_listener_receives_readings_from_other_connections(self):
+        device = await Device.objects.acreate(serial_number='LIVE2')
+        hub = live.Hub()
+        subscription = hub.subscribe(device.pk)
+        listener = live.Listener(hub, poll_interval=0.1)
+        listener.start()
+        self.addCleanup(listener.stop)
+        await asyncio.sleep(0.5)  # let it connect and LISTEN
+        await SensorReading.objects.acreate(
+            device=device, value=7, rssi=-80, timestamp=timezone.now(), deduplicationId='live-2',
+        )
+        event = await subscription.get(5)
+        self.assertEqual((event['device'], event['value'], event['rssi']), (device.pk, 7, -80))
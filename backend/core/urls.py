@@ -1,6 +1,6 @@
 from django.urls import path
 from dj_rest_auth.registration.views import RegisterView
-from .views import ProfileView, PasswordChangeView, PasswordResetView, DeviceListCreateView, DeviceDetailView, SensorReadingIngestView, DeviceDashboardView, PasswordResetConfirmAPIView
+from .views import ProfileView, PasswordChangeView, PasswordResetView, DeviceListCreateView, DeviceDetailView, SensorReadingIngestView, SensorReadingBulkIngestView, DeviceDashboardView, DeviceReadingsView, ReadingsExportView, PasswordResetConfirmAPIView, reading_stream
 from django.contrib.auth import views as auth_views
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
@@ -12,4 +12,10 @@ urlpatterns = [
     path('devices/', DeviceListCreateView.as_view(), name='device-list-create'),
     path('devices/<int:pk>/', DeviceDetailView.as_view(), name='device-detail'),
     path('devices/<str:serial_number>/dashboard/', DeviceDashboardView.as_view(), name='device-dashboard'),
+    path('devices/<str:serial_number>/stream/', reading_stream, name='device-reading-stream'),
+    path('devices/<str:serial_number>/readings/', DeviceReadingsView.as_view(), name='device-readings'),
+    path('devices/<str:serial_number>/export/<str:export_format>/', ReadingsExportView.as_view(), name='device-readings-export'),
+    path('export/<str:export_format>/', ReadingsExportView.as_view(), name='readings-export'),
+    path('sensor-ingest/', SensorReadingIngestView.as_view(), name='sensor-ingest'),
+    path('sensor-ingest/bulk/', SensorReadingBulkIngestView.as_view(), name='sensor-ingest-bulk'),
 ] 
\ No newline at end of file
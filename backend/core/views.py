@@ -1,25 +1,49 @@
-from decimal import Decimal as D
+import json
+from datetime import timedelta
+from itertools import islice
 
 from django.contrib.auth.models import User
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from .serializers import UserProfileSerializer, PasswordChangeSerializer, DeviceSerializer, DeviceDashboardSerializer
+from rest_framework.parsers import JSONParser
+from .serializers import UserProfileSerializer, PasswordChangeSerializer, DeviceSerializer, DeviceUpdateSerializer, DeviceSummarySerializer, DeviceDashboardSerializer, DeviceDashboardQuerySerializer, DeviceReadingsQuerySerializer
 from .models import UserProfile, Device, SensorReading
 from .auth import CentralCollectorAPIKeyAuthentication
+from .parsers import NDJSONParser
+from .pagination import encode_cursor
+from django.db.models import Q
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
 from django.contrib.auth import update_session_auth_hash
 from django.contrib.auth.forms import PasswordResetForm
 from django.conf import settings
 from django.utils import timezone
-from datetime import timedelta
 from django.contrib.auth.tokens import default_token_generator
-from django.utils.http import urlsafe_base64_decode
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, urlsafe_base64_decode
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
 from .exceptions import SensorException
-from .sensor import process_message
+from .sensor import process_message, parse_uplink
+from .ingest import store_uplinks
+from . import analytics, dashboard, export, live, metrics
 
 # Create your views here.
 
+class InstrumentedViewMixin:
+    """Records request latency and database time under ``metrics_name``."""
+    metrics_name = None
+
+    def dispatch(self, request, *args, **kwargs):
+        with metrics.REQUEST_SECONDS.labels(self.metrics_name).time(), metrics.db_time(self.metrics_name):
+            return super().dispatch(request, *args, **kwargs)
+
+
 class ProfileView(generics.RetrieveUpdateAPIView):
     serializer_class = UserProfileSerializer
     permission_classes = [IsAuthenticated]
@@ -82,11 +106,25 @@ class PasswordResetConfirmAPIView(APIView):
         return Response({'detail': 'Password has been reset.'})
 
 class DeviceListCreateView(generics.ListCreateAPIView):
+    """
+    The user's devices. With ``?summary=1`` each one also carries its last
+    reading and its 24 hour average, for overview pages: two queries
+    however many devices there are.
+    """
     serializer_class = DeviceSerializer
     permission_classes = [IsAuthenticated]
 
+    def summary(self):
+        return self.request.method == 'GET' and self.request.query_params.get('summary') in ('1', 'true')
+
+    def get_serializer_class(self):
+        return DeviceSummarySerializer if self.summary() else DeviceSerializer
+
     def get_queryset(self):
-        return self.request.user.devices.all()
+        devices = self.request.user.devices.prefetch_related('users')
+        if self.summary():
+            devices = devices.annotate(average_24_hours=dashboard.average_subquery(timezone.now(), timedelta(days=1)))
+        return devices
 
 
     def post(self, request, *args, **kwargs):
@@ -110,8 +148,8 @@ class DeviceListCreateView(generics.ListCreateAPIView):
     def perform_create(self, serializer):
         serializer.save(users=[self.request.user])
 
-class DeviceDetailView(generics.RetrieveAPIView):
-    serializer_class = DeviceSerializer
+class DeviceDetailView(generics.RetrieveUpdateAPIView):
+    serializer_class = DeviceUpdateSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
@@ -123,33 +161,38 @@ class DeviceDetailView(generics.RetrieveAPIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class DeviceDashboardView(APIView):
+class DeviceDashboardView(InstrumentedViewMixin, APIView):
     permission_classes = [IsAuthenticated]
+    metrics_name = 'dashboard'
 
     def get(self, request, serial_number):
-        try:
-            device = self.request.user.devices.get(serial_number=serial_number)
-        except Device.DoesNotExist:
+        query = DeviceDashboardQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+        # Checked against the database on every request, cached or not, so
+        # removed access takes effect at once.
+        device = request.user.devices.filter(serial_number=serial_number).first()
+        if device is None:
             return Response({'detail': 'Device not found.'}, status=status.HTTP_404_NOT_FOUND)
+        etag, payload = dashboard.cached_payload(
+            device.pk, query.validated_data, lambda: self.build(device, query.validated_data),
+        )
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(payload)
+        response['ETag'] = etag
+        # Let browsers keep the payload but revalidate it on every poll.
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def build(self, device, params):
         now = timezone.now()
         readings = SensorReading.objects.filter(device=device).order_by('-timestamp')
         recent = readings.first()
-        # Averages
-        def avg_for_days(days):
-            since = now - timedelta(days=days)
-            vals = readings.filter(timestamp__gte=since).values_list('value', flat=True)
-            return D(sum(vals)/len(vals)).quantize(D('0.01')) if vals else None
-        averages = {
-            '24_hours': avg_for_days(1),
-            '7_days': avg_for_days(7),
-            '30_days': avg_for_days(30),
-        }
-        # Trend: last 30 days, sorted by timestamp asc
-        trend_qs = readings.filter(timestamp__gte=now - timedelta(days=30)).order_by('timestamp')
-        trend = [
-            {'timestamp': r.timestamp.isoformat(), 'value': r.value, 'rssi': r.rssi}
-            for r in trend_qs
-        ]
+        averages, statistics = dashboard.window_statistics(device, now)
+        # Trend: last 30 days, sorted by timestamp asc, bounded to max_points
+        trend_resolution, trend = dashboard.trend(device, now, statistics['count'], **params)
         data = {
             'recent_reading': {
                 'value': recent.value if recent else None,
@@ -157,19 +200,196 @@ class DeviceDashboardView(APIView):
                 'timestamp': recent.timestamp.isoformat() if recent else None,
             },
             'averages': averages,
+            'statistics': statistics,
+            'trend_resolution': trend_resolution,
             'trend': trend,
         }
-        serializer = DeviceDashboardSerializer(data)
-        return Response(serializer.data)
+        return DeviceDashboardSerializer(data).data
+
+class DeviceReadingsView(APIView):
+    """
+    Raw reading history of a device, oldest first, in column-oriented pages:
+    parallel arrays of timestamps (epoch milliseconds), values and rssi.
+    Pages are addressed with a keyset cursor on (timestamp, id), so deep
+    pages cost the same as the first one.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, serial_number):
+        query = DeviceReadingsQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+        params = query.validated_data
+        try:
+            device = self.request.user.devices.get(serial_number=serial_number)
+        except Device.DoesNotExist:
+            return Response({'detail': 'Device not found.'}, status=status.HTTP_404_NOT_FOUND)
+        readings = SensorReading.objects.filter(device=device)
+        if 'from' in params:
+            readings = readings.filter(timestamp__gte=params['from'])
+        if 'to' in params:
+            readings = readings.filter(timestamp__lt=params['to'])
+        if 'cursor' in params:
+            timestamp, pk = params['cursor']
+            readings = readings.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk))
+        limit = params['limit']
+        rows = list(
+            readings.order_by('timestamp', 'id')
+            .values_list('id', 'timestamp', 'value', 'rssi', 'flags')[:limit + 1]
+        )
+        page = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            last_id, last_timestamp = page[-1][0], page[-1][1]
+            next_cursor = encode_cursor(last_timestamp, last_id)
+        return Response({
+            'timestamps': [int(row[1].timestamp() * 1000) for row in page],
+            'values': [row[2] for row in page],
+            'rssi': [row[3] for row in page],
+            'flags': [analytics.flag_names(row[4]) for row in page],
+            'next_cursor': next_cursor,
+        })
 
-class SensorReadingIngestView(APIView):
+class ReadingsExportView(APIView):
+    """
+    Streams the full reading history of one device, or of every device of
+    the user when no serial number is given, as CSV, NDJSON or Parquet.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, export_format, serial_number=None):
+        if export_format not in export.FORMATS:
+            return Response({'detail': f'Unsupported export format: {export_format}.'}, status=status.HTTP_400_BAD_REQUEST)
+        if export_format == 'parquet' and not export.parquet_available():
+            return Response({'detail': 'Parquet export is not available on this server.'}, status=status.HTTP_400_BAD_REQUEST)
+        if serial_number is None:
+            readings = SensorReading.objects.filter(device__users=request.user)
+            filename = f'readings.{export_format}'
+        else:
+            try:
+                device = self.request.user.devices.get(serial_number=serial_number)
+            except Device.DoesNotExist:
+                return Response({'detail': 'Device not found.'}, status=status.HTTP_404_NOT_FOUND)
+            readings = SensorReading.objects.filter(device=device)
+            filename = f'{device.serial_number}.{export_format}'
+        chunks = export.export_readings(readings, export_format)
+        if isinstance(request._request, ASGIRequest):
+            chunks = export.aiter_chunks(chunks)
+        response = StreamingHttpResponse(chunks, content_type=export.FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+class SensorReadingIngestView(InstrumentedViewMixin, APIView):
     authentication_classes = [CentralCollectorAPIKeyAuthentication]
     permission_classes = []
+    metrics_name = 'ingest'
 
     def post(self, request, *args, **kwargs):
         obj = request.data
+        metrics.UPLINKS_RECEIVED.labels('http').inc()
         try:
             process_message(obj)
         except SensorException as exc:
             return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
         return Response({'detail': 'Reading stored.'}, status=status.HTTP_201_CREATED)
+
+
+class SensorReadingBulkIngestView(InstrumentedViewMixin, APIView):
+    """
+    Accepts a JSON array of ChirpStack uplinks, or an NDJSON stream with one
+    uplink per line, and stores them in batches of INGEST_BATCH_SIZE.
+    """
+    authentication_classes = [CentralCollectorAPIKeyAuthentication]
+    permission_classes = []
+    parser_classes = [JSONParser, NDJSONParser]
+    max_reported_errors = 1000
+    metrics_name = 'ingest_bulk'
+
+    def post(self, request, *args, **kwargs):
+        records = request.data
+        if isinstance(records, dict):
+            return Response({'error': 'Expected a JSON array or an NDJSON body.'}, status=status.HTTP_400_BAD_REQUEST)
+        totals = {'accepted': 0, 'duplicates': 0, 'rejected': 0}
+        errors = []
+        records = enumerate(records)
+        while batch := list(islice(records, settings.INGEST_BATCH_SIZE)):
+            metrics.UPLINKS_RECEIVED.labels('http_bulk').inc(len(batch))
+            positions, uplinks = [], []
+            for index, record in batch:
+                if isinstance(record, (bytes, str)):
+                    try:
+                        record = json.loads(record)
+                    except ValueError as exc:
+                        metrics.UPLINKS_REJECTED.inc()
+                        totals['rejected'] += 1
+                        errors.append({'index': index, 'error': f'Invalid JSON: {exc}'})
+                        continue
+                if not isinstance(record, dict):
+                    metrics.UPLINKS_REJECTED.inc()
+                    totals['rejected'] += 1
+                    errors.append({'index': index, 'error': 'Expected a JSON object.'})
+                    continue
+                positions.append(index)
+                uplinks.append(parse_uplink(record))
+            result = store_uplinks(uplinks)
+            totals['accepted'] += result.stored
+            totals['duplicates'] += result.duplicates
+            totals['rejected'] += result.rejected
+            errors.extend(
+                {'index': positions[error['index']], 'error': error['error']}
+                for error in result.errors
+            )
+        errors.sort(key=lambda error: error['index'])
+        return Response(dict(totals, errors=errors[:self.max_reported_errors]))
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; needs ``Authorization: Bearer <METRICS_API_KEY>``."""
+    if not settings.METRICS_API_KEY:
+        raise Http404
+    if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_API_KEY}'):
+        return HttpResponse('Unauthorized', status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+
+def _authorized_device(request, serial_number):
+    """The device if the request's JWT (header or cookie) belongs to one of its users."""
+    for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        try:
+            authenticated = authenticator().authenticate(Request(request))
+        except AuthenticationFailed:
+            return None
+        if authenticated is not None:
+            return authenticated[0].devices.filter(serial_number=serial_number).first()
+    return None
+
+
+async def reading_stream(request, serial_number):
+    """
+    Server-Sent Events stream of the readings stored for a device from now
+    on, as ``reading`` events. Only served through ASGI: under WSGI (e.g.
+    ``runserver``) Django reads an async streaming body to its end before
+    sending anything, and this one never ends.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'detail': 'Live readings need the ASGI server.'}, status=501)
+    device = await sync_to_async(_authorized_device)(request, serial_number)
+    if device is None:
+        return JsonResponse({'detail': 'Device not found.'}, status=404)
+    live.ensure_listener()
+
+    def render(event):
+        return {
+            'serial_number': device.serial_number,
+            'value': event['value'],
+            'rssi': event['rssi'],
+            'timestamp': event['timestamp'],
+        }
+
+    stream = live.EventStream(live.hub, live.hub.subscribe(device.pk), render)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,247 @@
+"""
+asyncio alternative to the paho consumer (``startmqttclient --mode asyncio``).
+
+Network I/O and JSON decoding run on the event loop; database writes run in
+a thread pool through ``store_uplinks``. Uplinks are sharded by device onto
+MQTT_ASYNC_SHARDS bounded queues, each drained in batches by a single
+writer, so different devices are written concurrently while readings of
+one device are stored in the order they arrived. When a shard's queue is
+full the consumer stops reading the broker's socket (see FlowControl) until
+the writer catches up, so TCP flow control holds the broker back instead of
+messages piling up in this process (see FlowControl for how that interacts
+with the MQTT keepalive).
+
+``aiomqtt`` is only imported when connecting, so the paho mode and the
+tests do not need it.
+"""
+import asyncio
+import signal
+import ssl
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from core import metrics
+from core.exceptions import SensorException
+from .mqtt_client import serve_metrics, subscriptions
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FlowControl:
+    """
+    Pauses reading from the broker's socket while the ingest queues are full.
+
+    aiomqtt has no public pause, so this relies on its internals (the paho
+    client in ``_client``, and ``_on_socket_open``, which registers its
+    reader with the event loop); requirements.txt pins the aiomqtt version
+    this is tested against.
+
+    While paused, paho does not read the broker's PINGRESP either. A pause
+    longer than MQTT_KEEPALIVE (a database outage, see _store) therefore
+    ends with paho dropping the connection; the consumer reconnects once the
+    writers catch up, and meanwhile the broker hands a shared subscription's
+    messages to the other consumers of the group.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.paused_at = None
+
+    @property
+    def paused(self):
+        return self.paused_at is not None
+
+    def connected(self, client):
+        self.client = client
+        self.paused_at = None
+
+    def _socket(self):
+        return self.client._client.socket() if self.client is not None else None
+
+    def pause(self):
+        sock = self._socket()
+        if sock is not None and not self.paused:
+            asyncio.get_running_loop().remove_reader(sock)
+            self.paused_at = time.monotonic()
+
+    def resume(self):
+        sock = self._socket()
+        if sock is not None and self.paused:
+            paused_for = time.monotonic() - self.paused_at
+            if paused_for > settings.MQTT_KEEPALIVE:
+                logger.warning('Stopped reading from the broker for %.0fs, longer than MQTT_KEEPALIVE: '
+                               'expect a reconnect', paused_for)
+            # Registers aiomqtt's own reader again, along with a new task
+            # for paho's housekeeping in place of the running one.
+            if self.client._misc_task is not None:
+                self.client._misc_task.cancel()
+            self.client._on_socket_open(self.client._client, None, sock)
+        self.paused_at = None
+
+
+async def mqtt_messages(flow=None):
+    """Messages from the broker, reconnecting whenever the connection drops."""
+    import aiomqtt
+
+    protocol = aiomqtt.ProtocolVersion.V5 if settings.MQTT_SHARED_GROUP else aiomqtt.ProtocolVersion.V311
+    while True:
+        try:
+            async with aiomqtt.Client(
+                hostname=settings.MQTT_BROKER_URL,
+                port=settings.MQTT_BROKER_PORT,
+                username=settings.MQTT_BROKER_USERNAME,
+                password=settings.MQTT_BROKER_PASSWORD,
+                keepalive=settings.MQTT_KEEPALIVE,
+                tls_context=ssl.create_default_context(),
+                protocol=protocol,
+                # A hard bound on aiomqtt's own queue (which drops messages
+                # beyond it); FlowControl normally keeps it far from full.
+                max_queued_incoming_messages=settings.MQTT_ASYNC_QUEUE_SIZE,
+            ) as client:
+                logger.info('Connected successfully')
+                if flow is not None:
+                    flow.connected(client)
+                await client.subscribe([(topic, settings.MQTT_QOS) for topic in subscriptions()])
+                async for message in client.messages:
+                    yield message
+        except aiomqtt.MqttError as exc:
+            logger.error('Lost connection to MQTT broker (%s), reconnecting', exc)
+            await asyncio.sleep(settings.MQTT_RECONNECT_DELAY)
+
+
+class AsyncIngestService:
+    def __init__(self, shards=None, queue_size=None, batch_size=None, store=None, archive=None, flow=None):
+        from core.archive import get_archive
+        from core.decoders import get_decoder
+        if store is None:
+            from core.ingest import store_uplinks as store
+        self.decode = get_decoder()
+        self.archive = get_archive() if archive is None else archive
+        self.shards = shards or settings.MQTT_ASYNC_SHARDS
+        self.queue_size = queue_size or settings.MQTT_ASYNC_QUEUE_SIZE
+        self.batch_size = batch_size or settings.INGEST_BATCH_SIZE
+        self.store = store
+        self.flow = flow or FlowControl()
+        self.queues = []
+        self.stats = {
+            'received': 0,
+            'invalid': 0,
+            'stored': 0,
+            'batches': 0,
+            'retries': 0,
+            'failed_batches': 0,
+        }
+        self._writers = []
+        self._executor = None
+        self._stopping = threading.Event()
+
+    def shard_for(self, serial_number):
+        return zlib.crc32((serial_number or '').encode()) % self.shards
+
+    def start(self):
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.shards)]
+        self._executor = ThreadPoolExecutor(max_workers=self.shards, thread_name_prefix='ingest')
+        self._writers = [asyncio.create_task(self._write(queue)) for queue in self.queues]
+        metrics.QUEUE_DEPTH.labels('asyncio').set_function(lambda: sum(queue.qsize() for queue in self.queues))
+
+    async def stop(self):
+        """Store everything still queued and stop the writers."""
+        # Failing batches are given up on rather than retried from here on.
+        self._stopping.set()
+        for queue in self.queues:
+            await queue.join()
+        for writer in self._writers:
+            writer.cancel()
+        await asyncio.gather(*self._writers, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def handle(self, payload):
+        self.stats['received'] += 1
+        metrics.UPLINKS_RECEIVED.labels('mqtt').inc()
+        if self.archive:
+            self.archive.append(payload)
+        try:
+            uplink = self.decode(payload)
+        except SensorException as exc:
+            self.stats['invalid'] += 1
+            logger.warning('Ignoring undecodable message: %s', exc)
+            return
+        queue = self.queues[self.shard_for(uplink.devEui)]
+        if not queue.full():
+            queue.put_nowait(uplink)
+            return
+        # Waits for the writer, which stops the consumer from taking further
+        # messages; stop reading the socket too, or they pile up in aiomqtt.
+        self.flow.pause()
+        try:
+            await queue.put(uplink)
+        finally:
+            self.flow.resume()
+
+    async def _write(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                await loop.run_in_executor(self._executor, self._store, batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _store(self, batch):
+        from core.ingest import retry_delays
+        delays = retry_delays()
+        while True:
+            close_old_connections()
+            try:
+                result = self.store(batch)
+                break
+            except Exception:
+                delay = next(delays, None)
+                if delay is None or self._stopping.is_set():
+                    logger.exception('Failed to store batch of %d uplinks', len(batch))
+                    self.stats['failed_batches'] += 1
+                    return
+                # Blocks this shard's writer, so its queue fills up and the
+                # consumer stops reading until the database is back.
+                logger.exception('Failed to store batch of %d uplinks, retrying in %.1fs', len(batch), delay)
+                self.stats['retries'] += 1
+                self._stopping.wait(delay)
+        self.stats['batches'] += 1
+        self.stats['stored'] += result.stored
+        for error in result.errors:
+            logger.warning('Rejected uplink: %s', error['error'])
+
+    async def run(self, messages=None):
+        self.start()
+        try:
+            async for message in messages or mqtt_messages(self.flow):
+                await self.handle(message.payload)
+        finally:
+            await self.stop()
+            if self.archive:
+                self.archive.close()
+            logger.info('Ingest stats: %s', self.stats)
+
+
+async def serve():
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await AsyncIngestService().run()
+    except asyncio.CancelledError:
+        pass
+
+
+def run_worker(worker=0):
+    serve_metrics(worker)
+    asyncio.run(serve())
@@ -1,10 +1,35 @@
-from django.core.management.base import BaseCommand
-from mqtt_client import mqtt_client
-        
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.checks import cache_is_shared
+from mqtt_client import aio, mqtt_client
+from mqtt_client.supervisor import Supervisor
+
 
 class Command(BaseCommand):
     help = "Starts the MQTT client"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode', choices=['paho', 'asyncio'], default=settings.MQTT_CLIENT_MODE,
+            help='Consumer implementation (default: MQTT_CLIENT_MODE).',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=settings.MQTT_WORKERS,
+            help='Number of consumer processes to run under a supervisor (default: MQTT_WORKERS).',
+        )
+
     def handle(self, *args, **options):
-        client = mqtt_client.set_up_client()
-        client.loop_forever()
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers must be at least 1.')
+        run_worker = aio.run_worker if options['mode'] == 'asyncio' else mqtt_client.run_worker
+        if workers > 1 and not settings.MQTT_SHARED_GROUP:
+            raise CommandError('Running several workers needs MQTT_SHARED_GROUP, or each would get every message.')
+        if (workers > 1 or settings.MQTT_SHARED_GROUP) and not (cache_is_shared() and cache_is_shared('alerts')):
+            # A shared subscription spreads one device's uplinks over the
+            # consumers, which must then share its alert and stream state.
+            raise CommandError('Several consumers need a shared cache (CACHE_BACKEND), not a per-process LocMemCache.')
+        if workers == 1:
+            run_worker()
+            return
+        Supervisor(run_worker, workers).run()
@@ -1,4 +1,4 @@
-import json
+import signal
 from functools import lru_cache
 import paho.mqtt.client as mqtt
 from django.conf import settings
@@ -8,19 +8,47 @@ logger = logging.getLogger(__name__)
 
 # https://www.emqx.com/en/blog/how-to-use-mqtt-in-django
 
+def subscriptions():
+    """
+    Topic filters to subscribe to. With MQTT_SHARED_GROUP set they become
+    MQTT v5 shared subscriptions, so the broker spreads the messages over
+    every client in the group instead of sending each one to all of them.
+    """
+    if settings.MQTT_SHARED_GROUP:
+        return [f'$share/{settings.MQTT_SHARED_GROUP}/{topic}' for topic in settings.MQTT_TOPICS]
+    return list(settings.MQTT_TOPICS)
+
+
 def on_connect(mqtt_client, userdata, flags, rc, properties):
     if rc == 0:
         logger.info('Connected successfully')
-        mqtt_client.subscribe('application/50c4db63-0f74-4b5a-8d4c-964f238a786d/device/+/event/up')
+        mqtt_client.subscribe([(topic, settings.MQTT_QOS) for topic in subscriptions()])
     else:
-        logger.error('Bad connection. Code:', rc)
+        logger.error('Bad connection. Code: %s', rc)
 
 def on_message(mqtt_client, userdata, message):
-    payload = message.payload.decode()
-    data = json.loads(payload)
-    logger.debug(f"Received message {message.topic}: {payload}")
-    from core import sensor
-    sensor.process_message(data)
+    logger.debug("Received message %s: %r", message.topic, message.payload)
+    from core import archive, decoders, metrics, sensor
+    from core.exceptions import SensorException
+    metrics.UPLINKS_RECEIVED.labels('mqtt').inc()
+    with metrics.MQTT_MESSAGE_SECONDS.time():
+        uplink_archive = archive.get_archive()
+        if uplink_archive is not None:
+            uplink_archive.append(message.payload)
+        try:
+            uplink = decoders.get_decoder()(message.payload)
+        except SensorException as exc:
+            # paho re-raises exceptions from callbacks, which would stop the
+            # network loop over a single malformed message.
+            metrics.UPLINKS_REJECTED.inc()
+            logger.warning('Ignoring undecodable message on %s: %s', message.topic, exc)
+            return
+        if userdata is None:
+            sensor.process_uplink(uplink)
+        else:
+            # userdata is the IngestBuffer: only decode here and leave the
+            # database work to its worker thread.
+            userdata.put(uplink)
 
 def on_disconnect(mqtt_client, userdata, rc):
     logger.info('Disconnected from MQTT broker')
@@ -28,13 +56,28 @@ def on_disconnect(mqtt_client, userdata, rc):
 
 
 @lru_cache
-def set_up_client():
-    logging.info('Setting up MQTT client')
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+def get_ingest_buffer():
+    from core import metrics
+    from core.ingest import IngestBuffer
+    ingest_buffer = IngestBuffer()
+    ingest_buffer.start()
+    metrics.QUEUE_DEPTH.labels('ingest_buffer').set_function(lambda: ingest_buffer.queue_depth)
+    return ingest_buffer
+
+
+def make_client(userdata=None):
+    # Shared subscriptions need MQTT v5.
+    protocol = mqtt.MQTTv5 if settings.MQTT_SHARED_GROUP else mqtt.MQTTv311
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=userdata, protocol=protocol)
     client.on_connect = on_connect
     client.on_message = on_message
     client.enable_logger()
-    import ssl
+    return client
+
+
+def set_up_client():
+    logging.info('Setting up MQTT client')
+    client = make_client(userdata=get_ingest_buffer())
     client.tls_set()
     client.username_pw_set(settings.MQTT_BROKER_USERNAME, settings.MQTT_BROKER_PASSWORD)
     client.connect(
@@ -43,3 +86,24 @@ def set_up_client():
         keepalive=settings.MQTT_KEEPALIVE
     )
     return client
+
+
+def serve_metrics(worker=0):
+    if settings.MQTT_METRICS_PORT:
+        from core import metrics
+        metrics.serve(settings.MQTT_METRICS_PORT + worker)
+
+
+def run_worker(worker=0):
+    """Consume messages until disconnected or sent SIGTERM, then flush the ingest buffer."""
+    serve_metrics(worker)
+    client = set_up_client()
+    signal.signal(signal.SIGTERM, lambda signum, frame: client.disconnect())
+    try:
+        client.loop_forever()
+    finally:
+        # Store whatever is still buffered before exiting.
+        get_ingest_buffer().stop(timeout=10)
+        from core.archive import get_archive
+        if get_archive() is not None:
+            get_archive().close()
@@ -0,0 +1,84 @@
+"""
+Runs several MQTT consumer processes and restarts the ones that die.
+
+Workers are forked from the management command, so each has its own MQTT
+connection, ingest buffer and database connection. They only split the load
+when they consume through a shared subscription (see MQTT_SHARED_GROUP).
+"""
+import multiprocessing
+import signal
+import time
+
+from django.db import connections
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    def __init__(self, target, workers, restart_delay=5.0, start_method='fork'):
+        self.target = target
+        self.workers = workers
+        # A worker that keeps dying (e.g. bad broker credentials) is not
+        # restarted more often than this.
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context(start_method)
+        self.processes = [None] * workers
+        self.started_at = [0.0] * workers
+        self.restarts = 0
+        self._stopping = False
+
+    def _spawn(self, slot):
+        # Connections must not be shared with the children.
+        connections.close_all()
+        process = self.context.Process(target=self.target, args=(slot,), name=f'mqtt-worker-{slot}', daemon=False)
+        process.start()
+        self.processes[slot] = process
+        self.started_at[slot] = time.monotonic()
+        logger.info('Started MQTT worker %d (pid %d)', slot, process.pid)
+
+    def start(self):
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+    def check(self):
+        """Restart workers that have exited. Returns how many were restarted."""
+        restarted = 0
+        for slot, process in enumerate(self.processes):
+            if process is None or process.is_alive():
+                continue
+            if time.monotonic() - self.started_at[slot] < self.restart_delay:
+                continue
+            logger.warning('MQTT worker %d (pid %d) exited with %s, restarting', slot, process.pid, process.exitcode)
+            process.close()
+            self._spawn(slot)
+            restarted += 1
+        self.restarts += restarted
+        return restarted
+
+    def stop(self, timeout=15):
+        self._stopping = True
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    def run(self, poll_interval=1.0):
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, '_stopping', True))
+        self.start()
+        try:
+            while not self._stopping:
+                time.sleep(poll_interval)
+                self.check()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
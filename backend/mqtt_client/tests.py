@@ -1,13 +1,81 @@
+import asyncio
+import importlib.util
+import itertools
 import json
+import os
+import socket
+import threading
+import time
+import paho.mqtt.client as mqtt
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from core.tests import create_test_user
 from core.models import Device, SensorReading
-from mqtt_client.mqtt_client import on_message
+from core.ingest import IngestBuffer
+from mqtt_client.mqtt_client import make_client, on_connect, on_message, subscriptions
+from mqtt_client.aio import AsyncIngestService
+from mqtt_client.supervisor import Supervisor
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from types import SimpleNamespace
+from unittest import mock, skipUnless
 
 # Create your tests here.
 
+
+class LocalBroker:
+    """
+    In-memory stand-in for an MQTT broker: plain subscriptions get every
+    matching message, shared ones ($share/<group>/<filter>) are handed to
+    one member of each group in turn.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self._turns = {}
+
+    def client(self, userdata=None):
+        return LocalClient(self, userdata)
+
+    def subscribe(self, client, topic_filter):
+        group = None
+        if topic_filter.startswith('$share/'):
+            _, group, topic_filter = topic_filter.split('/', 2)
+        self.subscriptions.append((group, topic_filter, client))
+
+    def publish(self, topic, payload):
+        groups = {}
+        for group, topic_filter, client in self.subscriptions:
+            if not mqtt.topic_matches_sub(topic_filter, topic):
+                continue
+            if group is None:
+                client.deliver(topic, payload)
+            else:
+                groups.setdefault((group, topic_filter), []).append(client)
+        for key, members in groups.items():
+            turn = self._turns.setdefault(key, itertools.count())
+            members[next(turn) % len(members)].deliver(topic, payload)
+
+
+class LocalClient:
+    def __init__(self, broker, userdata):
+        self.broker = broker
+        self.userdata = userdata
+        self.received = 0
+
+    def subscribe(self, topics):
+        for topic_filter, qos in topics:
+            self.broker.subscribe(self, topic_filter)
+
+    def deliver(self, topic, payload):
+        self.received += 1
+        on_message(self, self.userdata, SimpleNamespace(topic=topic, payload=payload))
+
+
+def exit_immediately(worker):
+    os._exit(3)
+
 class MqttClientTestCase(TestCase):
     def setUp(self):
         self.user = create_test_user(username='testuser', password='testpass', email='test@example.com')
@@ -35,3 +103,270 @@ class MqttClientTestCase(TestCase):
         self.assertEqual(reading.value, int(self.sample_data['object']['hexdata']))
         self.assertEqual(reading.rssi, self.sample_data['rxInfo'][0]['rssi'])
         self.assertEqual(str(reading.timestamp), self.sample_data['time'].replace('T', ' '))
+
+    def test_on_message_archives_raw_payloads(self):
+        from core import archive
+        with TemporaryDirectory() as directory, self.settings(UPLINK_ARCHIVE_DIR=directory):
+            archive.get_archive.cache_clear()
+            self.addCleanup(archive.get_archive.cache_clear)
+            on_message(None, None, SimpleNamespace(payload=self.sample_payload, topic='t'))
+            # Undecodable messages are logged and dropped instead of raised.
+            with self.assertLogs('mqtt_client.mqtt_client', 'WARNING'):
+                on_message(None, None, SimpleNamespace(payload=b'{"object": null}', topic='t'))
+            archive.get_archive().close()
+            payloads = [
+                payload
+                for segment in archive.list_segments(directory)
+                for _, payload in archive.read_segment(segment)
+            ]
+        self.assertEqual(payloads, [self.sample_payload, b'{"object": null}'])
+
+    def test_on_message_with_buffer_only_enqueues(self):
+        ingest_buffer = IngestBuffer(batch_size=10, flush_interval=0.01)
+        message = SimpleNamespace(payload=self.sample_payload, topic='application/x/device/0123456789abcd13/event/up')
+        on_message(None, ingest_buffer, message)
+        self.assertEqual(ingest_buffer.queue_depth, 1)
+        self.assertFalse(SensorReading.objects.exists())
+        ingest_buffer.flush()
+        reading = SensorReading.objects.get(deduplicationId=self.sample_data['deduplicationId'])
+        self.assertEqual(reading.device, self.device)
+
+
+class SharedSubscriptionTests(TestCase):
+    topic = 'application/x/device/+/event/up'
+
+    def setUp(self):
+        self.device = Device.objects.create(serial_number='0123456789abcd14')
+
+    def payload(self, i):
+        return json.dumps({
+            'deduplicationId': f'shared-{i}',
+            'time': '2025-01-01T00:00:00+00:00',
+            'deviceInfo': {'devEui': self.device.serial_number},
+            'object': {'hexdata': '42'},
+            'rxInfo': [{'rssi': -70}],
+        }).encode()
+
+    def test_subscriptions(self):
+        with self.settings(MQTT_TOPICS=[self.topic, 'other/#'], MQTT_SHARED_GROUP=''):
+            self.assertEqual(subscriptions(), [self.topic, 'other/#'])
+            self.assertEqual(make_client()._protocol, mqtt.MQTTv311)
+        with self.settings(MQTT_TOPICS=[self.topic], MQTT_SHARED_GROUP='radon'):
+            self.assertEqual(subscriptions(), [f'$share/radon/{self.topic}'])
+            self.assertEqual(make_client()._protocol, mqtt.MQTTv5)
+
+    def test_workers_split_the_messages(self):
+        broker = LocalBroker()
+        buffers = [IngestBuffer(batch_size=100, flush_interval=0.01) for _ in range(3)]
+        clients = [broker.client(ingest_buffer) for ingest_buffer in buffers]
+        with self.settings(MQTT_TOPICS=[self.topic], MQTT_SHARED_GROUP='radon'):
+            for client in clients:
+                on_connect(client, client.userdata, None, 0, None)
+        for i in range(9):
+            broker.publish(f'application/x/device/{self.device.serial_number}/event/up', self.payload(i))
+        broker.publish('application/y/device/other/event/up', self.payload(99))
+        self.assertEqual([client.received for client in clients], [3, 3, 3])
+        self.assertEqual(sum(ingest_buffer.flush() for ingest_buffer in buffers), 9)
+        self.assertEqual(SensorReading.objects.filter(device=self.device).count(), 9)
+
+    def test_without_shared_group_every_client_gets_everything(self):
+        broker = LocalBroker()
+        clients = [broker.client(IngestBuffer()) for _ in range(2)]
+        with self.settings(MQTT_TOPICS=[self.topic], MQTT_SHARED_GROUP=''):
+            for client in clients:
+                on_connect(client, client.userdata, None, 0, None)
+        broker.publish(f'application/x/device/{self.device.serial_number}/event/up', self.payload(0))
+        self.assertEqual([client.received for client in clients], [1, 1])
+
+    def test_several_workers_need_a_shared_group(self):
+        with self.settings(MQTT_SHARED_GROUP=''), self.assertRaises(CommandError):
+            call_command('startmqttclient', workers=2)
+
+    def test_shared_group_needs_a_shared_cache(self):
+        # The test settings use the per-process LocMemCache.
+        with self.settings(MQTT_SHARED_GROUP='radon'), self.assertRaisesMessage(CommandError, 'shared cache'):
+            call_command('startmqttclient', workers=1)
+
+
+class SupervisorTests(TestCase):
+    def test_restarts_dead_workers(self):
+        supervisor = Supervisor(exit_immediately, workers=2, restart_delay=0)
+        supervisor.start()
+        try:
+            for process in supervisor.processes:
+                process.join(5)
+            self.assertEqual([process.exitcode for process in supervisor.processes], [3, 3])
+            self.assertEqual(supervisor.check(), 2)
+            self.assertEqual(supervisor.restarts, 2)
+        finally:
+            supervisor.stop(timeout=5)
+
+    def test_restart_delay(self):
+        supervisor = Supervisor(exit_immediately, workers=1, restart_delay=60)
+        supervisor.start()
+        try:
+            supervisor.processes[0].join(5)
+            self.assertEqual(supervisor.check(), 0)
+        finally:
+            supervisor.stop(timeout=5)
+
+
+class AsyncIngestServiceTests(TestCase):
+    def message(self, serial_number, i):
+        return SimpleNamespace(topic='application/x/device/up', payload=json.dumps({
+            'deduplicationId': f'{serial_number}-{i}',
+            'time': '2025-01-01T00:00:00+00:00',
+            'deviceInfo': {'devEui': serial_number},
+            'object': {'hexdata': str(i)},
+            'rxInfo': [{'rssi': -70}],
+        }).encode())
+
+    def test_keeps_per_device_order_across_shards(self):
+        batches = []
+
+        def store(batch):
+            batches.append(list(batch))
+            return SimpleNamespace(stored=len(batch), errors=[])
+
+        async def messages():
+            for i in range(20):
+                for serial_number in ('dev-a', 'dev-b', 'dev-c'):
+                    yield self.message(serial_number, i)
+            yield SimpleNamespace(topic='x', payload=b'not json')
+
+        service = AsyncIngestService(shards=2, queue_size=5, batch_size=4, store=store)
+        asyncio.run(service.run(messages()))
+        self.assertEqual(service.stats['received'], 61)
+        self.assertEqual(service.stats['invalid'], 1)
+        self.assertEqual(service.stats['stored'], 60)
+        self.assertTrue(all(len(batch) <= 4 for batch in batches))
+        for serial_number in ('dev-a', 'dev-b', 'dev-c'):
+            values = [uplink.hexdata for batch in batches for uplink in batch if uplink.devEui == serial_number]
+            self.assertEqual(values, [str(i) for i in range(20)])
+
+    def test_pauses_reading_when_queue_is_full(self):
+        release = threading.Event()
+        pulled = []
+
+        def store(batch):
+            release.wait(5)
+            return SimpleNamespace(stored=len(batch), errors=[])
+
+        async def messages():
+            for i in range(50):
+                pulled.append(i)
+                yield self.message('dev-a', i)
+
+        async def scenario():
+            service = AsyncIngestService(shards=1, queue_size=3, batch_size=2, store=store)
+            task = asyncio.create_task(service.run(messages()))
+            await asyncio.sleep(0.2)
+            # One batch is being written, the queue is full and one more
+            # message waits to be queued: the consumer reads no further.
+            in_flight = len(pulled)
+            release.set()
+            await task
+            return in_flight, service.stats['stored']
+
+        in_flight, stored = asyncio.run(scenario())
+        self.assertLessEqual(in_flight, 2 + 3 + 1)
+        self.assertEqual(stored, 50)
+
+    def test_pauses_the_socket_while_queue_is_full(self):
+        release = threading.Event()
+        calls = []
+        flow = SimpleNamespace(pause=lambda: calls.append('pause'), resume=lambda: calls.append('resume'))
+
+        def store(batch):
+            release.wait(5)
+            return SimpleNamespace(stored=len(batch), errors=[])
+
+        async def scenario():
+            service = AsyncIngestService(shards=1, queue_size=1, batch_size=1, store=store, flow=flow)
+            service.start()
+            await service.handle(self.message('dev-a', 0).payload)
+            await asyncio.sleep(0.05)  # the writer takes it and blocks
+            await service.handle(self.message('dev-a', 1).payload)
+            self.assertEqual(calls, [])
+            waiting = asyncio.create_task(service.handle(self.message('dev-a', 2).payload))
+            await asyncio.sleep(0.1)
+            self.assertEqual(calls, ['pause'])
+            release.set()
+            await waiting
+            await service.stop()
+
+        asyncio.run(scenario())
+        self.assertEqual(calls, ['pause', 'resume'])
+
+    @skipUnless(importlib.util.find_spec('aiomqtt'), 'aiomqtt is not installed')
+    def test_flow_control_pauses_aiomqtt_reader(self):
+        import aiomqtt
+        from mqtt_client.aio import FlowControl
+        reader, writer = socket.socketpair()
+        self.addCleanup(reader.close)
+        self.addCleanup(writer.close)
+        reads = []
+
+        async def read():
+            writer.send(b'x')
+            await asyncio.sleep(0.05)
+            return len(b''.join(reads))
+
+        async def scenario():
+            client = aiomqtt.Client('localhost')
+            paho = client._client
+            # As if connected: paho reads the socket when aiomqtt's reader fires.
+            paho.socket = lambda: reader
+            paho.loop_read = lambda *args: reads.append(reader.recv(100))
+            client._on_socket_open(paho, None, reader)
+            flow = FlowControl()
+            flow.connected(client)
+            counts = [await read()]
+            flow.pause()
+            flow.pause()
+            counts.append(await read())
+            flow.resume()
+            counts.append(await read())
+            # aiomqtt's reader again, which turns a broken socket into a disconnect.
+            paho.loop_read = mock.Mock(side_effect=OSError('broken pipe'))
+            await read()
+            asyncio.get_running_loop().remove_reader(reader)
+            return counts, client._disconnected.exception()
+
+        counts, disconnected = asyncio.run(scenario())
+        # The byte sent while paused is read once resumed.
+        self.assertEqual(counts, [1, 1, 3])
+        self.assertIsInstance(disconnected, OSError)
+
+    def test_stop_interrupts_retries(self):
+        def store(batch):
+            raise RuntimeError('database is down')
+
+        async def scenario():
+            service = AsyncIngestService(shards=1, store=store)
+            service.start()
+            await service.handle(self.message('dev-a', 1).payload)
+            await asyncio.sleep(0.1)  # the first attempt failed, waiting to retry
+            started = time.monotonic()
+            await service.stop()
+            return service, time.monotonic() - started
+
+        with self.settings(INGEST_MAX_RETRIES=5, INGEST_RETRY_DELAY=30), self.assertLogs('mqtt_client.aio', 'ERROR'):
+            service, stopping = asyncio.run(scenario())
+        self.assertLess(stopping, 5)
+        self.assertEqual(service.stats['failed_batches'], 1)
+
+    def test_failed_batches_are_counted(self):
+        def store(batch):
+            raise RuntimeError('database is down')
+
+        async def messages():
+            yield self.message('dev-a', 1)
+            await asyncio.sleep(0.1)  # leave the writer time to retry before stopping
+
+        service = AsyncIngestService(shards=1, store=store)
+        with self.settings(INGEST_MAX_RETRIES=2, INGEST_RETRY_DELAY=0), self.assertLogs('mqtt_client.aio', 'ERROR'):
+            asyncio.run(service.run(messages()))
+        self.assertEqual(service.stats['retries'], 2)
+        self.assertEqual(service.stats['failed_batches'], 1)
+
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -98,6 +99,35 @@ DATABASES = {
 }
 
 
+# Cache
+# Alert state and other hot-path lookups live here. Point CACHE_BACKEND and
+# CACHE_LOCATION at a shared cache (e.g. Redis) when running several
+# processes, so they all see the same state; startmqttclient refuses to run
+# several consumers (MQTT_WORKERS > 1 or MQTT_SHARED_GROUP) without one, and
+# so does the dashboard cache (DASHBOARD_CACHE_TTL).
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+# Alert state (core/alerts.py) has no expiry, and losing an entry re-sends
+# its notification, so it gets a cache of its own that is never culled. On a
+# shared backend, run it without eviction of keys that have no timeout (e.g.
+# Redis with a volatile-* maxmemory-policy).
+CACHES['alerts'] = {
+    'BACKEND': CACHE_BACKEND,
+    'LOCATION': os.environ.get('ALERT_CACHE_LOCATION', CACHES['default']['LOCATION']),
+    'KEY_PREFIX': 'alerts',
+}
+if CACHE_BACKEND.endswith('LocMemCache'):
+    CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': 100000}
+    CACHES['alerts']['LOCATION'] = 'alerts'
+    CACHES['alerts']['OPTIONS'] = {'MAX_ENTRIES': sys.maxsize}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -150,6 +180,14 @@ DEFAULT_FROM_EMAIL = 'info@nesosgroup.com'
 
 NOTIFICATIONS_FROM_EMAIL = "notifications@nesosgroup.com"
 
+# Notification outbox, drained by `manage.py sendqueuedemails`
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', 100))
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_POLL_INTERVAL', 5))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 8))
+EMAIL_OUTBOX_RETRY_DELAY = int(os.environ.get('EMAIL_OUTBOX_RETRY_DELAY', 30))  # doubled per attempt
+EMAIL_OUTBOX_MAX_RETRY_DELAY = int(os.environ.get('EMAIL_OUTBOX_MAX_RETRY_DELAY', 3600))
+EMAIL_OUTBOX_CLAIM_TIMEOUT = int(os.environ.get('EMAIL_OUTBOX_CLAIM_TIMEOUT', 300))
+
 # Django REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -174,6 +212,63 @@ SIMPLE_JWT = {
 
 SENSOR_WARNING_THRESHOLD = int(os.environ.get("SENSOR_WARNING_THRESHOLD", 150))
 SENSOR_ALERT_THRESHOLD = int(os.environ.get("SENSOR_ALERT_THRESHOLD", 200))
+# Which gateway's RSSI is stored with a reading when several received the
+# uplink: 'first' (as listed by ChirpStack), 'rssi' or 'snr' (the best one).
+SENSOR_GATEWAY_SELECTION = os.environ.get('SENSOR_GATEWAY_SELECTION', 'first')
+# Record every gateway's reception in GatewayReception for coverage statistics.
+STORE_GATEWAY_RECEPTIONS = os.environ.get('STORE_GATEWAY_RECEPTIONS', '1') == '1'
+# Seconds between reminder e-mails while a device stays above a threshold.
+SENSOR_ALERT_COOLDOWN = int(os.environ.get("SENSOR_ALERT_COOLDOWN", 6 * 60 * 60))
+# Seconds without a reading after which `manage.py notifysilentdevices`
+# tells a device's users it went silent, and devices handled per transaction.
+SENSOR_SILENCE_TIMEOUT = int(os.environ.get('SENSOR_SILENCE_TIMEOUT', 3 * 60 * 60))
+SILENCE_BATCH_SIZE = int(os.environ.get('SILENCE_BATCH_SIZE', 1000))
+
+# Sensor-health checks flagging stored readings (see core/analytics.py).
+# Weight of the newest reading in the moving averages.
+ANALYTICS_EWMA_ALPHA = float(os.environ.get('ANALYTICS_EWMA_ALPHA', 0.1))
+# Readings a device sends before spikes, gaps and RSSI drops are flagged.
+ANALYTICS_WARMUP = int(os.environ.get('ANALYTICS_WARMUP', 10))
+ANALYTICS_STUCK_COUNT = int(os.environ.get('ANALYTICS_STUCK_COUNT', 12))
+ANALYTICS_SPIKE_SIGMA = float(os.environ.get('ANALYTICS_SPIKE_SIGMA', 4.0))
+ANALYTICS_SPIKE_MIN_DELTA = float(os.environ.get('ANALYTICS_SPIKE_MIN_DELTA', 50))
+ANALYTICS_GAP_FACTOR = float(os.environ.get('ANALYTICS_GAP_FACTOR', 5.0))
+ANALYTICS_RSSI_DROP = float(os.environ.get('ANALYTICS_RSSI_DROP', 10.0))
+# Seconds a silent device's summary is kept in the cache.
+ANALYTICS_STATE_TTL = int(os.environ.get('ANALYTICS_STATE_TTL', 30 * 24 * 60 * 60))
+
+# Answer dashboard statistics from the hourly rollups rather than raw readings.
+DASHBOARD_USE_ROLLUPS = os.environ.get('DASHBOARD_USE_ROLLUPS', '1') == '1'
+
+# Seconds a computed dashboard is served from the cache when no reading
+# arrives for the device in the meantime (0 disables the cache). New readings
+# invalidate it from whichever process stores them, so it needs a shared
+# cache and is off by default with LocMemCache (a system check enforces it).
+DASHBOARD_CACHE_TTL = int(os.environ.get('DASHBOARD_CACHE_TTL', 0 if CACHE_BACKEND.endswith('LocMemCache') else 60))
+
+# Retention tiers applied by `manage.py compactreadings`, in days; 0 keeps a
+# tier forever. Raw readings should outlive the dashboard's 30 day window.
+READING_RETENTION_DAYS = int(os.environ.get('READING_RETENTION_DAYS', 90))
+HOURLY_ROLLUP_RETENTION_DAYS = int(os.environ.get('HOURLY_ROLLUP_RETENTION_DAYS', 2 * 365))
+DAILY_ROLLUP_RETENTION_DAYS = int(os.environ.get('DAILY_ROLLUP_RETENTION_DAYS', 0))
+# Rows compactreadings deletes per transaction, and seconds it pauses in
+# between to keep locks short and replication lag down.
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 5000))
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', 0.05))
+
+# Live reading streams (api/devices/<serial>/stream/). On PostgreSQL new
+# readings are passed between processes with NOTIFY; turn it off to save a
+# query per stored batch when nobody uses the streams.
+LIVE_READINGS_NOTIFY = os.environ.get('LIVE_READINGS_NOTIFY', '1') == '1'
+# Readings a slow stream may fall behind before the oldest are dropped.
+LIVE_READINGS_QUEUE_SIZE = int(os.environ.get('LIVE_READINGS_QUEUE_SIZE', 100))
+# Seconds between keep-alive comments on an idle stream.
+LIVE_READINGS_KEEPALIVE = int(os.environ.get('LIVE_READINGS_KEEPALIVE', 15))
+# Seconds browsers wait before reconnecting a dropped stream.
+LIVE_READINGS_RETRY = int(os.environ.get('LIVE_READINGS_RETRY', 5))
+
+# Rows fetched and encoded at a time by the streaming reading exports.
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 5000))
 
 FRONTEND_URL = os.environ.get('FRONTEND_URL', "http://localhost:5173")
 
@@ -220,6 +315,59 @@ MQTT_BROKER_USERNAME = os.environ.get('MQTT_BROKER_USERNAME', '')
 MQTT_BROKER_PASSWORD = os.environ.get('MQTT_BROKER_PASSWORD', '')
 MQTT_BROKER_TOPIC = "application/50c4db63-0f74-4b5a-8d4c-964f238a786d/device/+/event/up"
 MQTT_KEEPALIVE = 60
+# Comma-separated topic filters to consume.
+MQTT_TOPICS = [topic.strip() for topic in os.environ.get('MQTT_TOPICS', MQTT_BROKER_TOPIC).split(',') if topic.strip()]
+MQTT_QOS = int(os.environ.get('MQTT_QOS', 0))
+# Set to consume with MQTT v5 shared subscriptions ($share/<group>/<topic>),
+# which is required to run more than one worker.
+MQTT_SHARED_GROUP = os.environ.get('MQTT_SHARED_GROUP', '')
+MQTT_WORKERS = int(os.environ.get('MQTT_WORKERS', 1))
+# 'paho' (callback client) or 'asyncio' (see mqtt_client.aio).
+MQTT_CLIENT_MODE = os.environ.get('MQTT_CLIENT_MODE', 'paho')
+MQTT_RECONNECT_DELAY = int(os.environ.get('MQTT_RECONNECT_DELAY', 5))
+# asyncio mode: uplinks are sharded by device over this many write queues.
+MQTT_ASYNC_SHARDS = int(os.environ.get('MQTT_ASYNC_SHARDS', 8))
+MQTT_ASYNC_QUEUE_SIZE = int(os.environ.get('MQTT_ASYNC_QUEUE_SIZE', 1000))
+
+# Batched ingest: uplinks are stored in batches of up to INGEST_BATCH_SIZE,
+# or whatever has arrived after INGEST_FLUSH_INTERVAL seconds.
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', 1.0))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 100000))
+INGEST_STATS_INTERVAL = int(os.environ.get('INGEST_STATS_INTERVAL', 60))
+# A batch that fails to store (e.g. the database is down) is retried this
+# many times, waiting INGEST_RETRY_DELAY seconds doubled per attempt, while
+# the queue fills up and holds the consumer back; then it is dropped.
+INGEST_MAX_RETRIES = int(os.environ.get('INGEST_MAX_RETRIES', 8))
+INGEST_RETRY_DELAY = float(os.environ.get('INGEST_RETRY_DELAY', 1.0))
+INGEST_MAX_RETRY_DELAY = float(os.environ.get('INGEST_MAX_RETRY_DELAY', 60))
+# Seconds the paho consumer waits for room in a full queue before dropping
+# an uplink (counted as 'dropped'). Waiting blocks paho's network thread and
+# with it the keepalive, so it stays well below MQTT_KEEPALIVE; 0 waits
+# indefinitely, until the broker drops the connection.
+INGEST_PUT_TIMEOUT = float(os.environ.get('INGEST_PUT_TIMEOUT', MQTT_KEEPALIVE / 2))
+# How MQTT payloads are decoded: 'msgspec', 'orjson', 'json', or 'auto' for
+# the fastest one installed (see core.decoders).
+UPLINK_DECODER = os.environ.get('UPLINK_DECODER', 'auto')
+# Every raw MQTT payload is appended to a compressed archive here (unset to
+# disable); see core.archive and `manage.py replayuplinks`.
+UPLINK_ARCHIVE_DIR = os.environ.get('UPLINK_ARCHIVE_DIR', '')
+UPLINK_ARCHIVE_COMPRESSION = os.environ.get('UPLINK_ARCHIVE_COMPRESSION', 'gzip')  # or 'zstd'
+UPLINK_ARCHIVE_SEGMENT_BYTES = int(os.environ.get('UPLINK_ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))
+UPLINK_ARCHIVE_SEGMENT_SECONDS = int(os.environ.get('UPLINK_ARCHIVE_SEGMENT_SECONDS', 60 * 60))
+UPLINK_ARCHIVE_BLOCK_RECORDS = int(os.environ.get('UPLINK_ARCHIVE_BLOCK_RECORDS', 1000))
+UPLINK_ARCHIVE_FLUSH_INTERVAL = float(os.environ.get('UPLINK_ARCHIVE_FLUSH_INTERVAL', 5))
+# Bearer token Prometheus must send to scrape /metrics (unset disables it),
+# and the port MQTT workers serve their own /metrics on (worker N uses
+# MQTT_METRICS_PORT + N; unset to disable). The workers only listen on
+# MQTT_METRICS_HOST, loopback unless set (e.g. to 0.0.0.0 in a container),
+# and ask for the same token when METRICS_API_KEY is set.
+METRICS_API_KEY = os.environ.get('METRICS_API_KEY', '')
+MQTT_METRICS_PORT = int(os.environ.get('MQTT_METRICS_PORT', 0))
+MQTT_METRICS_HOST = os.environ.get('MQTT_METRICS_HOST', '127.0.0.1')
+# Devices and alert subscribers are cached in-process for the ingest path.
+DEVICE_REGISTRY_SIZE = int(os.environ.get('DEVICE_REGISTRY_SIZE', 10000))
+DEVICE_REGISTRY_TTL = int(os.environ.get('DEVICE_REGISTRY_TTL', 60))
 
 # Logging configuration
 LOGGING = {
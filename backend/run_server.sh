@@ -1,4 +1,4 @@
 #!/bin/bash
 
 python manage.py migrate
-gunicorn radon_backend.wsgi --bind 0.0.0.0:8000
+gunicorn radon_backend.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000